@@ -34,6 +34,10 @@ def process_abbreviation_in_1_entry(key, value, method_name):
         set_controller_name_in_specs(new_value, 'checkpoint_steps')
     if key == 'learning_rate':
         set_controller_name_in_specs(new_value, 'learning_rate')
+    if key == 'abort':
+        if value is True:
+            new_value = {'type': 'divergence_detector'}
+        set_controller_name_in_specs(new_value, 'abort')
 
     if key == 'debug':
         if isinstance(value, int):
@@ -0,0 +1,70 @@
+import numpy as np
+
+from learning_to_learn.useful_functions import InvalidArgumentError
+
+
+def redistribute_cursors(cursor, new_batch_size, dataset_length):
+    """Used by batch generators when batch size is changed. First min(len(cursor), new_batch_size) cursors are kept.
+    Cursors of added streams are placed evenly along dataset starting from cursor[0]"""
+    num_kept = min(len(cursor), new_batch_size)
+    new_cursor = [int(c) for c in cursor[:num_kept]]
+    segment = dataset_length // new_batch_size
+    for offset in range(num_kept, new_batch_size):
+        new_cursor.append((int(cursor[0]) + offset * segment) % dataset_length)
+    return new_cursor
+
+
+def check_vocabulary_is_not_changed(old_vocabulary, new_vocabulary):
+    if new_vocabulary is not None and list(new_vocabulary) != list(old_vocabulary):
+        raise InvalidArgumentError(
+            'Vocabulary of batch generator can not be changed. Create new batch generator instead',
+            new_vocabulary,
+            'vocabulary',
+            'vocabulary used for batch generator construction'
+        )
+
+
+class BatchGeneratorSpecsMixin(object):
+    """change_batch_size, change_specs and cursor state access for batch generators which keep cursors of streams
+    in self._cursor and last batch of previous unrolling in self._last_batch. Generator has to provide _start_batch
+    method. Methods _get_num_positions, _get_vocabulary and _set_num_unrollings are overridden if generator stores
+    length of dataset, vocabulary or number of unrollings differently"""
+    def _get_num_positions(self):
+        return self._number_of_pairs
+
+    def _get_vocabulary(self):
+        return self.vocabulary
+
+    def _set_num_unrollings(self, num_unrollings):
+        self._num_unrollings = num_unrollings
+
+    def change_batch_size(self, batch_size):
+        """Cursors of first min(old, new) streams and their last batches are kept. Added streams start from
+        start batch"""
+        old_batch_size = self._batch_size
+        cursor = redistribute_cursors(self._cursor, batch_size, self._get_num_positions())
+        if isinstance(self._cursor, np.ndarray):
+            cursor = np.array(cursor)
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self._last_batch = np.concatenate([self._last_batch[:batch_size], self._start_batch()[old_batch_size:]], 0)
+
+    def change_specs(self, batch_size=None, num_unrollings=None, vocabulary=None, **kwargs):
+        """kwargs are construction only arguments (e. g. random_batch_initiation) and are ignored"""
+        check_vocabulary_is_not_changed(self._get_vocabulary(), vocabulary)
+        if batch_size is not None and batch_size != self._batch_size:
+            self.change_batch_size(batch_size)
+        if num_unrollings is not None:
+            self._set_num_unrollings(num_unrollings)
+
+    def get_cursor_state(self):
+        """Returns copy of cursors and last batch. PrefetchingBatchGenerator uses it to rewind generator to first
+        batch which was not consumed"""
+        return list(self._cursor), np.array(self._last_batch)
+
+    def set_cursor_state(self, state):
+        cursor, last_batch = state
+        if isinstance(self._cursor, np.ndarray):
+            cursor = np.array(cursor)
+        self._cursor = cursor
+        self._last_batch = last_batch
@@ -1,7 +1,8 @@
 from subword_nmt.apply_bpe import BPE
 import numpy as np
 from learning_to_learn.useful_functions import char2vec, pred2vec, vec2char, get_positions_in_vocabulary, char2id, \
-    id2char, pred2vec_fast, vec2char_fast
+    id2char, pred2vec_fast, vec2char_fast, load_id_file
+from learning_to_learn.batch_generators import BatchGeneratorSpecsMixin
 import re
 
 MAX_NUM_PUNCTUATION_MARKS = 6
@@ -42,7 +43,7 @@ def create_vocabulary(text):
     return sorted(vocabulary)
 
 
-class BpeBatchGenerator(object):
+class BpeBatchGenerator(BatchGeneratorSpecsMixin):
 
     @staticmethod
     def create_vocabulary(texts):
@@ -158,7 +159,7 @@ class BpeBatchGenerator(object):
         return np.stack(batches[:-1]), np.concatenate(batches[1:], 0), tokens
 
 
-class BpeFastBatchGenerator(object):
+class BpeFastBatchGenerator(BatchGeneratorSpecsMixin):
 
     @staticmethod
     def create_vocabulary(texts):
@@ -225,6 +226,12 @@ class BpeFastBatchGenerator(object):
     def get_vocabulary_size(self):
         return self._vocabulary_size
 
+    def get_ids(self):
+        return self._ids
+
+    def get_start_id(self):
+        return char2id('\n', self.character_positions_in_vocabulary)
+
     def _start_batch(self):
         return np.array([[char2id('\n', self.character_positions_in_vocabulary)] for _ in range(self._batch_size)])
 
@@ -271,6 +278,38 @@ class BpeFastBatchGenerator(object):
         return np.stack(batches[:-1]), np.concatenate(batches[1:], 0), tokens
 
 
+class BpeMemmapBatchGenerator(BpeFastBatchGenerator):
+    """Instead of text a name of file created with useful_functions.create_id_file from
+    BpeFastBatchGenerator.make_pairs(text, None) is passed. Ids are read through np.memmap."""
+    def __init__(self, id_file_name, batch_size, num_unrollings=1, vocabulary=None):
+        self._text = None
+        self._pairs = None
+        self._ids = load_id_file(id_file_name)
+        self._number_of_pairs = len(self._ids)
+        self._text_size = None
+        self._batch_size = batch_size
+        self.vocabulary = vocabulary
+        self._vocabulary_size = len(self.vocabulary)
+        self.character_positions_in_vocabulary = get_positions_in_vocabulary(self.vocabulary)
+        self._num_unrollings = num_unrollings
+        segment = self._number_of_pairs // batch_size
+        self._cursor = [offset * segment for offset in range(batch_size)]
+        self._last_batch = self._start_batch()
+
+    def get_dataset_length(self):
+        return self._number_of_pairs
+
+    def _next_batch_with_tokens(self):
+        tokens = list()
+        bs = list()
+        for b in range(self._batch_size):
+            id_ = self._ids[self._cursor[b]]
+            tokens.append(self.vocabulary[id_])
+            bs.append(np.array([id_]))
+            self._cursor[b] = (self._cursor[b] + 1) % self._number_of_pairs
+        return np.stack(bs), tokens
+
+
 def create_vocabularies_one_hot(text, punctuation_marks):
     vocabulary = list()
     text = re.sub('@@', '', text)
@@ -351,7 +390,7 @@ def vec2char_one_hot(vec, vocabularies):
     return ''.join(chars)
 
 
-class BpeBatchGeneratorOneHot(object):
+class BpeBatchGeneratorOneHot(BatchGeneratorSpecsMixin):
 
     @staticmethod
     def create_vocabularies(texts, punctuation_marks):
@@ -425,6 +464,9 @@ class BpeBatchGeneratorOneHot(object):
     def get_vocabulary_size(self):
         return self._vocabulary_sizes
 
+    def _get_vocabulary(self):
+        return self.vocabularies
+
     def _start_batch(self):
         word_batch = np.zeros(shape=(self._batch_size, self._vocabulary_sizes[0]), dtype=np.float)
         for b in range(self._batch_size):
@@ -542,7 +584,7 @@ def pred2vec_one_hot_fast(preds, batch_gen_args):
     return np.stack(tuple(vec), axis=1)
 
 
-class BpeFastBatchGeneratorOneHot(object):
+class BpeFastBatchGeneratorOneHot(BatchGeneratorSpecsMixin):
 
     @staticmethod
     def create_vocabularies(texts, punctuation_marks):
@@ -629,6 +671,9 @@ class BpeFastBatchGeneratorOneHot(object):
     def get_vocabulary_size(self):
         return self._vocabulary_sizes
 
+    def _get_vocabulary(self):
+        return self.vocabularies
+
     def _start_batch(self):
         return np.array([[char2id('\n', self.character_positions_in_vocabulary[0])] + [0] * MAX_NUM_PUNCTUATION_MARKS
                          for _ in range(self._batch_size)])
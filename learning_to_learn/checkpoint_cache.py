@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+import tensorflow as tf
+
+
+class PupilCheckpointCache(object):
+    """Keeps values of pupil checkpoints in memory as numpy arrays so exercises can be restored without reading
+    checkpoint files. Checkpoints are evicted in least recently used order if total size of cached arrays exceeds
+    max_bytes (max_bytes=None means no limit). The most recently used checkpoint is never evicted"""
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._sizes = dict()
+        self._total_bytes = 0
+        self._num_hits = 0
+        self._num_misses = 0
+
+    @staticmethod
+    def _load(path, names):
+        reader = tf.train.NewCheckpointReader(path)
+        return {name: reader.get_tensor(name) for name in names}
+
+    def _evict(self):
+        while self._max_bytes is not None and self._total_bytes > self._max_bytes and len(self._cache) > 1:
+            path, _ = self._cache.popitem(last=False)
+            self._total_bytes -= self._sizes.pop(path)
+
+    def get(self, path, names):
+        """Returns dictionary with values of variables names from checkpoint path"""
+        if path in self._cache:
+            self._num_hits += 1
+            self._cache.move_to_end(path)
+        else:
+            self._num_misses += 1
+            values = self._load(path, names)
+            self._cache[path] = values
+            self._sizes[path] = sum([v.nbytes for v in values.values()])
+            self._total_bytes += self._sizes[path]
+            self._evict()
+        return self._cache[path]
+
+    def get_stats(self):
+        return dict(
+            num_hits=self._num_hits,
+            num_misses=self._num_misses,
+            num_cached=len(self._cache),
+            cached_bytes=self._total_bytes
+        )
+
+    def clear(self):
+        self._cache = OrderedDict()
+        self._sizes = dict()
+        self._total_bytes = 0
@@ -1,11 +1,16 @@
 import csv
+import itertools
 import multiprocessing as mp
+import os
 import queue
 import random
 import re
 import select
+import shutil
 import sys
+import tempfile
 import time
+import traceback
 from collections import OrderedDict
 
 import numpy as np
@@ -16,12 +21,19 @@ from learning_to_learn.args_parsing import parse_1_set_of_kwargs, parse_train_me
 from learning_to_learn.bpe import prepare_for_bpe, bpe_post_processing
 from tensorflow.python import debug as tf_debug
 from learning_to_learn.tensors import identity_tensor
-from learning_to_learn.useful_functions import InvalidArgumentError
+from learning_to_learn.useful_functions import InvalidArgumentError, WorkerError
 from learning_to_learn.useful_functions import construct, add_index_to_filename_if_needed, match_two_dicts, \
     create_path, check_if_key_in_nested_dict, add_missing_to_list, print_and_log, apply_temperature, sample, is_int, \
     create_distribute_map, nth_element_of_sequence_of_sequences
 
 from learning_to_learn.handler import Handler
+from learning_to_learn.prefetch import PrefetchingBatchGenerator
+from learning_to_learn.exercise_batches import MultiExerciseBatchGenerator
+from learning_to_learn.checkpoint_cache import PupilCheckpointCache
+from learning_to_learn.results_store import ResultsStoreReader, RESULTS_STORE_FILE_NAME
+from learning_to_learn.grid_index import hp_comb_hash, read_grid_index, GRID_INDEX_FILE_NAME
+from learning_to_learn.hp_search import GaussianProcessProposer, encode_hp_combs
+from learning_to_learn.graph_cache import GraphCache, graph_cache_key, UncacheableGraphError
 from subword_nmt.apply_bpe import BPE
 
 
@@ -76,6 +88,10 @@ class Controller(object):
 
         elif self._specifications['type'] == 'linear':
             self.get = self._linear
+        elif self._specifications['type'] == 'divergence_detector':
+            self._num_checked = 0
+            self._abort_reason = None
+            self.get = self._divergence_detector
 
     def _changes_detector(self):
         something_changed = False
@@ -100,6 +116,35 @@ class Controller(object):
         else:
             return end
 
+    def _divergence_detector(self):
+        """Returns reason for aborting of launch or None. Values of result_type collected in storage['train'] are
+        checked for not finite values (check_nan), crossing threshold and absence of improvement by more than
+        min_delta during last window collected values. If maximize is True (default for accuracy) larger values
+        are better: launch is aborted if result falls below threshold"""
+        result_type = self._specifications.get('result_type', 'loss')
+        maximize = self._specifications.get('maximize', result_type.endswith('accuracy'))
+        values = self._storage.get('train', dict()).get(result_type, list())
+        if len(values) == self._num_checked:
+            return self._abort_reason
+        self._num_checked = len(values)
+        last = values[-1]
+        threshold = self._specifications.get('threshold')
+        window = self._specifications.get('window')
+        min_delta = self._specifications.get('min_delta', 0.)
+        if self._specifications.get('check_nan', True) and not np.isfinite(last):
+            self._abort_reason = '%s is %s' % (result_type, last)
+        elif threshold is not None and (last < threshold if maximize else last > threshold):
+            self._abort_reason = '%s %s %s threshold %s' % (
+                result_type, last, 'is below' if maximize else 'exceeds', threshold)
+        elif window is not None and len(values) > window:
+            if maximize:
+                not_improved = max(values[-window:]) < max(values[:-window]) + min_delta
+            else:
+                not_improved = min(values[-window:]) > min(values[:-window]) - min_delta
+            if not_improved:
+                self._abort_reason = '%s did not improve during last %s collected values' % (result_type, window)
+        return self._abort_reason
+
     def _limit_steps(self):
         if self._storage['step'] > self._specifications['limit']:
             return False
@@ -130,8 +175,24 @@ class Controller(object):
         return self._specifications['name']
 
 
+class _TaskResultQueue(object):
+    """Passed to launch methods in grid search worker processes instead of mp.Queue. Tags results with task id
+    and launch index so parent process can match them with hyperparameter combinations"""
+    def __init__(self, result_queue, task_id):
+        self._result_queue = result_queue
+        self._task_id = task_id
+        self._launch_idx = 0
+
+    def put(self, result):
+        self._result_queue.put((self._task_id, self._launch_idx, result))
+        self._launch_idx += 1
+
+
 class Environment(object):
 
+    # hooks used by variable initializers
+    _initialization_hooks = ['init_parameter', 'optimizer_init_parameter']
+
     @staticmethod
     def put_result_types_in_correct_order(result_types):
         correct_order = ['loss', 'perplexity', 'accuracy', 'bpc']
@@ -148,14 +209,19 @@ class Environment(object):
                  datasets=None,
                  filenames=None,
                  texts=None,
-                 meta_optimizer_class=None):
+                 meta_optimizer_class=None,
+                 graph_cache_dir=None):
         """ Initializes environment class
         Args:
             pupil_class: is a class to which pupil model belongs
             meta_optimizer_class: is a class to which meta_optimizer model belongs if it is provided
             data_filenames: contains paths to a files with data for model training, validation and testing
                 has to be a dictionary in which keys are names of datasets, values are strings with paths to files
-            batch_generator_classes: """
+            batch_generator_classes:
+            graph_cache_dir: if provided built graphs are saved into this directory and are imported instead of
+                building if pupil or optimizer is built again with the same kwargs (e.g. in grid search
+                processes). If graph is imported pupil and optimizer objects are not created and only hooks
+                are available"""
 
         self._pupil_class = pupil_class
         self._pupil_type = self._pupil_class.get_name()
@@ -194,6 +260,16 @@ class Environment(object):
         self._pupil = None
         self._meta_optimizer = None
 
+        if graph_cache_dir is None:
+            self._graph_cache = None
+        else:
+            self._graph_cache = GraphCache(graph_cache_dir)
+        # key of pupil graph in graph cache. It is a part of meta optimizer graph key. None if pupil graph is not
+        # cached
+        self._pupil_graph_key = None
+        # number of operations in graph after pupil is built or imported
+        self._pupil_graph_num_ops = None
+
         # An attribute holding tensors which could be run. It has the form of dictionary which keys are user specified
         # descriptors of tensors and are tensors themselves
         self._hooks = dict()
@@ -204,6 +280,8 @@ class Environment(object):
 
         # An attribute holding session. Default value when there is no active sessions is None
         self._session = None
+        # callables created by Session.make_callable for current session (see _run_fetches)
+        self._callables = dict()
 
         self._build_functions = {'identity': identity_tensor}
 
@@ -270,7 +348,8 @@ class Environment(object):
                 summary=False,
                 add_graph_to_summary=False,
                 batch_generator_class=self._default_batch_generator,
-                vocabulary=self._vocabulary
+                vocabulary=self._vocabulary,
+                use_results_store=False
             ),
             run=dict(
                 train_specs=dict(
@@ -280,6 +359,7 @@ class Environment(object):
                     train_dataset=default_dataset,  # list of 2 elements. First is text string, the second is name
                     batch_size={'type': 'fixed', 'value': 64, 'name': 'batch_size'},
                     train_batch_kwargs=dict(),
+                    prefetch_batches=None,
                     checkpoint_steps=None,
                     debug=None,
                     validation_datasets=None,
@@ -287,7 +367,8 @@ class Environment(object):
                     validation_batch_size=1,
                     valid_batch_kwargs=dict(),
                     validate_tokens_by_chars=False,
-                    no_validation=False
+                    no_validation=False,
+                    abort=None
                 ),
                 schedule=dict(
                     to_be_collected_while_training=construct(default_collected_while_training),
@@ -322,7 +403,8 @@ class Environment(object):
                 summary=False,
                 add_graph_to_summary=False,
                 batch_generator_class=self._default_batch_generator,
-                vocabulary=self._vocabulary
+                vocabulary=self._vocabulary,
+                use_results_store=False
             ),
             run=dict(
                 train_specs=dict(
@@ -340,12 +422,20 @@ class Environment(object):
                     train_datasets=[default_dataset],
                     batch_size={'type': 'fixed', 'value': 64, 'name': 'batch_size'},
                     train_batch_kwargs=dict(),
+                    prefetch_batches=None,
+                    one_batch_source=False,
+                    use_pupil_checkpoint_cache=False,
+                    pupil_checkpoint_cache_max_bytes=None,
+
+                    num_loop_unrollings=None,
 
                     checkpoint_steps=None,
-                    debug=None
+                    debug=None,
+                    abort=None
                 ),
                 optimizer_inference=dict(
                     opt_inf_is_performed=False,
+                    opt_inf_num_workers=None,
                     opt_inf_stop=None,
                     opt_inf_pupil_restore_paths=None,
                     opt_inf_additions_to_feed_dict=None,
@@ -427,6 +517,15 @@ class Environment(object):
         self.current_optimizer_build_parameters = None
         self.current_optimizer_launch_parameters = None
         self.mp_debug_flag = 0
+        # queue statistics of prefetching batch generators used in last _train or _train_optimizer call
+        self._prefetch_stats = dict()
+        # processes and queues used for optimizer inference in background (opt_inf_num_workers)
+        self._opt_inf_workers = None
+        # arguments of Handler of current meta optimizer training except for save_path. Workers create handlers
+        # with them
+        self._opt_inf_handler_specs = None
+        # persistent processes used by grid_search and grid_search_for_meta
+        self._grid_search_workers = None
 
     def build_pupil(self, **kwargs):
         """A method building the graph
@@ -437,9 +536,28 @@ class Environment(object):
         # checking if passed required arguments
         self._build_pupil(kwargs)
 
+    def _get_graph_cache_key(self, cls, kwargs, parent_key=None):
+        """Returns None if graph can not be cached"""
+        try:
+            return graph_cache_key(cls, kwargs, parent_key=parent_key)
+        except UncacheableGraphError as e:
+            print('(Environment._get_graph_cache_key)graph is not cached: %s' % e)
+            return None
+
     def _build_pupil(self, kwargs):
         self._pupil_class.check_kwargs(**kwargs)
         self.current_pupil_build_parameters = kwargs
+        self._pupil_graph_key = None
+        # graph is cached only if it holds nothing but pupil
+        if self._graph_cache is not None and len(tf.get_default_graph().get_operations()) == 0:
+            self._pupil_graph_key = self._get_graph_cache_key(self._pupil_class, kwargs)
+            if self._pupil_graph_key is not None:
+                cached_hooks = self._graph_cache.load(self._pupil_graph_key)
+                if cached_hooks is not None:
+                    self._pupil = None
+                    self._hooks.update(cached_hooks)
+                    self._pupil_graph_num_ops = len(tf.get_default_graph().get_operations())
+                    return
         # Building the graph
         self._pupil = self._pupil_class(**kwargs)
 
@@ -448,13 +566,39 @@ class Environment(object):
         # print('(Environment._build_pupil)default_hooks:', default_hooks)
         self._hooks.update(default_hooks)
         # self._register_default_builders()
+        if self._pupil_graph_key is not None:
+            if self._pupil_graph_key not in self._graph_cache:
+                self._graph_cache.save(self._pupil_graph_key, default_hooks)
+            self._pupil_graph_num_ops = len(tf.get_default_graph().get_operations())
 
     def build_optimizer(self, **kwargs):
         self._meta_optimizer_class.check_kwargs(**kwargs)
-        self.current_pupil_build_parameters = kwargs
+        self.current_optimizer_build_parameters = kwargs
+        # pupil and optimizer are saved in one graph so graph is imported or built from scratch. Graph is cached
+        # only if nothing was added to graph after pupil
+        if self._graph_cache is None or self._pupil_graph_key is None \
+                or len(tf.get_default_graph().get_operations()) != self._pupil_graph_num_ops:
+            key = None
+        else:
+            key = self._get_graph_cache_key(self._meta_optimizer_class, kwargs, parent_key=self._pupil_graph_key)
+        if key is not None and key in self._graph_cache:
+            tf.reset_default_graph()
+            self._pupil = None
+            self._meta_optimizer = None
+            self._hooks.update(self._graph_cache.load(key))
+            return
+        if self._pupil is None:
+            # pupil graph was imported from cache but optimizer needs pupil object
+            tf.reset_default_graph()
+            self._pupil = self._pupil_class(**self.current_pupil_build_parameters)
+            self._hooks.update(self._pupil.get_default_hooks())
         self._meta_optimizer = self._meta_optimizer_class(self._pupil, **kwargs)
         default_hooks = self._meta_optimizer.get_default_hooks()
         self._hooks.update(default_hooks)
+        if key is not None:
+            hooks = self._pupil.get_default_hooks()
+            hooks.update(default_hooks)
+            self._graph_cache.save(key, hooks)
 
     @classmethod
     def _update_dict(cls, dict_to_update, update):
@@ -507,8 +651,10 @@ class Environment(object):
             return self.default_train_optimizer_method_args
         return None
 
-    def _start_session(self, allow_soft_placement, log_device_placement, gpu_memory, allow_growth, visible_device_list):
-        """Starts new session with specified parameters. If there is opend session closes it"""
+    def _start_session(self, allow_soft_placement, log_device_placement, gpu_memory, allow_growth, visible_device_list,
+                       num_threads=None):
+        """Starts new session with specified parameters. If there is opend session closes it. num_threads limits
+        intra op and inter op thread pools (None means TensorFlow default)"""
         if self._session is not None:
             print('Warning: there is an opened session already. Closing it')
             self._session.close()
@@ -523,12 +669,30 @@ class Environment(object):
             ),
             log_device_placement=log_device_placement
         )
+        if num_threads is not None:
+            config.intra_op_parallelism_threads = num_threads
+            config.inter_op_parallelism_threads = num_threads
         # config.gpu_options.per_process_gpu_memory_fraction = gpu_memory
         self._session = tf.Session(config=config)
+        self._callables = dict()
+
+    def _run_fetches(self, fetches, feed_dict):
+        """Replacement of session.run for training and validation loops. For every new combination of fetches and
+        fed tensors a callable is created with Session.make_callable. Feed values are passed to it positionally.
+        session.run is used if handler fetches scheduled (print, summary) tensors or if session is wrapped by
+        debugger"""
+        if not self._handler.last_fetches_are_basic() or not isinstance(self._session, tf.Session):
+            return self._session.run(fetches, feed_dict=feed_dict)
+        feed_list = list(feed_dict.keys())
+        key = (tuple(fetches), tuple(feed_list))
+        if key not in self._callables:
+            self._callables[key] = self._session.make_callable(fetches, feed_list=feed_list)
+        return self._callables[key](*[feed_dict[tensor] for tensor in feed_list])
 
     def _close_session(self):
         self._session.close()
         self._session = None
+        self._callables = dict()
 
     def init_storage(self, dataset_name, **kwargs):
         self._current_place_for_result_saving[dataset_name] = dict()
@@ -610,7 +774,7 @@ class Environment(object):
         if model_type == 'pupil':
             self._hooks['saver'].save(self._session, path)
         elif model_type == 'meta_optimizer':
-            self._hooks['saver'].save(self._session, path)
+            self._hooks['meta_optimizer_saver'].save(self._session, path)
 
     def _restore_pupil(self, restore_path, verbose=True):
         if restore_path is not None:
@@ -642,8 +806,12 @@ class Environment(object):
                             session_specs['log_device_placement'],
                             session_specs['gpu_memory'],
                             session_specs['allow_growth'],
-                            session_specs['visible_device_list'])
-        self._session.run(tf.global_variables_initializer())
+                            session_specs['visible_device_list'],
+                            num_threads=session_specs.get('num_threads'))
+        self._session.run(
+            tf.global_variables_initializer(),
+            feed_dict=self._form_initialization_feed_dict(work['additions_to_feed_dict'])
+        )
         self._restore_pupil(start_specs['restore_path'])
         add_feed_dict = dict()
         # print("(Environment.test)work['additions_to_feed_dict']:", work['additions_to_feed_dict'])
@@ -804,6 +972,17 @@ class Environment(object):
     ):
         if additional_feed_dict is None:
             additional_feed_dict = dict()
+        if 'batched_validation_inputs' in self._hooks:
+            return self._validate_by_streams(
+                batch_generator_class,
+                validation_dataset,
+                valid_batch_kwargs,
+                training_step=training_step,
+                additional_feed_dict=additional_feed_dict,
+                save_to_file=save_to_file,
+                save_to_storage=save_to_storage,
+                print_results=print_results
+            )
         # print('valid_batch_kwargs:', valid_batch_kwargs)
         if 'reset_validation_state' in self._hooks:
             self._session.run(self._hooks['reset_validation_state'])
@@ -812,6 +991,9 @@ class Environment(object):
         length = valid_batches.get_dataset_length()
         inputs, labels = valid_batches.next()
         step = 0
+        accumulate_on_device = 'validation_accumulate_metrics' in self._hooks
+        if accumulate_on_device:
+            self._session.run(self._hooks['reset_validation_accumulators'])
         self._handler.start_accumulation(validation_dataset[1], training_step=training_step)
         # print("(Environment._validate/before loop)self._current_place_for_result_saving:",
         #       self._current_place_for_result_saving)
@@ -821,16 +1003,90 @@ class Environment(object):
                          self._hooks['validation_labels']: labels}
             if isinstance(additional_feed_dict, dict):
                 feed_dict.update(additional_feed_dict)
-            valid_res = self._session.run(validation_operations, feed_dict=feed_dict)
-            self._handler.process_results(training_step, valid_res, regime='validation')
+            if accumulate_on_device:
+                self._run_accumulating_validation_step(validation_operations, feed_dict, 'validation_', training_step)
+            else:
+                valid_res = self._run_fetches(validation_operations, feed_dict)
+                self._handler.process_results(training_step, valid_res, regime='validation')
             step += 1
             inputs, labels = valid_batches.next()
 
         # print("(Environment._validate/after loop)self._current_place_for_result_saving:",
         #       self._current_place_for_result_saving)
+        if accumulate_on_device:
+            precomputed_means = self._get_accumulated_validation_means('validation_')
+        else:
+            precomputed_means = None
         means = self._handler.stop_accumulation(save_to_file=save_to_file,
                                                 save_to_storage=save_to_storage,
-                                                print_results=print_results)
+                                                print_results=print_results,
+                                                precomputed_means=precomputed_means)
+        return means
+
+    def _run_accumulating_validation_step(self, validation_operations, feed_dict, prefix, training_step):
+        """Metrics are accumulated in pupil graph. If handler does not need scheduled tensors only accumulation op
+        is run and nothing is fetched"""
+        accumulate_op = self._hooks[prefix + 'accumulate_metrics']
+        if self._handler.last_fetches_are_basic():
+            self._run_fetches([accumulate_op], feed_dict)
+        else:
+            valid_res = self._session.run(validation_operations + [accumulate_op], feed_dict=feed_dict)
+            self._handler.process_results(training_step, valid_res[:-1], regime='validation')
+
+    def _get_accumulated_validation_means(self, prefix):
+        fetches = dict()
+        for res_type in self._handler.result_types:
+            if prefix + 'accumulated_' + res_type in self._hooks:
+                fetches[res_type] = self._hooks[prefix + 'accumulated_' + res_type]
+        return dict([(res_type, float(mean)) for res_type, mean in self._session.run(fetches).items()])
+
+    def _validate_by_streams(
+            self,
+            batch_generator_class,
+            validation_dataset,
+            valid_batch_kwargs,
+            training_step=None,
+            additional_feed_dict=None,
+            save_to_file=None,
+            save_to_storage=None,
+            print_results=None
+    ):
+        """Validation on pupil batched validation graph. Validation text is split into num_validation_streams
+        segments and num_validation_unrollings characters of every segment are processed per session.run call.
+        Since every call processes the same number of characters averaging of per call metrics performed
+        by Handler.stop_accumulation is equal to averaging over characters. Last length % (num_streams * num_unrollings)
+        characters are not used."""
+        [num_unrollings, num_streams, _] = self._hooks['batched_validation_inputs'].get_shape().as_list()
+        self._session.run(self._hooks['reset_batched_validation_state'])
+        batch_kwargs = dict(valid_batch_kwargs)
+        batch_kwargs['num_unrollings'] = num_unrollings
+        valid_batches = batch_generator_class(validation_dataset[0], num_streams, **batch_kwargs)
+        num_steps = valid_batches.get_dataset_length() // (num_streams * num_unrollings)
+        accumulate_on_device = 'batched_validation_accumulate_metrics' in self._hooks
+        if accumulate_on_device:
+            self._session.run(self._hooks['reset_batched_validation_accumulators'])
+        self._handler.start_accumulation(validation_dataset[1], training_step=training_step)
+        for step in range(num_steps):
+            inputs, labels = valid_batches.next()
+            validation_operations = self._handler.get_tensors('batched_validation', step)
+            feed_dict = {self._hooks['batched_validation_inputs']: inputs,
+                         self._hooks['batched_validation_labels']: labels}
+            if isinstance(additional_feed_dict, dict):
+                feed_dict.update(additional_feed_dict)
+            if accumulate_on_device:
+                self._run_accumulating_validation_step(
+                    validation_operations, feed_dict, 'batched_validation_', training_step)
+            else:
+                valid_res = self._run_fetches(validation_operations, feed_dict)
+                self._handler.process_results(training_step, valid_res, regime='validation')
+        if accumulate_on_device:
+            precomputed_means = self._get_accumulated_validation_means('batched_validation_')
+        else:
+            precomputed_means = None
+        means = self._handler.stop_accumulation(save_to_file=save_to_file,
+                                                save_to_storage=save_to_storage,
+                                                print_results=print_results,
+                                                precomputed_means=precomputed_means)
         return means
 
     def _validate_by_chars(
@@ -861,7 +1117,7 @@ class Environment(object):
                          self._hooks['validation_labels']: labels}
             if isinstance(additional_feed_dict, dict):
                 feed_dict.update(additional_feed_dict)
-            valid_res = self._session.run(validation_operations, feed_dict=feed_dict)
+            valid_res = self._run_fetches(validation_operations, feed_dict)
             self._handler.process_results(training_step, valid_res, correct_tokens[0], regime='validation_by_chars')
             step += 1
             inputs, labels, correct_tokens = valid_batches.next_with_tokens()
@@ -991,6 +1247,33 @@ class Environment(object):
             valid_add_feed_dict[self._hooks[addition['placeholder']]] = addition['value']
         return valid_add_feed_dict
 
+    def _close_prefetching_batch_generators(self, key, batch_gens):
+        """Stops background threads of prefetching generators and sums up their queue statistics in
+        self._prefetch_stats[key]"""
+        for b_gen in batch_gens:
+            if isinstance(b_gen, PrefetchingBatchGenerator):
+                b_gen.close()
+                if key not in self._prefetch_stats:
+                    self._prefetch_stats[key] = dict(num_requests=0, num_starvations=0, accumulated_depth=0.)
+                stats = b_gen.get_stats()
+                accumulated = self._prefetch_stats[key]
+                accumulated['num_requests'] += stats['num_requests']
+                accumulated['num_starvations'] += stats['num_starvations']
+                accumulated['accumulated_depth'] += stats['mean_queue_depth'] * stats['num_requests']
+
+    def get_prefetch_stats(self):
+        """Returns queue statistics of prefetching batch generators (train specs prefetch_batches) used since
+        last train or train_optimizer call. Large number of starvations means that batch generation is slower than
+        session.run and prefetching queue stays empty"""
+        res = dict()
+        for key, stats in self._prefetch_stats.items():
+            res[key] = dict(
+                num_requests=stats['num_requests'],
+                num_starvations=stats['num_starvations'],
+                mean_queue_depth=stats['accumulated_depth'] / max(stats['num_requests'], 1)
+            )
+        return res
+
     def _train(
             self,
             run_specs,
@@ -1032,6 +1315,10 @@ class Environment(object):
         if train_specs['stop']['type'] == 'limit_steps':
             train_specs['stop']['limit'] += init_step
         should_continue = Controller(storage, train_specs['stop'])
+        if train_specs['abort'] is not None:
+            should_abort = Controller(storage, train_specs['abort'])
+        else:
+            should_abort = Controller(storage, {'type': 'always_false'})
 
         to_be_collected_while_training = schedule['to_be_collected_while_training']
         collect_interval = to_be_collected_while_training['results_collect_interval']
@@ -1121,87 +1408,96 @@ class Environment(object):
         tb_kwargs = self._build_batch_kwargs(train_batch_kwargs)
         # print("(Environment._train)tb_kwargs:", tb_kwargs)
         train_batches = batch_generator_class(train_specs['train_dataset'][0], batch_size, **tb_kwargs)
+        if train_specs['prefetch_batches'] is not None:
+            train_batches = PrefetchingBatchGenerator(train_batches, queue_size=train_specs['prefetch_batches'])
         feed_dict = dict()
-        while should_continue.get():
-            if should_start_debugging.get():
-                self._session = tf_debug.LocalCLIDebugWrapperSession(self._session)
-                self._session.add_tensor_filter("has_inf_or_nan", tf_debug.has_inf_or_nan)
-
-            if batch_size_should_change.get():
-                batch_size = batch_size_controller.get()
-                train_batches.change_batch_size(batch_size)
-
-            if batch_generator_specs_should_change.get():
-                tb_kwargs = self._build_batch_kwargs(train_batch_kwargs)
-                train_batches.change_specs(**tb_kwargs)
-
-            if it_is_time_to_create_checkpoint.get():
-                self._create_checkpoint(step, checkpoints_path)
-            train_inputs, train_labels = train_batches.next()
-
-            if not with_meta_optimizer:
-                learning_rate = learning_rate_controller.get()
-                feed_dict[self._hooks['learning_rate']] = learning_rate
-
-            if isinstance(self._hooks['inputs'], list):
-                for input_tensor, input_value in zip(self._hooks['inputs'], train_inputs):
-                    feed_dict[input_tensor] = input_value
-            else:
-                feed_dict[self._hooks['inputs']] = train_inputs
-            if isinstance(self._hooks['labels'], list):
-                for label_tensor, label_value in zip(self._hooks['labels'], train_labels):
-                    feed_dict[label_tensor] = label_value
-            else:
-                feed_dict[self._hooks['labels']] = train_labels
-            for addition, add_controller in zip(train_feed_dict_additions, additional_controllers):
-                feed_dict[self._hooks[addition['placeholder']]] = add_controller.get()
-            # print('(Environment._train)self._hooks:', self._hooks)
-
-            train_operations = self._handler.get_tensors('train', step, with_meta_optimizer=with_meta_optimizer)
-            # print('train_operations:', train_operations)
-            # print('feed_dict:', feed_dict)
-
-            train_res = self._session.run(train_operations, feed_dict=feed_dict)
-            # here loss is given in bits per input (BPI)
-            self._handler.process_results(step, train_res, regime='train')
-            # print("(Environment._train)train_specs['valid_batch_kwargs']:", train_specs['valid_batch_kwargs'])
-            if it_is_time_for_validation.get():
-                if len(train_specs['validation_datasets']) > 0:
+        # background thread of prefetching generator is stopped even if training fails
+        try:
+            while should_continue.get():
+                if should_start_debugging.get():
+                    self._session = tf_debug.LocalCLIDebugWrapperSession(self._session)
+                    self._session.add_tensor_filter("has_inf_or_nan", tf_debug.has_inf_or_nan)
+
+                if batch_size_should_change.get():
+                    batch_size = batch_size_controller.get()
+                    train_batches.change_batch_size(batch_size)
+
+                if batch_generator_specs_should_change.get():
+                    tb_kwargs = self._build_batch_kwargs(train_batch_kwargs)
+                    train_batches.change_specs(**tb_kwargs)
+
+                if it_is_time_to_create_checkpoint.get():
+                    self._create_checkpoint(step, checkpoints_path)
+                train_inputs, train_labels = train_batches.next()
+
+                if not with_meta_optimizer:
+                    learning_rate = learning_rate_controller.get()
+                    feed_dict[self._hooks['learning_rate']] = learning_rate
+
+                if isinstance(self._hooks['inputs'], list):
+                    for input_tensor, input_value in zip(self._hooks['inputs'], train_inputs):
+                        feed_dict[input_tensor] = input_value
+                else:
+                    feed_dict[self._hooks['inputs']] = train_inputs
+                if isinstance(self._hooks['labels'], list):
+                    for label_tensor, label_value in zip(self._hooks['labels'], train_labels):
+                        feed_dict[label_tensor] = label_value
+                else:
+                    feed_dict[self._hooks['labels']] = train_labels
+                for addition, add_controller in zip(train_feed_dict_additions, additional_controllers):
+                    feed_dict[self._hooks[addition['placeholder']]] = add_controller.get()
+                # print('(Environment._train)self._hooks:', self._hooks)
+
+                train_operations = self._handler.get_tensors('train', step, with_meta_optimizer=with_meta_optimizer)
+                # print('train_operations:', train_operations)
+                # print('feed_dict:', feed_dict)
+
+                train_res = self._run_fetches(train_operations, feed_dict)
+                # here loss is given in bits per input (BPI)
+                self._handler.process_results(step, train_res, regime='train')
+                abort_reason = should_abort.get()
+                if abort_reason:
+                    self._abort_launch(step, abort_reason)
+                    break
+                # print("(Environment._train)train_specs['valid_batch_kwargs']:", train_specs['valid_batch_kwargs'])
+                if it_is_time_for_validation.get():
+                    if len(train_specs['validation_datasets']) > 0:
+                        valid_add_feed_dict = self._form_validation_additional_feed_dict(
+                            train_feed_dict_additions, additional_controllers, validation_additional_feed_dict)
+                    for validation_dataset in train_specs['validation_datasets']:
+                        if train_specs['validate_tokens_by_chars']:
+                            # print('(Environment._train)ready to validate by chars')
+                            _ = self._validate_by_chars(
+                                batch_generator_class, validation_dataset, train_specs['validation_batch_size'],
+                                train_specs['valid_batch_kwargs'], training_step=step,
+                                additional_feed_dict=valid_add_feed_dict)
+                        else:
+                            _ = self._validate(
+                                batch_generator_class, validation_dataset, train_specs['validation_batch_size'],
+                                train_specs['valid_batch_kwargs'], training_step=step,
+                                additional_feed_dict=valid_add_feed_dict)
+                if it_is_time_for_example.get():
                     valid_add_feed_dict = self._form_validation_additional_feed_dict(train_feed_dict_additions,
                                                                                      additional_controllers,
                                                                                      validation_additional_feed_dict)
-                for validation_dataset in train_specs['validation_datasets']:
-                    if train_specs['validate_tokens_by_chars']:
-                        # print('(Environment._train)ready to validate by chars')
-                        _ = self._validate_by_chars(
-                            batch_generator_class, validation_dataset, train_specs['validation_batch_size'],
-                            train_specs['valid_batch_kwargs'], training_step=step,
-                            additional_feed_dict=valid_add_feed_dict)
-                    else:
-                        _ = self._validate(
-                            batch_generator_class, validation_dataset, train_specs['validation_batch_size'],
-                            train_specs['valid_batch_kwargs'], training_step=step,
-                            additional_feed_dict=valid_add_feed_dict)
-            if it_is_time_for_example.get():
-                valid_add_feed_dict = self._form_validation_additional_feed_dict(train_feed_dict_additions,
-                                                                                 additional_controllers,
-                                                                                 validation_additional_feed_dict)
-                if schedule['fuses'] is not None:
-                    _ = self._on_fuses(train_batches,
-                                       schedule['fuses'],
-                                       training_step=step,
-                                       additional_feed_dict=valid_add_feed_dict)
-                for validation_dataset in train_specs['validation_datasets']:
-                    if schedule['example_length'] is not None:
-                        _ = self._prediction_examples(
-                            batch_generator_class,
-                            validation_dataset,
-                            schedule['example_length'],
-                            train_specs['valid_batch_kwargs'],
-                            training_step=step,
-                            additional_feed_dict=valid_add_feed_dict)
-            step += 1
-            storage['step'] = step
+                    if schedule['fuses'] is not None:
+                        _ = self._on_fuses(train_batches,
+                                           schedule['fuses'],
+                                           training_step=step,
+                                           additional_feed_dict=valid_add_feed_dict)
+                    for validation_dataset in train_specs['validation_datasets']:
+                        if schedule['example_length'] is not None:
+                            _ = self._prediction_examples(
+                                batch_generator_class,
+                                validation_dataset,
+                                schedule['example_length'],
+                                train_specs['valid_batch_kwargs'],
+                                training_step=step,
+                                additional_feed_dict=valid_add_feed_dict)
+                step += 1
+                storage['step'] = step
+        finally:
+            self._close_prefetching_batch_generators('train', [train_batches])
         return step
 
     def train(
@@ -1265,8 +1561,20 @@ class Environment(object):
                     construction for training (any of batch generator parameters can be provided as key word args
                     separately if their processing is described in _process_batch_kwargs_shortcut method. Now it is only
                     'vocabulary' and 'num_unrollings')
+                prefetch_batches: if not None train batches are generated in background thread and put into queue of
+                    size prefetch_batches. Queue statistics are available through get_prefetch_stats method
                 checkpoint_steps: list of steps on which checpoints should be created
                 debug: step on which tfdbg should be activated. Default is None
+                abort: if not None launch is aborted when collected train results diverge. True or dictionary with
+                    entries (all optional)
+                        type: str 'divergence_detector'
+                        result_type: monitored result type. Default is 'loss'
+                        check_nan: abort on nan or inf. Default is True
+                        maximize: if True larger values of result are better. Default is True for accuracy and
+                            False for other result types
+                        threshold: abort if result exceeds threshold (falls below threshold if maximize)
+                        window: abort if result did not improve by min_delta (default 0) during window collected
+                            values
                 validation_dataset_names: list of dataset names used for validation (datasets have to provided to
                     Environment instance separately. Now only through constructor
                 validation_dataset_texts: list of texts (type str) used for validation
@@ -1321,15 +1629,43 @@ class Environment(object):
                                 session_specs['log_device_placement'],
                                 session_specs['gpu_memory'],
                                 session_specs['allow_growth'],
-                                session_specs['visible_device_list'])
+                                session_specs['visible_device_list'],
+                            num_threads=session_specs.get('num_threads'))
         self._train_repeatedly(start_specs, run_specs_set)
         if close_session:
             self._close_session()
 
+    def _abort_launch(self, step, reason):
+        """Marks current launch as aborted in storage. Aborted launch is not continued by following run specs"""
+        self.set_in_storage(aborted=dict(step=step, reason=reason))
+        self._handler.log_abort(step, reason)
+
+    def launch_is_aborted(self):
+        return 'aborted' in self._current_place_for_result_saving
+
+    def _form_initialization_feed_dict(self, additions_to_feed_dict):
+        """Values of hooks listed in _initialization_hooks (e.g. init_parameter) provided in additions_to_feed_dict are
+        fed whenever pupil or optimizer variables are initialized so init parameters can be varied in grid search
+        without graph rebuilding. Values are either Controller specifications or plain values"""
+        feed_dict = dict()
+        if additions_to_feed_dict is None:
+            return feed_dict
+        for addition in additions_to_feed_dict:
+            if addition['placeholder'] in self._initialization_hooks and addition['placeholder'] in self._hooks:
+                value = addition['value']
+                if isinstance(value, dict):
+                    value = Controller(self._current_place_for_result_saving, value).get()
+                feed_dict[self._hooks[addition['placeholder']]] = value
+        return feed_dict
+
     def _train_repeatedly(self, start_specs, run_specs_set):
         # initializing model
         self.flush_storage()
-        self._session.run(tf.global_variables_initializer())
+        self._prefetch_stats = dict()
+        self._session.run(
+            tf.global_variables_initializer(),
+            feed_dict=self._form_initialization_feed_dict(run_specs_set[0]['train_specs']['additions_to_feed_dict'])
+        )
         self._restore_pupil(start_specs['restore_path'])
         if start_specs['with_meta_optimizer']:
             self._restore_meta_optimizer(start_specs['meta_optimizer_restore_path'])
@@ -1345,7 +1681,8 @@ class Environment(object):
                                 summary=start_specs['summary'],
                                 add_graph_to_summary=start_specs['add_graph_to_summary'],
                                 batch_generator_class=start_specs['batch_generator_class'],
-                                vocabulary=start_specs['vocabulary'])
+                                vocabulary=start_specs['vocabulary'],
+                                use_results_store=start_specs['use_results_store'])
         self._handler.log_launch()
         if start_specs['save_path'] is not None:
             checkpoints_path = start_specs['save_path'] + '/checkpoints'
@@ -1359,6 +1696,8 @@ class Environment(object):
                                     start_specs['batch_generator_class'],
                                     start_specs['with_meta_optimizer'],
                                     init_step=init_step)
+            if self.launch_is_aborted():
+                break
         if checkpoints_path is not None:
             self._create_checkpoint('final', checkpoints_path)
         self._handler.log_finish_time()
@@ -1392,20 +1731,32 @@ class Environment(object):
         # print("(Environment.train_optimizer)run_specs_set[0]['optimizer_inference']['valid_batch_kwargs']:",
         #       run_specs_set[0]['optimizer_inference']['valid_batch_kwargs'])
 
-        if start_session:
-            self._start_session(session_specs['allow_soft_placement'],
-                                session_specs['log_device_placement'],
-                                session_specs['gpu_memory'],
-                                session_specs['allow_growth'],
-                                session_specs['visible_device_list'])
-        self._train_optimizer_repeatedly(start_specs, run_specs_set)
+        num_opt_inf_workers = self._get_num_opt_inf_workers([run_specs_set])
+        if start_session and num_opt_inf_workers is not None:
+            # workers are forked before session is created because forking process with running session is unsafe
+            self._start_optimizer_inference_workers(num_opt_inf_workers, keep=True)
+        try:
+            if start_session:
+                self._start_session(session_specs['allow_soft_placement'],
+                                    session_specs['log_device_placement'],
+                                    session_specs['gpu_memory'],
+                                    session_specs['allow_growth'],
+                                    session_specs['visible_device_list'],
+                                    num_threads=session_specs.get('num_threads'))
+            self._train_optimizer_repeatedly(start_specs, run_specs_set)
+        finally:
+            self._stop_optimizer_inference_workers()
         if close_session:
             self._close_session()
 
     def _train_optimizer_repeatedly(self, start_specs, run_specs_set, log=True):
         # initializing model
         self.flush_storage()
-        self._session.run(tf.global_variables_initializer())
+        self._prefetch_stats = dict()
+        self._session.run(
+            tf.global_variables_initializer(),
+            feed_dict=self._form_initialization_feed_dict(run_specs_set[0]['train_specs']['additions_to_feed_dict'])
+        )
         self._restore_meta_optimizer(start_specs['restore_optimizer_path'])
         processing_type = 'train_meta_optimizer'
 
@@ -1417,7 +1768,13 @@ class Environment(object):
                                 summary=start_specs['summary'],
                                 add_graph_to_summary=start_specs['add_graph_to_summary'],
                                 batch_generator_class=start_specs['batch_generator_class'],
-                                vocabulary=start_specs['vocabulary'])
+                                vocabulary=start_specs['vocabulary'],
+                                use_results_store=start_specs['use_results_store'])
+        self._opt_inf_handler_specs = dict(
+            result_types=start_specs['result_types'],
+            batch_generator_class=start_specs['batch_generator_class'],
+            vocabulary=start_specs['vocabulary']
+        )
         if log:
             self._handler.log_launch()
         if start_specs['save_path'] is not None:
@@ -1440,13 +1797,86 @@ class Environment(object):
                 start_specs['result_types'],
                 init_step=init_step
             )
+            if self.launch_is_aborted():
+                break
+        if self._opt_inf_workers is not None and self._opt_inf_workers['keep']:
+            # workers started before session are stopped by method which started them
+            self._collect_optimizer_inference_results(block=True)
+        else:
+            self._stop_optimizer_inference_workers()
         if checkpoints_path is not None:
-            self._create_checkpoint('final', checkpoints_path)
+            self._create_checkpoint('final', checkpoints_path, model_type='meta_optimizer')
         self._handler.log_finish_time()
         self._handler.close()
 
+    @staticmethod
+    def _fill_feed_dict_from_multi_exercise_batch_gen(feed_dict, inp_placeholders, lbl_placeholders, b_gen):
+        # one next call provides batches for all exercises. If exercise placeholders are lists (one
+        # placeholder per optimizer unrolling) next is called once per unrolling
+        if isinstance(inp_placeholders[0], list):
+            num_calls = len(inp_placeholders[0])
+        else:
+            num_calls = 1
+        for call_idx in range(num_calls):
+            inputs, labels = b_gen.next()
+            for ex_idx, (inp_placeholder, lbl_placeholder) in enumerate(zip(inp_placeholders, lbl_placeholders)):
+                if isinstance(inp_placeholder, list):
+                    feed_dict[inp_placeholder[call_idx]] = inputs[ex_idx]
+                    feed_dict[lbl_placeholder[call_idx]] = labels[ex_idx]
+                else:
+                    feed_dict[inp_placeholder] = inputs[ex_idx]
+                    feed_dict[lbl_placeholder] = labels[ex_idx]
+
+    def _fill_stacked_exercise_placeholders(self, feed_dict, prefix, batch_gens, num_loop_unrollings=None):
+        """Used if optimizer is built with stacked_placeholders=True. Batches of all exercises and optimizer
+        unrollings are put into one array of shape [num_exercises, num_optimizer_unrollings, ...] which is split
+        among gpus along first dimension. If optimizer is built with unrolling_loop=True number of unrollings is
+        not fixed in placeholders and num_loop_unrollings is used"""
+        inp_placeholders = self._hooks['stacked_%s_inputs' % prefix]
+        lbl_placeholders = self._hooks['stacked_%s_labels' % prefix]
+        num_optimizer_unrollings = inp_placeholders[0].get_shape().as_list()[1]
+        if num_optimizer_unrollings is None:
+            if num_loop_unrollings is None:
+                num_optimizer_unrollings = self._hooks['num_optimizer_unrollings']
+            else:
+                num_optimizer_unrollings = num_loop_unrollings
+        if isinstance(batch_gens, MultiExerciseBatchGenerator):
+            batches = [batch_gens.next() for _ in range(num_optimizer_unrollings)]
+            inputs = np.stack([inp for inp, _ in batches], axis=1)
+            labels = np.stack([lbl for _, lbl in batches], axis=1)
+        else:
+            batches = [[b_gen.next() for _ in range(num_optimizer_unrollings)] for b_gen in batch_gens]
+            inputs = np.array([[inp for inp, _ in ex_batches] for ex_batches in batches])
+            labels = np.array([[lbl for _, lbl in ex_batches] for ex_batches in batches])
+        start = 0
+        for inp_placeholder, lbl_placeholder in zip(inp_placeholders, lbl_placeholders):
+            num_ex_on_gpu = inp_placeholder.get_shape().as_list()[0]
+            feed_dict[inp_placeholder] = inputs[start:start + num_ex_on_gpu]
+            feed_dict[lbl_placeholder] = labels[start:start + num_ex_on_gpu]
+            start += num_ex_on_gpu
+
     def _fill_train_meta_optimizer_feed_dict_with_inputs_and_labels(
-            self, feed_dict, pupil_grad_eval_batch_gens, optimizer_grad_batch_gens):
+            self, feed_dict, pupil_grad_eval_batch_gens, optimizer_grad_batch_gens, num_loop_unrollings=None):
+        if 'stacked_pupil_grad_eval_inputs' in self._hooks:
+            self._fill_stacked_exercise_placeholders(
+                feed_dict, 'pupil_grad_eval', pupil_grad_eval_batch_gens, num_loop_unrollings=num_loop_unrollings)
+            self._fill_stacked_exercise_placeholders(
+                feed_dict, 'optimizer_grad', optimizer_grad_batch_gens, num_loop_unrollings=num_loop_unrollings)
+            return feed_dict
+        if isinstance(pupil_grad_eval_batch_gens, MultiExerciseBatchGenerator):
+            self._fill_feed_dict_from_multi_exercise_batch_gen(
+                feed_dict,
+                self._hooks['pupil_grad_eval_inputs'],
+                self._hooks['pupil_grad_eval_labels'],
+                pupil_grad_eval_batch_gens
+            )
+            self._fill_feed_dict_from_multi_exercise_batch_gen(
+                feed_dict,
+                self._hooks['optimizer_grad_inputs'],
+                self._hooks['optimizer_grad_labels'],
+                optimizer_grad_batch_gens
+            )
+            return feed_dict
         for inp_placeholder, lbl_placeholder, b_gen in zip(
                 self._hooks['pupil_grad_eval_inputs'],
                 self._hooks['pupil_grad_eval_labels'],
@@ -1477,6 +1907,22 @@ class Environment(object):
                 feed_dict[lbl_placeholder] = lbl
         return feed_dict
 
+    def _create_multi_exercise_batch_sources(
+            self,
+            num_exercises,
+            datasets,
+            batch_generator_class,
+            train_batch_kwargs
+    ):
+        """Token ids of datasets are computed once. Returned sources are used for pupil gradient evaluation and
+        optimizer gradient computation respectively"""
+        tb_kwargs = self._build_batch_kwargs(train_batch_kwargs)
+        dataset_batch_gens = [batch_generator_class(dataset[0], 1, **tb_kwargs) for dataset in datasets]
+        pupil_grad_eval_source = MultiExerciseBatchGenerator(
+            dataset_batch_gens, num_exercises, num_unrollings=tb_kwargs.get('num_unrollings', 1))
+        optimizer_grad_source = pupil_grad_eval_source.fork()
+        return pupil_grad_eval_source, optimizer_grad_source
+
     def _reset_exercises(
             self,
             num_exercises,
@@ -1487,8 +1933,18 @@ class Environment(object):
             batch_gen_init_is_random,
             train_batch_kwargs,
             restore_paths_datasets_map,
-            random_=True
+            random_=True,
+            prefetch_batches=None,
+            batch_sources=None,
+            checkpoint_cache=None,
+            initialization_feed_dict=None
     ):
+        """If batch_sources (pair of MultiExerciseBatchGenerator instances) is provided, batch generators are not
+        created. Cursors of batch_sources are reassigned instead and batch_sources are returned. prefetch_batches
+        can not be used with batch_sources.
+        If checkpoint_cache (PupilCheckpointCache instance) is provided, pupil variables are assigned from
+        checkpoint values kept in memory in one session.run call instead of saver.restore calls.
+        initialization_feed_dict is fed when pupils without restore path are initialized"""
         # print("EXERCISES RESET!")
         # print('(Environment._reset_exercises)restore_paths_datasets_map:', restore_paths_datasets_map)
         num_paths = len(pupil_restore_paths)
@@ -1518,13 +1974,30 @@ class Environment(object):
         # print("(Environment._reset_exercises)tb_kwargs:", tb_kwargs)
         # print("(Environment._reset_exercises)restore_paths_datasets_map:", restore_paths_datasets_map)
         # print("(Environment._reset_exercises)datasets:", datasets)
+        if batch_sources is not None and prefetch_batches is not None:
+            raise InvalidArgumentError(
+                'prefetch_batches can not be used together with batch_sources',
+                prefetch_batches,
+                'prefetch_batches',
+                'None if batch_sources are provided'
+            )
+        restore_ops = list()
+        restore_feed_dict = dict()
         for idx, (saver, pupil_trainable_initializer, path) in enumerate(
                 zip(self._hooks['pupil_savers'], self._hooks['pupil_trainable_initializers'], paths)):
             if path is None:
-                self._session.run(pupil_trainable_initializer)
+                self._session.run(pupil_trainable_initializer, feed_dict=initialization_feed_dict)
+            elif checkpoint_cache is not None:
+                placeholders = self._hooks['pupil_restore_placeholders'][idx]
+                values = checkpoint_cache.get(path, list(placeholders.keys()))
+                for name, placeholder in placeholders.items():
+                    restore_feed_dict[placeholder] = values[name]
+                restore_ops.append(self._hooks['pupil_restore_ops'][idx])
             else:
                 # print("(Environmet._reset_exercises)path:", path)
                 saver.restore(self._session, path)
+            if batch_sources is not None:
+                continue
             # print("(Environment._reset_exercises)restore_paths_datasets_map:", restore_paths_datasets_map)
             # print("(Environment._reset_exercises)idx:", idx)
             pupil_grad_eval_batch_gens.append(batch_generator_class(
@@ -1547,6 +2020,24 @@ class Environment(object):
         #     len(self._hooks['pupil_trainable_initializers'])
         # )
         # print("(Environment._reset_exercises)len(self._hooks['pupil_savers']):", len(self._hooks['pupil_savers']))
+        if len(restore_ops) > 0:
+            self._session.run(restore_ops, feed_dict=restore_feed_dict)
+        if batch_sources is not None:
+            num_unrollings = tb_kwargs.get('num_unrollings', None)
+            dataset_map = restore_paths_datasets_map[:len(paths)]
+            for source in batch_sources:
+                source.reset(
+                    batch_size,
+                    dataset_map,
+                    random_batch_initiation=batch_gen_init_is_random,
+                    num_unrollings=num_unrollings
+                )
+            pupil_grad_eval_batch_gens, optimizer_grad_batch_gens = batch_sources
+        elif prefetch_batches is not None:
+            pupil_grad_eval_batch_gens = [
+                PrefetchingBatchGenerator(b_gen, queue_size=prefetch_batches) for b_gen in pupil_grad_eval_batch_gens]
+            optimizer_grad_batch_gens = [
+                PrefetchingBatchGenerator(b_gen, queue_size=prefetch_batches) for b_gen in optimizer_grad_batch_gens]
         self._session.run(self._hooks['reset_permutation_matrices'])
         self._session.run(self._hooks['reset_optimizer_train_state'])
         self._session.run(self._hooks['reset_pupil_grad_eval_pupil_storage'])
@@ -1572,6 +2063,7 @@ class Environment(object):
             train_dataset=train_dataset,
             batch_size=train_specs['batch_size'],
             train_batch_kwargs=train_specs['train_batch_kwargs'],
+            prefetch_batches=train_specs['prefetch_batches'],
             checkpoint_steps=None,
             debug=None,
             validation_datasets=[validation_dataset],
@@ -1671,6 +2163,165 @@ class Environment(object):
         self._handler.set_meta_optimizer_inference_flags(False, False)
         self._current_place_for_result_saving = old_place_for_saving
 
+    def _optimizer_inference_worker(self, task_queue, result_queue):
+        """Target of optimizer inference worker processes. Workers are usually forked before session of parent
+        process is created. Graph is rebuilt and new session is started. Handler is created for every task from
+        handler specs provided with a task because handler of parent process may be not created yet. Handler of
+        worker has no save_path: results are sent to parent through result queue and written by parent handler.
+        Meta optimizer weights are restored from checkpoint provided with a task"""
+        tf.reset_default_graph()
+        self._hooks = dict()
+        self._build_pupil(self.current_pupil_build_parameters)
+        self.build_optimizer(**self.current_optimizer_build_parameters)
+        self._session = None
+        self._start_session(True, False, None, True, '')
+        initializer = tf.global_variables_initializer()
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            task_id, optimizer_path, handler_specs, launch_args = task
+            train_specs, optimizer_inference, schedule = launch_args[:3]
+            try:
+                self._handler = Handler(self, self._hooks, 'train_meta_optimizer', None, **handler_specs)
+                self._set_handler_optimizer_train_schedule(schedule, optimizer_inference)
+                self._session.run(
+                    initializer,
+                    feed_dict=self._form_initialization_feed_dict(train_specs['additions_to_feed_dict'])
+                )
+                self._restore_meta_optimizer(optimizer_path)
+                storage = dict()
+                self._launch_optimizer_inference(*launch_args, storage=storage)
+                self._handler.close()
+                result_queue.put((task_id, storage))
+            except Exception:
+                # traceback is passed to parent process and raised there. Exception object may be not picklable
+                result_queue.put((task_id, traceback.format_exc()))
+        self._session.close()
+
+    @staticmethod
+    def _get_num_opt_inf_workers(run_specs_sets):
+        """Returns the largest opt_inf_num_workers in run specs or None if inference is not done in background"""
+        nums = list()
+        for run_specs_set in run_specs_sets:
+            for run_specs in run_specs_set:
+                optimizer_inference = run_specs.get('optimizer_inference')
+                if optimizer_inference is not None and optimizer_inference.get('opt_inf_num_workers') is not None:
+                    nums.append(optimizer_inference['opt_inf_num_workers'])
+        if len(nums) == 0:
+            return None
+        return max(nums)
+
+    def _start_optimizer_inference_workers(self, num_workers, keep=False):
+        """Workers should be started before session is created: forked child of process with running TensorFlow
+        session can deadlock on locks held by session threads. If keep is True workers are not stopped at the end
+        of _train_optimizer_repeatedly and have to be stopped by caller"""
+        if self._session is not None:
+            print('(Environment._start_optimizer_inference_workers)WARNING: optimizer inference workers are forked '
+                  'from process with running session')
+        self._opt_inf_workers = dict(
+            tmp_dir=tempfile.mkdtemp(prefix='opt_inf_'),
+            task_queue=mp.Queue(),
+            result_queue=mp.Queue(),
+            processes=list(),
+            pending=dict(),
+            task_counter=0,
+            keep=keep
+        )
+        for _ in range(num_workers):
+            p = mp.Process(
+                target=self._optimizer_inference_worker,
+                args=(self._opt_inf_workers['task_queue'], self._opt_inf_workers['result_queue'])
+            )
+            p.start()
+            self._opt_inf_workers['processes'].append(p)
+
+    def _submit_optimizer_inference_tasks(
+            self,
+            train_specs,
+            optimizer_inference,
+            schedule,
+            optimizer_training_step,
+            batch_generator_class,
+            result_types
+    ):
+        """Current meta optimizer weights are saved into temporary checkpoint which is restored by workers. Storages
+        for results are put into self._current_place_for_result_saving immediately to keep results order and
+        filled when results are collected"""
+        workers = self._opt_inf_workers
+        optimizer_path = os.path.join(workers['tmp_dir'], str(optimizer_training_step))
+        self._hooks['meta_optimizer_saver'].save(self._session, optimizer_path)
+        for idx, (pupil_name, path) in enumerate(optimizer_inference['opt_inf_pupil_restore_paths']):
+            storage = dict()
+            self._current_place_for_result_saving[pupil_name]['results'].append(storage)
+            task_id = workers['task_counter']
+            workers['task_counter'] += 1
+            workers['pending'][task_id] = (storage, pupil_name, optimizer_training_step)
+            launch_args = (
+                train_specs,
+                optimizer_inference,
+                schedule,
+                idx,
+                pupil_name,
+                path,
+                optimizer_training_step,
+                batch_generator_class,
+                result_types
+            )
+            workers['task_queue'].put((task_id, optimizer_path, self._opt_inf_handler_specs, launch_args))
+
+    def _collect_optimizer_inference_results(self, block=False):
+        """Merges results of finished optimizer inference tasks into storage. If block is True waits for all
+        submitted tasks"""
+        workers = self._opt_inf_workers
+        if workers is None:
+            return
+        while len(workers['pending']) > 0:
+            try:
+                task_id, result = workers['result_queue'].get(block=block)
+            except queue.Empty:
+                break
+            storage, pupil_name, optimizer_training_step = workers['pending'].pop(task_id)
+            if isinstance(result, str):
+                raise WorkerError('optimizer inference task %s failed in worker process:\n%s' % (task_id, result))
+            storage.update(result)
+            self._handler.save_optimizer_inference_results(pupil_name, optimizer_training_step, result)
+
+    def _stop_optimizer_inference_workers(self):
+        workers = self._opt_inf_workers
+        if workers is None:
+            return
+        try:
+            self._collect_optimizer_inference_results(block=True)
+        except Exception:
+            for p in workers['processes']:
+                p.terminate()
+            shutil.rmtree(workers['tmp_dir'], ignore_errors=True)
+            self._opt_inf_workers = None
+            raise
+        for _ in workers['processes']:
+            workers['task_queue'].put(None)
+        for p in workers['processes']:
+            p.join()
+        shutil.rmtree(workers['tmp_dir'], ignore_errors=True)
+        self._opt_inf_workers = None
+
+    def _set_handler_optimizer_train_schedule(self, schedule, optimizer_inference):
+        if optimizer_inference['opt_inf_pupil_restore_paths'] is None:
+            opt_if_pupil_names = None
+        else:
+            opt_if_pupil_names = nth_element_of_sequence_of_sequences(
+                optimizer_inference['opt_inf_pupil_restore_paths'],
+                0
+            )
+        self._handler.set_optimizer_train_schedule(
+            schedule,
+            opt_inf_pupil_names=opt_if_pupil_names,
+            opt_inf_to_be_collected_while_training=optimizer_inference['opt_inf_to_be_collected_while_training'],
+            opt_inf_train_tensor_schedule=optimizer_inference['opt_inf_train_tensor_schedule'],
+            opt_inf_validation_tensor_schedule=optimizer_inference['opt_inf_validation_tensor_schedule']
+        )
+
     def _train_optimizer(
             self,
             run_specs,
@@ -1705,6 +2356,17 @@ class Environment(object):
         if train_specs['stop']['type'] == 'limit_steps':
             train_specs['stop']['limit'] += init_step
         should_continue = Controller(self._current_place_for_result_saving, train_specs['stop'])
+        abort_specs = train_specs['abort']
+        if abort_specs is not None:
+            # specs passed by user are not changed
+            abort_specs = dict(abort_specs)
+            result_type = abort_specs.get('result_type', 'loss')
+            # meta optimizer train results are collected for pupil before and after optimizer unrollings
+            if result_type not in self._current_place_for_result_saving['train']:
+                abort_specs['result_type'] = 'end_' + result_type
+            should_abort = Controller(self._current_place_for_result_saving, abort_specs)
+        else:
+            should_abort = Controller(self._current_place_for_result_saving, {'type': 'always_false'})
 
         to_be_collected_while_training = schedule['to_be_collected_while_training']
         collect_interval = to_be_collected_while_training['results_collect_interval']
@@ -1763,24 +2425,40 @@ class Environment(object):
         controllers_for_printing.extend(additional_controllers)
 
         # print("(Environment._train_optimizer)optimizer_inference:", optimizer_inference)
-        if optimizer_inference['opt_inf_pupil_restore_paths'] is None:
-            opt_if_pupil_names = None
-        else:
-            opt_if_pupil_names = nth_element_of_sequence_of_sequences(
-                optimizer_inference['opt_inf_pupil_restore_paths'],
-                0
-            )
-        self._handler.set_optimizer_train_schedule(
-            schedule,
-            opt_inf_pupil_names=opt_if_pupil_names,
-            opt_inf_to_be_collected_while_training=optimizer_inference['opt_inf_to_be_collected_while_training'],
-            opt_inf_train_tensor_schedule=optimizer_inference['opt_inf_train_tensor_schedule'],
-            opt_inf_validation_tensor_schedule=optimizer_inference['opt_inf_validation_tensor_schedule']
-        )
+        self._set_handler_optimizer_train_schedule(schedule, optimizer_inference)
 
         self._handler.set_controllers(controllers_for_printing)
         # print("(Environment._train_optimizer)train_specs['train_datasets']:", train_specs['train_datasets'])
         # print("(Environment._train_optimizer)train_specs['num_exercises']:", train_specs['num_exercises'])
+        if train_specs['one_batch_source']:
+            if train_specs['prefetch_batches'] is not None:
+                # cursors of batch sources are reassigned on exercise reset so prefetched batches would be stale
+                raise InvalidArgumentError(
+                    'prefetch_batches can not be used together with one_batch_source',
+                    train_specs['prefetch_batches'],
+                    'prefetch_batches',
+                    'None if one_batch_source is True'
+                )
+            batch_sources = self._create_multi_exercise_batch_sources(
+                train_specs['num_exercises'],
+                train_specs['train_datasets'],
+                batch_generator_class,
+                train_batch_kwargs
+            )
+        else:
+            batch_sources = None
+        if train_specs['use_pupil_checkpoint_cache']:
+            if self._hooks.get('pupil_restore_ops') is None:
+                raise InvalidArgumentError(
+                    'Pupil checkpoint cache requires optimizer built with pupil_checkpoint_cache=True',
+                    train_specs['use_pupil_checkpoint_cache'],
+                    'use_pupil_checkpoint_cache',
+                    'False if optimizer is built without pupil_checkpoint_cache'
+                )
+            checkpoint_cache = PupilCheckpointCache(max_bytes=train_specs['pupil_checkpoint_cache_max_bytes'])
+        else:
+            checkpoint_cache = None
+        initialization_feed_dict = self._form_initialization_feed_dict(train_specs['additions_to_feed_dict'])
         pupil_grad_eval_batch_gens, optimizer_grad_batch_gens = self._reset_exercises(
             train_specs['num_exercises'],
             train_specs['pupil_restore_paths'],
@@ -1790,7 +2468,11 @@ class Environment(object):
             train_specs['batch_gen_init_is_random'],
             train_batch_kwargs,
             train_specs['restore_paths_datasets_map'],
-            random_=False
+            random_=False,
+            prefetch_batches=train_specs['prefetch_batches'],
+            batch_sources=batch_sources,
+            checkpoint_cache=checkpoint_cache,
+            initialization_feed_dict=initialization_feed_dict
         )
         feed_dict = dict()
         while should_continue.get():
@@ -1799,10 +2481,11 @@ class Environment(object):
                 self._session.add_tensor_filter("has_inf_or_nan", tf_debug.has_inf_or_nan)
 
             if it_is_time_to_create_checkpoint.get():
-                self._create_checkpoint(step, checkpoints_path)
+                self._create_checkpoint(step, checkpoints_path, model_type='meta_optimizer')
 
             feed_dict = self._fill_train_meta_optimizer_feed_dict_with_inputs_and_labels(
-                feed_dict, pupil_grad_eval_batch_gens, optimizer_grad_batch_gens)
+                feed_dict, pupil_grad_eval_batch_gens, optimizer_grad_batch_gens,
+                num_loop_unrollings=train_specs['num_loop_unrollings'])
 
             learning_rate = learning_rate_controller.get()
             feed_dict[self._hooks['learning_rate_for_optimizer_training']] = learning_rate
@@ -1813,26 +2496,46 @@ class Environment(object):
             # print('train_operations:', train_operations)
             # print('feed_dict:', feed_dict)
             # print("(Environment._train_optimizer)feed_dict:", feed_dict)
-            train_res = self._session.run(train_operations, feed_dict=feed_dict)
+            train_res = self._run_fetches(train_operations, feed_dict)
             # here loss is given in bits per input (BPI)
 
             self._handler.process_results(step, train_res, regime='train_meta_optimizer')
+            self._collect_optimizer_inference_results()
+            abort_reason = should_abort.get()
+            if abort_reason:
+                self._abort_launch(step, abort_reason)
+                break
             if it_is_time_for_opt_inf.get():
-                for idx, (pupil_name, path) in enumerate(optimizer_inference['opt_inf_pupil_restore_paths']):
-                    self._launch_optimizer_inference(
+                if optimizer_inference['opt_inf_num_workers'] is not None:
+                    if self._opt_inf_workers is None:
+                        self._start_optimizer_inference_workers(optimizer_inference['opt_inf_num_workers'])
+                    self._submit_optimizer_inference_tasks(
                         train_specs,
                         optimizer_inference,
                         schedule,
-                        idx,
-                        pupil_name,
-                        path,
                         step,
                         batch_generator_class,
                         result_types
                     )
+                else:
+                    for idx, (pupil_name, path) in enumerate(optimizer_inference['opt_inf_pupil_restore_paths']):
+                        self._launch_optimizer_inference(
+                            train_specs,
+                            optimizer_inference,
+                            schedule,
+                            idx,
+                            pupil_name,
+                            path,
+                            step,
+                            batch_generator_class,
+                            result_types
+                        )
 
             step += 1
             if it_is_time_to_reset_exercises.get():
+                if batch_sources is None:
+                    self._close_prefetching_batch_generators(
+                        'exercises', pupil_grad_eval_batch_gens + optimizer_grad_batch_gens)
                 pupil_grad_eval_batch_gens, optimizer_grad_batch_gens = self._reset_exercises(
                     train_specs['num_exercises'],
                     train_specs['pupil_restore_paths'],
@@ -1841,9 +2544,17 @@ class Environment(object):
                     batch_size_controller,
                     train_specs['batch_gen_init_is_random'],
                     train_batch_kwargs,
-                    train_specs['restore_paths_datasets_map']
+                    train_specs['restore_paths_datasets_map'],
+                    prefetch_batches=train_specs['prefetch_batches'],
+                    batch_sources=batch_sources,
+                    checkpoint_cache=checkpoint_cache,
+                    initialization_feed_dict=initialization_feed_dict
                 )
             self.set_in_storage(step=step)
+        if batch_sources is None:
+            self._close_prefetching_batch_generators(
+                'exercises', pupil_grad_eval_batch_gens + optimizer_grad_batch_gens)
+        self._collect_optimizer_inference_results(block=True)
         return step
 
     def _several_launches_without_rebuilding(self,
@@ -1859,7 +2570,8 @@ class Environment(object):
                             session_specs['log_device_placement'],
                             session_specs['gpu_memory'],
                             session_specs['allow_growth'],
-                            session_specs['visible_device_list'])
+                            session_specs['visible_device_list'],
+                            num_threads=session_specs.get('num_threads'))
         datasets = dict(evaluation['datasets'])
         if 'train' in datasets:
             del datasets['train']
@@ -1872,6 +2584,11 @@ class Environment(object):
         for start_specs, run_specs_set in args_for_launches:
             result = dict()
             self._train_repeatedly(start_specs, run_specs_set)
+            if self.launch_is_aborted():
+                # diverged model is not evaluated
+                result['aborted'] = self._current_place_for_result_saving['aborted']
+                queue_.put(result)
+                continue
             if 'train' in evaluation['datasets']:
                 tr_res = dict()
                 for key, res in self._storage['train'].items():
@@ -1911,58 +2628,224 @@ class Environment(object):
     ):
         self._build_pupil(pupil_build_kwargs)
         self.build_optimizer(**optimizer_build_kwargs)
+        num_opt_inf_workers = self._get_num_opt_inf_workers(
+            [run_specs_set for _, run_specs_set in args_for_launches])
+        if num_opt_inf_workers is not None:
+            self._start_optimizer_inference_workers(num_opt_inf_workers, keep=True)
         self._start_session(session_specs['allow_soft_placement'],
                             session_specs['log_device_placement'],
                             session_specs['gpu_memory'],
                             session_specs['allow_growth'],
-                            session_specs['visible_device_list'])
-        for hp_comb, (start_specs, run_specs_set) in zip(hp_combs, args_for_launches):
-            self._handler.print_hyper_parameters(hp_comb, order)
-
-            result_types = start_specs['result_types']
-            self._train_optimizer_repeatedly(start_specs, run_specs_set, log=False)
-            pupil_names = nth_element_of_sequence_of_sequences(
-                evaluation['opt_inf_pupil_restore_paths'],
-                0
-            )
-            self._handler.set_optimizer_train_schedule(
-                None,
-                opt_inf_pupil_names=pupil_names,
-                opt_inf_to_be_collected_while_training=evaluation['opt_inf_to_be_collected_while_training']
-            )
-            result = dict()
-            # print("(Environment._several_optimizer_launches_without_rebuilding)pupil_names:", pupil_names)
-            for idx, name in enumerate(pupil_names):
-                train_dataset_name = evaluation['opt_inf_train_datasets'][idx][1]
-                # duplicates validation storage setting in Handler.set_new_run_schedule
-                if evaluation['opt_inf_validation_datasets'] is not None:
-                    validation_dataset_name = 'validation'
-                else:
-                    validation_dataset_name = None
-                dataset_names = ['train']
-                if validation_dataset_name is not None:
-                    dataset_names.append(validation_dataset_name)
-                result[name] = self.create_train_pupil_storage(
-                    dict(), result_types, dataset_names
+                            session_specs['visible_device_list'],
+                            num_threads=session_specs.get('num_threads'))
+        try:
+            for hp_comb, (start_specs, run_specs_set) in zip(hp_combs, args_for_launches):
+                self._handler.print_hyper_parameters(hp_comb, order)
+
+                result_types = start_specs['result_types']
+                self._train_optimizer_repeatedly(start_specs, run_specs_set, log=False)
+                pupil_names = nth_element_of_sequence_of_sequences(
+                    evaluation['opt_inf_pupil_restore_paths'],
+                    0
                 )
+                self._handler.set_optimizer_train_schedule(
+                    None,
+                    opt_inf_pupil_names=pupil_names,
+                    opt_inf_to_be_collected_while_training=evaluation['opt_inf_to_be_collected_while_training']
+                )
+                result = dict()
+                # print("(Environment._several_optimizer_launches_without_rebuilding)pupil_names:", pupil_names)
+                for idx, name in enumerate(pupil_names):
+                    train_dataset_name = evaluation['opt_inf_train_datasets'][idx][1]
+                    # duplicates validation storage setting in Handler.set_new_run_schedule
+                    if evaluation['opt_inf_validation_datasets'] is not None:
+                        validation_dataset_name = 'validation'
+                    else:
+                        validation_dataset_name = None
+                    dataset_names = ['train']
+                    if validation_dataset_name is not None:
+                        dataset_names.append(validation_dataset_name)
+                    result[name] = self.create_train_pupil_storage(
+                        dict(), result_types, dataset_names
+                    )
 
-            old_place_for_saving = self._current_place_for_result_saving
-            self._current_place_for_result_saving = result
-            for idx, (pupil_name, pupil_path) in enumerate(evaluation['opt_inf_pupil_restore_paths']):
-                self._launch_optimizer_inference(
-                    run_specs_set[0]['train_specs'],
-                    evaluation,
-                    run_specs_set[0]['schedule'],
-                    idx,
-                    pupil_name,
-                    pupil_path,
-                    0,
-                    start_specs['batch_generator_class'],
-                    result_types,
-                    storage=result[pupil_name]
+                if self.launch_is_aborted():
+                    # optimizer inference is skipped. Pupil storages are left empty
+                    result['aborted'] = self._current_place_for_result_saving['aborted']
+                    queue_.put(result)
+                    continue
+                old_place_for_saving = self._current_place_for_result_saving
+                self._current_place_for_result_saving = result
+                for idx, (pupil_name, pupil_path) in enumerate(evaluation['opt_inf_pupil_restore_paths']):
+                    self._launch_optimizer_inference(
+                        run_specs_set[0]['train_specs'],
+                        evaluation,
+                        run_specs_set[0]['schedule'],
+                        idx,
+                        pupil_name,
+                        pupil_path,
+                        0,
+                        start_specs['batch_generator_class'],
+                        result_types,
+                        storage=result[pupil_name]
+                    )
+                self._current_place_for_result_saving = old_place_for_saving
+                queue_.put(result)
+        finally:
+            self._stop_optimizer_inference_workers()
+
+    def _select_launches(self, hp_combs, parsed, skip_completed, launched_hp_comb_hashes=None):
+        """Removes launches which hyperparameter combinations are recorded in grid search index of handler (if
+        skip_completed is True) and launches which hyperparameter combination hashes are not in
+        launched_hp_comb_hashes (if it is not None)"""
+        left_hp_combs = list()
+        left_parsed = list()
+        num_completed = 0
+        for hp_comb, launch_args in zip(hp_combs, parsed):
+            if hp_comb is not None:
+                if skip_completed and self._handler.hp_comb_is_completed(hp_comb):
+                    num_completed += 1
+                    continue
+                if launched_hp_comb_hashes is not None \
+                        and self._handler.get_hp_comb_hash(hp_comb) not in launched_hp_comb_hashes:
+                    continue
+            left_hp_combs.append(hp_comb)
+            left_parsed.append(launch_args)
+        if num_completed > 0:
+            print('%s hyperparameter combinations are skipped because they are recorded in grid search index as '
+                  'completed (skip_completed=True)' % num_completed)
+        num_not_proposed = len(hp_combs) - len(left_hp_combs) - num_completed
+        if num_not_proposed > 0:
+            print('%s hyperparameter combinations are not in launched_hp_comb_hashes' % num_not_proposed)
+        return left_hp_combs, left_parsed
+
+    def _grid_search_worker(self, session_specs, cpus, task_queue, result_queue):
+        """Target of grid search worker processes. Worker takes build combinations from task_queue until None is
+        received. For every task graph is rebuilt and launch method puts results tagged by _TaskResultQueue"""
+        if cpus is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        # session of parent process can not be used after fork
+        self._session = None
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            task_id, method_name, kwargs = task
+            tf.reset_default_graph()
+            # hooks, models and callables of previous task belong to its graph. Hooks added by launch methods (e.g.
+            # stacked_* and batched_validation_*) would otherwise leak into next task
+            self._hooks = dict()
+            self._pupil = None
+            self._meta_optimizer = None
+            self._pupil_graph_key = None
+            self._callables = dict()
+            if self._handler is not None:
+                # tensors cached by handler belong to graph of previous task
+                self._handler.reset_fetch_cache()
+            try:
+                getattr(self, method_name)(
+                    _TaskResultQueue(result_queue, task_id), session_specs=session_specs, **kwargs)
+            except Exception:
+                # traceback is passed to parent process and raised there. Exception object may be not picklable
+                result_queue.put((task_id, None, traceback.format_exc()))
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _start_grid_search_workers(
+            self,
+            session_specs,
+            num_workers,
+            worker_visible_device_lists=None,
+            worker_num_threads=None,
+            worker_cpus=None
+    ):
+        """Forks num_workers processes. Worker i uses visible_device_list worker_visible_device_lists[i] and is
+        bound to cpus worker_cpus[i] if these lists are provided. If num_workers > 1 and worker_num_threads is None
+        cores are divided between workers equally"""
+        for value, name in [(worker_visible_device_lists, 'worker_visible_device_lists'),
+                            (worker_cpus, 'worker_cpus')]:
+            if value is not None and len(value) != num_workers:
+                raise InvalidArgumentError(
+                    '%s has to contain one entry per worker' % name,
+                    value,
+                    name,
+                    'list of length %s' % num_workers
                 )
-            self._current_place_for_result_saving = old_place_for_saving
-            queue_.put(result)
+        if worker_num_threads is None and num_workers > 1:
+            worker_num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self._grid_search_workers = dict(
+            task_queue=mp.Queue(),
+            result_queue=mp.Queue(),
+            processes=list(),
+            pending=dict(),
+            task_counter=0
+        )
+        for worker_idx in range(num_workers):
+            worker_session_specs = construct(session_specs)
+            if worker_visible_device_lists is not None:
+                worker_session_specs['visible_device_list'] = worker_visible_device_lists[worker_idx]
+            worker_session_specs['num_threads'] = worker_num_threads
+            cpus = None if worker_cpus is None else worker_cpus[worker_idx]
+            self.mp_debug_flag += 1
+            p = mp.Process(
+                target=self._grid_search_worker,
+                args=(
+                    worker_session_specs,
+                    cpus,
+                    self._grid_search_workers['task_queue'],
+                    self._grid_search_workers['result_queue']
+                )
+            )
+            p.start()
+            self._grid_search_workers['processes'].append(p)
+
+    def _submit_grid_search_task(self, method_name, kwargs, hp_combs, regime):
+        """kwargs are arguments of method method_name except queue and session_specs. hp_combs[i] is hyperparameter
+        combination of i-th result put by method. Results with hp combination None are not processed"""
+        workers = self._grid_search_workers
+        task_id = workers['task_counter']
+        workers['task_counter'] += 1
+        workers['pending'][task_id] = dict(hp_combs=hp_combs, regime=regime, num_received=0)
+        workers['task_queue'].put((task_id, method_name, kwargs))
+
+    def _collect_grid_search_results(self, block=False):
+        """Results are passed to handler in order of arrival. If block is True waits for all submitted tasks"""
+        workers = self._grid_search_workers
+        if workers is None:
+            return
+        while len(workers['pending']) > 0:
+            try:
+                task_id, launch_idx, result = workers['result_queue'].get(block=block)
+            except queue.Empty:
+                break
+            if launch_idx is None:
+                del workers['pending'][task_id]
+                raise WorkerError('grid search task %s failed in worker process:\n%s' % (task_id, result))
+            task = workers['pending'][task_id]
+            hp_comb = task['hp_combs'][launch_idx]
+            if hp_comb is not None:
+                self._handler.process_results(hp_comb, result, regime=task['regime'])
+            task['num_received'] += 1
+            if task['num_received'] == len(task['hp_combs']):
+                del workers['pending'][task_id]
+
+    def _stop_grid_search_workers(self):
+        workers = self._grid_search_workers
+        if workers is None:
+            return
+        try:
+            self._collect_grid_search_results(block=True)
+        except Exception:
+            for p in workers['processes']:
+                p.terminate()
+            self._grid_search_workers = None
+            raise
+        for _ in workers['processes']:
+            workers['task_queue'].put(None)
+        for p in workers['processes']:
+            p.join()
+        self._grid_search_workers = None
 
     @staticmethod
     def _check_hp_in_additional_feed_dict(additions, tensor_alias):
@@ -1990,13 +2873,27 @@ class Environment(object):
                     kwargs_for_building,
                     build_hyperparameters=None,
                     other_hyperparameters=None,
+                    num_workers=1,
+                    worker_visible_device_lists=None,
+                    worker_num_threads=None,
+                    worker_cpus=None,
+                    skip_completed=False,
                     **kwargs):
-        """build_hyperparameters and other_hyperparameters are provided in the following format
+        """Build hyperparameter combinations are put into queue and processed by num_workers persistent worker
+        processes. Results are passed to handler as soon as they are received. Worker i can be restricted to devices
+        worker_visible_device_lists[i] (visible_device_list session spec) and cpus worker_cpus[i]. worker_num_threads
+        is size of session thread pools in workers (by default cores are divided equally between workers).
+        Completed hyperparameter combinations are recorded in grid search index in evaluation save_path. If
+        skip_completed is True recorded combinations are not launched again so interrupted grid search can be resumed
+        by calling this method with the same arguments. Number of skipped combinations is printed.
+        build_hyperparameters and other_hyperparameters are provided in the following format
         build_hyperparameters and other_hyperparameters are a dictionaries which keys are kwargs for build or train
         Environment methods for corresponding hyper parameters and values are dictionaries of following format:
             hp_type ('build_hp', 'built-in', 'additional_placeholder', 'batch_kwarg')
                 can be omitted for build_hyperparameters and if omitted in other_hyperparameters it is set to
-                additional_placeholder
+                additional_placeholder. Build parameters init_parameter, regularization_rate of Lstm and
+                optimizer_init_parameter, optimizer_regularization_rate, clip_norm of ResNet4Lstm are placeholders
+                and can be varied as additional_placeholder other_hyperparameters without graph rebuilding
             list_indices
                 a list of indices of hp values if hp is a list (e.g. number of nodes by layers)
                 it can be an int if only 1 index is used
@@ -2041,6 +2938,7 @@ class Environment(object):
             kwargs_for_building=kwargs_for_building,
             build_hyperparameters=build_hyperparameters,
             other_hyperparameters=other_hyperparameters,
+            num_workers=num_workers,
             kwargs=kwargs)
         if build_hyperparameters is None:
             build_hyperparameters = dict()
@@ -2075,6 +2973,8 @@ class Environment(object):
                                 eval_dataset_names=list(evaluation['datasets'].keys()),
                                 hyperparameters=hps)
         self._handler.log_launch()
+        self._start_grid_search_workers(
+            session_specs, num_workers, worker_visible_device_lists, worker_num_threads, worker_cpus)
         # print('build_insertions:', build_insertions)
         # print('build_hp_combs:', build_hp_combs)
         if len(build_hp_combs) > 0:
@@ -2091,50 +2991,57 @@ class Environment(object):
                 # shared hyperparameters specified as build hps with share field. During build_hp postprocessing share
                 # is extracted. Share field applied later
                 parsed = configure_args_for_launches(self, args_for_launches, shares)
-                queue_ = mp.Queue()
                 # from some_useful_functions import nested2string
                 # print('build_kwargs:', nested2string(build_kwargs))
                 # print('parsed:', nested2string(parsed))
-                self.mp_debug_flag += 1
-                p = mp.Process(target=self._several_launches_without_rebuilding,
-                               args=(queue_, build_kwargs, session_specs, parsed, evaluation))
-                p.start()
+                hp_combs = list()
                 if len(other_hp_combs) > 0:
-                    for idx, other_hp_comb in enumerate(other_hp_combs):
+                    for other_hp_comb in other_hp_combs:
                         hp_combination = construct(build_hp_comb)
                         hp_combination.update(other_hp_comb)
-                        res = queue_.get()
-                        # print('\nidx: %s\nres: %s' % (idx, res))
-                        # print('hp_combination:', hp_combination)
-                        # print('res:', res)
-                        self._handler.process_results(hp_combination, res, regime='several_launches')
+                        hp_combs.append(hp_combination)
                 else:
-                    hp_combination = construct(build_hp_comb)
-                    res = queue_.get()
-                    self._handler.process_results(hp_combination, res, regime='several_launches')
-                p.join()
+                    hp_combs.append(construct(build_hp_comb))
+                hp_combs, parsed = self._select_launches(hp_combs, parsed, skip_completed)
+                if len(hp_combs) > 0:
+                    self._submit_grid_search_task(
+                        '_several_launches_without_rebuilding',
+                        dict(
+                            kwargs_for_building=build_kwargs,
+                            args_for_launches=parsed,
+                            evaluation=evaluation
+                        ),
+                        hp_combs,
+                        'several_launches'
+                    )
+                self._collect_grid_search_results()
         else:
             parsed = configure_args_for_launches(self, args_for_launches, list())
-            queue_ = mp.Queue()
             # from some_useful_functions import nested2string
             # print('build_kwargs:', nested2string(build_kwargs))
             # print('parsed:', nested2string(parsed))
-            self.mp_debug_flag += 1
-            p = mp.Process(target=self._several_launches_without_rebuilding,
-                           args=(queue, kwargs_for_building, session_specs, parsed, evaluation))
-            p.start()
+            hp_combs = list()
             if len(other_hp_combs) > 0:
-                for idx, other_hp_comb in enumerate(other_hp_combs):
+                for other_hp_comb in other_hp_combs:
                     hp_combination = OrderedDict()
                     hp_combination.update(other_hp_comb)
-                    res = queue_.get()
-                    # print('\nidx: %s\nres: %s' % (idx, res))
-                    # print('hp_combination:', hp_combination)
-                    # print('res:', res)
-                    self._handler.process_results(hp_combination, res, regime='several_launches')
+                    hp_combs.append(hp_combination)
             else:
-                pass
-            p.join()
+                # nothing is varied and result of the only launch is not processed
+                hp_combs.append(None)
+            hp_combs, parsed = self._select_launches(hp_combs, parsed, skip_completed)
+            if len(hp_combs) > 0:
+                self._submit_grid_search_task(
+                    '_several_launches_without_rebuilding',
+                    dict(
+                        kwargs_for_building=kwargs_for_building,
+                        args_for_launches=parsed,
+                        evaluation=evaluation
+                    ),
+                    hp_combs,
+                    'several_launches'
+                )
+        self._stop_grid_search_workers()
 
         self._handler.log_finish_time()
         self._handler.close()
@@ -2145,17 +3052,17 @@ class Environment(object):
             shares,
             pupil_build_kwargs,
             optimizer_build_kwargs,
-            session_specs,
             evaluation,
             other_hp_combs,
-            base_hp_comb
+            base_hp_comb,
+            skip_completed,
+            launched_hp_comb_hashes
     ):
+        """Puts one pupil and optimizer build combination into grid search workers queue"""
         parsed = configure_args_for_launches(self, args_for_launches, shares, model='meta_optimizer')
-        queue_ = mp.Queue()
         # from some_useful_functions import nested2string
         # print('build_kwargs:', nested2string(build_kwargs))
         # print('parsed:', nested2string(parsed))
-        self.mp_debug_flag += 1
 
         hp_combs = list()
         if len(other_hp_combs) > 0:
@@ -2166,46 +3073,24 @@ class Environment(object):
         else:
             hp_combination = construct(base_hp_comb)
             hp_combs.append(hp_combination)
+        hp_combs, parsed = self._select_launches(hp_combs, parsed, skip_completed, launched_hp_comb_hashes)
+        if len(hp_combs) == 0:
+            return
         order = self._handler.order
-        p = mp.Process(
-            target=self._several_optimizer_launches_without_rebuilding,
-            args=(
-                queue_,
-                pupil_build_kwargs,
-                optimizer_build_kwargs,
-                session_specs,
-                parsed,
-                evaluation,
-                hp_combs,
-                order
-            )
+        self._submit_grid_search_task(
+            '_several_optimizer_launches_without_rebuilding',
+            dict(
+                pupil_build_kwargs=pupil_build_kwargs,
+                optimizer_build_kwargs=optimizer_build_kwargs,
+                args_for_launches=parsed,
+                evaluation=evaluation,
+                hp_combs=hp_combs,
+                order=order
+            ),
+            hp_combs,
+            'several_meta_optimizer_launches'
         )
-        p.start()
-        for hp_comb in hp_combs:
-            res = queue_.get()
-            # print('\nidx: %s\nres: %s' % (idx, res))
-            # print('hp_combination:', hp_combination)
-            # print("(Environment._spring_process_for_meta_grid_search)res:", res)
-            self._handler.process_results(
-                hp_comb, res, regime='several_meta_optimizer_launches'
-            )
-        # if len(other_hp_combs) > 0:
-        #     for idx, other_hp_comb in enumerate(other_hp_combs):
-        #         hp_combination = construct(base_hp_comb)
-        #         hp_combination.update(other_hp_comb)
-        #         res = queue_.get()
-        #         # print('\nidx: %s\nres: %s' % (idx, res))
-        #         # print('hp_combination:', hp_combination)
-        #         # print("(Environment._spring_process_for_meta_grid_search)res:", res)
-        #         self._handler.process_results(
-        #             hp_combination, res, regime='several_meta_optimizer_launches'
-        #         )
-        # else:
-        #     hp_combination = construct(base_hp_comb)
-        #     res = queue_.get()
-        #     # print("(Environment._spring_process_for_meta_grid_search)res:", res)
-        #     self._handler.process_results(hp_combination, res, regime='several_meta_optimizer_launches')
-        p.join()
+        self._collect_grid_search_results()
 
     def grid_search_for_meta(
             self,
@@ -2216,8 +3101,19 @@ class Environment(object):
             build_optimizer_hyperparameters=None,
             other_hyperparameters=None,
             initial_experiment_counter_value=0,
+            num_workers=1,
+            worker_visible_device_lists=None,
+            worker_num_threads=None,
+            worker_cpus=None,
+            skip_completed=False,
+            launched_hp_comb_hashes=None,
+            use_results_store=False,
             **kwargs
     ):
+        """Worker pool arguments and skip_completed are the same as in grid_search method. If
+        launched_hp_comb_hashes is provided only hyperparameter combinations which hashes (computed by
+        Handler.get_hp_comb_hash) are in it are launched. If use_results_store is True results are also saved
+        in SQLite results store in evaluation save_path"""
         self._store_launch_parameters(
             'optimizer',
             evaluation=evaluation,
@@ -2226,6 +3122,7 @@ class Environment(object):
             build_pupil_hyperparameters=build_pupil_hyperparameters,
             build_optimizer_hyperparameters=build_optimizer_hyperparameters,
             other_hyperparameters=other_hyperparameters,
+            num_workers=num_workers,
             kwargs=kwargs
         )
 
@@ -2286,9 +3183,12 @@ class Environment(object):
             evaluation_result_types,
             eval_pupil_names=nth_element_of_sequence_of_sequences(evaluation['opt_inf_pupil_restore_paths'], 0),
             hyperparameters=hps,
-            initial_experiment_counter_value=initial_experiment_counter_value
+            initial_experiment_counter_value=initial_experiment_counter_value,
+            use_results_store=use_results_store
         )
         self._handler.log_launch()
+        self._start_grid_search_workers(
+            session_specs, num_workers, worker_visible_device_lists, worker_num_threads, worker_cpus)
         # print('build_insertions:', build_insertions)
         # print('build_hp_combs:', build_hp_combs)
         if len(build_pupil_hp_combs) > 0:
@@ -2331,10 +3231,11 @@ class Environment(object):
                             shares,
                             pupil_build_kwargs,
                             optimizer_build_kwargs,
-                            session_specs,
                             evaluation,
                             other_hp_combs,
-                            base_hp_comb
+                            base_hp_comb,
+                            skip_completed,
+                            launched_hp_comb_hashes
                         )
                 else:
                     self._spring_process_for_meta_grid_search(
@@ -2342,10 +3243,11 @@ class Environment(object):
                         pupil_shares,
                         pupil_build_kwargs,
                         kwargs_for_optimizer_building,
-                        session_specs,
                         evaluation,
                         other_hp_combs,
-                        construct(pupil_build_hp_comb)
+                        construct(pupil_build_hp_comb),
+                        skip_completed,
+                        launched_hp_comb_hashes
                     )
         else:
             if len(build_optimizer_hp_combs) > 0:
@@ -2371,10 +3273,11 @@ class Environment(object):
                         optimizer_shares,
                         kwargs_for_pupil_building,
                         optimizer_build_kwargs,
-                        session_specs,
                         evaluation,
                         other_hp_combs,
-                        optimizer_build_hp_comb
+                        optimizer_build_hp_comb,
+                        skip_completed,
+                        launched_hp_comb_hashes
                     )
             else:
                 self._spring_process_for_meta_grid_search(
@@ -2382,14 +3285,205 @@ class Environment(object):
                     [],
                     kwargs_for_pupil_building,
                     kwargs_for_optimizer_building,
-                    session_specs,
                     evaluation,
                     other_hp_combs,
-                    dict()
+                    dict(),
+                    skip_completed,
+                    launched_hp_comb_hashes
                 )
+        self._stop_grid_search_workers()
         self._handler.log_finish_time()
         self._handler.close()
 
+    @staticmethod
+    def _get_meta_search_scores(save_path, pupil_names, metric, maximize):
+        """Returns dictionary hyperparameter combination hash -> mean over pupils of last metric value of optimizer
+        inference on validation dataset (on train dataset if there is no validation). Diverged launches get the
+        worst score. Hashes and experiment numbers are taken from grid search index so hashes are the same as
+        computed by Handler.get_hp_comb_hash"""
+        worst = -np.inf if maximize else np.inf
+        if not os.path.exists(os.path.join(save_path, RESULTS_STORE_FILE_NAME)):
+            return dict()
+        records = read_grid_index(os.path.join(save_path, GRID_INDEX_FILE_NAME))
+        reader = ResultsStoreReader(os.path.join(save_path, RESULTS_STORE_FILE_NAME))
+        regime = 'validation' if 'validation' in reader.get_regimes() else 'train'
+        scores = dict()
+        for record in records:
+            if record['experiment'] is None:
+                continue
+            experiment = int(record['experiment'])
+            values = list()
+            for pupil_name in pupil_names:
+                _, pupil_values = reader.get_results(metric, regime, pupil=pupil_name, experiment=experiment)
+                if len(pupil_values) > 0 and np.isfinite(pupil_values[-1]):
+                    values.append(pupil_values[-1])
+                else:
+                    values.append(worst)
+            scores[record['hash']] = float(np.mean(values))
+        reader.close()
+        return scores
+
+    def successive_halving_for_meta(
+            self,
+            evaluation,
+            kwargs_for_pupil_building,
+            kwargs_for_optimizer_building,
+            min_stop,
+            eta=3,
+            max_stop=None,
+            metric='loss',
+            maximize=False,
+            **kwargs
+    ):
+        """Budget aware version of grid_search_for_meta. All hyperparameter combinations are trained with stop equal
+        to min_stop. Best 1/eta of them by metric of optimizer inference are trained with eta times larger stop and
+        so on until one combination is left or stop reaches max_stop (by default stop from kwargs). Combinations are
+        trained from scratch on every rung. Results of rung i are saved in '<evaluation save_path>/rung<i>' so
+        interrupted search is resumed if method is called with the same arguments. Other kwargs are passed to
+        grid_search_for_meta.
+        Returns list of (hyperparameter combination hash, score) tuples of last rung sorted from best to worst.
+        Hyperparameters of combination can be found in grid search index or results store of rung"""
+        if max_stop is None:
+            max_stop = kwargs.get('stop')
+            if isinstance(max_stop, dict):
+                max_stop = max_stop.get('limit')
+        if max_stop is None or max_stop < min_stop:
+            raise InvalidArgumentError(
+                'max_stop has to be provided (directly or as stop) and be not less than min_stop',
+                max_stop,
+                'max_stop',
+                'number not less than %s' % min_stop
+            )
+        pupil_names = nth_element_of_sequence_of_sequences(evaluation['opt_inf_pupil_restore_paths'], 0)
+        launched_hp_comb_hashes = None
+        stop = min_stop
+        rung = 0
+        while True:
+            rung_evaluation = dict(evaluation)
+            rung_evaluation['save_path'] = os.path.join(evaluation['save_path'], 'rung%s' % rung)
+            rung_kwargs = dict(kwargs)
+            rung_kwargs['stop'] = stop
+            # completed launches of rung are reused when search is resumed
+            rung_kwargs.setdefault('skip_completed', True)
+            # scores are read from results store
+            rung_kwargs['use_results_store'] = True
+            print('\nrung %s: stop %s, %s hyperparameter combinations' % (
+                rung, stop, 'all' if launched_hp_comb_hashes is None else len(launched_hp_comb_hashes)))
+            self.grid_search_for_meta(
+                rung_evaluation,
+                kwargs_for_pupil_building,
+                kwargs_for_optimizer_building,
+                launched_hp_comb_hashes=launched_hp_comb_hashes,
+                **rung_kwargs
+            )
+            scores = self._get_meta_search_scores(rung_evaluation['save_path'], pupil_names, metric, maximize)
+            if launched_hp_comb_hashes is not None:
+                scores = dict([(h, v) for h, v in scores.items() if h in launched_hp_comb_hashes])
+            ranked = sorted(scores.items(), key=lambda x: x[1], reverse=maximize)
+            num_kept = len(ranked) // eta
+            if num_kept == 0 or stop >= max_stop:
+                return ranked
+            launched_hp_comb_hashes = set([h for h, _ in ranked[:num_kept]])
+            stop = min(stop * eta, max_stop)
+            rung += 1
+
+    @staticmethod
+    def _create_meta_hp_candidates(
+            build_pupil_hyperparameters,
+            build_optimizer_hyperparameters,
+            other_hyperparameters
+    ):
+        """Returns all hyperparameter combinations of grid_search_for_meta keyed by hyperparameter name strings"""
+        hp_comb_lists = list()
+        for hps, formalize in [
+            (build_pupil_hyperparameters, formalize_and_create_insertions_for_build_hps),
+            (build_optimizer_hyperparameters, formalize_and_create_insertions_for_build_hps),
+            (other_hyperparameters, formalize_and_create_insertions_for_other_hps)
+        ]:
+            if hps is not None:
+                hp_combs, _ = formalize(construct(hps))
+                if len(hp_combs) > 0:
+                    hp_comb_lists.append(hp_combs)
+        candidates = list()
+        for combination in itertools.product(*hp_comb_lists):
+            hp_comb = OrderedDict()
+            for part in combination:
+                hp_comb.update(part)
+            candidates.append(Handler.hp_comb_with_name_strings(hp_comb))
+        return candidates
+
+    def model_based_search_for_meta(
+            self,
+            evaluation,
+            kwargs_for_pupil_building,
+            kwargs_for_optimizer_building,
+            num_launches,
+            build_pupil_hyperparameters=None,
+            build_optimizer_hyperparameters=None,
+            other_hyperparameters=None,
+            num_random_launches=5,
+            launches_per_step=None,
+            metric='loss',
+            maximize=False,
+            length_scale=.3,
+            random_seed=None,
+            **kwargs
+    ):
+        """Sequential model based alternative to grid_search_for_meta. Hyperparameters are specified in the same
+        format as for grid_search_for_meta and form a grid of candidates. First num_random_launches candidates are
+        chosen randomly. After that metric of optimizer inference (see successive_halving_for_meta) of launched
+        candidates is modelled by Gaussian process and launches_per_step (by default num_workers) candidates with
+        the largest expected improvement are launched on every step until num_launches candidates are launched.
+        All launches are saved in evaluation save_path. Launches found there (e.g. after crash) are reused.
+        Other kwargs are passed to grid_search_for_meta.
+        Returns list of (hyperparameter combination, score) tuples sorted from best to worst. Hyperparameters are
+        keyed by names used in hp_layout.txt"""
+        candidates = self._create_meta_hp_candidates(
+            build_pupil_hyperparameters, build_optimizer_hyperparameters, other_hyperparameters)
+        hashes = [hp_comb_hash(candidate) for candidate in candidates]
+        encoded = encode_hp_combs(candidates)
+        if launches_per_step is None:
+            launches_per_step = kwargs.get('num_workers', 1)
+        proposer = GaussianProcessProposer(length_scale=length_scale, random_seed=random_seed)
+        pupil_names = nth_element_of_sequence_of_sequences(evaluation['opt_inf_pupil_restore_paths'], 0)
+        sign = -1. if maximize else 1.
+        # scores are read from results store
+        kwargs['use_results_store'] = True
+        num_observed_before = None
+        while True:
+            # hashes of completed launches are recorded in grid search index by Handler
+            launched = set([record['hash'] for record in read_grid_index(
+                os.path.join(evaluation['save_path'], GRID_INDEX_FILE_NAME))])
+            scores = self._get_meta_search_scores(evaluation['save_path'], pupil_names, metric, maximize)
+            observed = [idx for idx, h in enumerate(hashes) if h in launched and h in scores]
+            not_launched = [idx for idx, h in enumerate(hashes) if h not in launched]
+            if num_observed_before is not None and len(observed) == num_observed_before:
+                print('(Environment.model_based_search_for_meta)WARNING: last step did not add observations '
+                      '(%s launches are observed). Launches probably failed. Search is stopped' % len(observed))
+                break
+            if len(observed) >= num_launches or len(not_launched) == 0:
+                break
+            num_observed_before = len(observed)
+            proposed = proposer.propose(
+                encoded[not_launched],
+                encoded[observed],
+                [sign * scores[hashes[idx]] for idx in observed],
+                num=min(launches_per_step, num_launches - len(observed)),
+                num_random=num_random_launches
+            )
+            self.grid_search_for_meta(
+                evaluation,
+                kwargs_for_pupil_building,
+                kwargs_for_optimizer_building,
+                build_pupil_hyperparameters=build_pupil_hyperparameters,
+                build_optimizer_hyperparameters=build_optimizer_hyperparameters,
+                other_hyperparameters=other_hyperparameters,
+                launched_hp_comb_hashes=set([hashes[not_launched[idx]] for idx in proposed]),
+                **kwargs
+            )
+        ranked = [(candidates[idx], scores[hashes[idx]]) for idx in observed]
+        return sorted(ranked, key=lambda x: x[1], reverse=maximize)
+
     @staticmethod
     def _prepare_replica(replica, batch_generator_class, bpe_codes, batch_gen_args):
         if getattr(batch_generator_class, 'make_pairs', None) is not None:
@@ -2455,7 +3549,10 @@ class Environment(object):
         if restore_path is None:
             print_and_log('Skipping variables restoring. Continuing on current variables values', fn=log_path)
         else:
-            self._session.run(tf.global_variables_initializer())
+            self._session.run(
+                tf.global_variables_initializer(),
+                feed_dict=self._form_initialization_feed_dict(additions_to_feed_dict)
+            )
             self._restore_pupil(restore_path)
         self._hooks['reset_validation_state'].run(session=self._session)
         if first_speaker == 'human':
@@ -2619,7 +3716,10 @@ class Environment(object):
                             gpu_memory,
                             allow_growth,
                             '')
-        self._session.run(tf.global_variables_initializer())
+        self._session.run(
+            tf.global_variables_initializer(),
+            feed_dict=self._form_initialization_feed_dict(additions_to_feed_dict)
+        )
         self._restore_pupil(restore_path)
         self._hooks['reset_validation_state'].run(session=self._session)
         greeting = 'Здравствуйте, я бот.'
@@ -0,0 +1,106 @@
+import numpy as np
+
+from learning_to_learn.useful_functions import InvalidArgumentError
+
+
+class MultiExerciseBatchGenerator(object):
+    """Produces batches for all exercises of meta optimizer training in one call. Token ids of all datasets are
+    taken once from batch generators (get_ids and get_start_id methods are required, e.g. LstmFastBatchGenerator,
+    BpeFastBatchGenerator) and concatenated into one array. Each exercise has its own row of cursors in
+    [num_exercises, batch_size] cursor array and its own dataset. Exercise reset is done by reset method which
+    only reassigns cursors.
+    next method returns inputs of shape [num_exercises, num_unrollings, batch_size, 1] and labels of shape
+    [num_exercises, num_unrollings * batch_size, 1]. Slice along first dimension is identical to output of
+    fast batch generator next method."""
+    def __init__(self, dataset_batch_gens, num_exercises, num_unrollings=1):
+        for b_gen in dataset_batch_gens:
+            if not hasattr(b_gen, 'get_ids') or not hasattr(b_gen, 'get_start_id'):
+                raise InvalidArgumentError(
+                    'Batch generators used in MultiExerciseBatchGenerator have to provide get_ids and'
+                    ' get_start_id methods',
+                    b_gen,
+                    'dataset_batch_gens',
+                    'list of fast batch generators'
+                )
+        id_arrays = [b_gen.get_ids() for b_gen in dataset_batch_gens]
+        if len(id_arrays) == 1:
+            # memory mapped ids are not copied
+            self._ids = id_arrays[0]
+        else:
+            self._ids = np.concatenate(id_arrays)
+        self._dataset_lengths = np.array([len(ids) for ids in id_arrays])
+        self._dataset_offsets = np.concatenate([[0], np.cumsum(self._dataset_lengths)[:-1]])
+        self._start_id = dataset_batch_gens[0].get_start_id()
+        self._num_exercises = num_exercises
+        self._num_unrollings = num_unrollings
+        self._batch_size = None
+        self._dataset_map = None
+        self._cursor = None
+        self._last_batch = None
+
+    def fork(self):
+        """Returns new generator which shares token ids with this one but has its own cursors. It has to be
+        reset before usage"""
+        new = MultiExerciseBatchGenerator.__new__(MultiExerciseBatchGenerator)
+        new._ids = self._ids
+        new._dataset_lengths = self._dataset_lengths
+        new._dataset_offsets = self._dataset_offsets
+        new._start_id = self._start_id
+        new._num_exercises = self._num_exercises
+        new._num_unrollings = self._num_unrollings
+        new._batch_size = None
+        new._dataset_map = None
+        new._cursor = None
+        new._last_batch = None
+        return new
+
+    def reset(self, batch_size, dataset_map, random_batch_initiation=False, num_unrollings=None):
+        """dataset_map[i] is index of dataset used by exercise i"""
+        if len(dataset_map) != self._num_exercises:
+            raise InvalidArgumentError(
+                'dataset_map length has to be equal to number of exercises',
+                dataset_map,
+                'dataset_map',
+                'list of length %s' % self._num_exercises
+            )
+        if num_unrollings is not None:
+            self._num_unrollings = num_unrollings
+        self._batch_size = batch_size
+        self._dataset_map = np.array(dataset_map)
+        # shape [num_exercises, 1]
+        lengths = self._dataset_lengths[self._dataset_map].reshape((-1, 1))
+        if random_batch_initiation:
+            self._cursor = np.floor(
+                np.random.uniform(size=(self._num_exercises, batch_size)) * lengths).astype(np.int64)
+        else:
+            segments = lengths // batch_size
+            self._cursor = np.arange(batch_size).reshape((1, -1)) * segments
+        self._last_batch = np.full((self._num_exercises, 1, batch_size), self._start_id, dtype=np.int32)
+
+    def get_batch_size(self):
+        return self._batch_size
+
+    def get_num_exercises(self):
+        return self._num_exercises
+
+    def next(self):
+        if self._cursor is None:
+            raise InvalidArgumentError(
+                'MultiExerciseBatchGenerator has to be reset before generating batches',
+                None,
+                'self._cursor',
+                'cursors assigned by reset method'
+            )
+        lengths = self._dataset_lengths[self._dataset_map].reshape((-1, 1, 1))
+        offsets = self._dataset_offsets[self._dataset_map].reshape((-1, 1, 1))
+        unrolling_offsets = np.arange(self._num_unrollings).reshape((1, -1, 1))
+        # shape [num_exercises, num_unrollings, batch_size]
+        positions = (self._cursor[:, None, :] + unrolling_offsets) % lengths + offsets
+        batches = self._ids[positions].astype(np.int32)
+        inputs = np.concatenate([self._last_batch, batches[:, :-1]], 1)
+        self._last_batch = batches[:, -1:]
+        self._cursor = (self._cursor + self._num_unrollings) % lengths.reshape((-1, 1))
+        return (
+            inputs.reshape((self._num_exercises, self._num_unrollings, self._batch_size, 1)),
+            batches.reshape((self._num_exercises, -1, 1))
+        )
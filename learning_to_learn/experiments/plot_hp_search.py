@@ -13,6 +13,7 @@ except ValueError:  # Already removed
 
 from learning_to_learn.useful_functions import convert, apply_func_to_nested, synchronous_sort, create_path, \
     remove_empty_strings_from_list
+from learning_to_learn.results_store import ResultsStoreReader, RESULTS_STORE_FILE_NAME
 
 AVERAGING_NUMBER = 3
 COLORS = ['r', 'g', 'b', 'k', 'c', 'magenta', 'brown', 'darkviolet', 'pink', 'yellow', 'gray', 'orange', 'olive']
@@ -39,6 +40,12 @@ eval_dir_contents.remove('hp_layout.txt')
 for entry in eval_dir_contents:
     if 'launch_log' in entry:
         eval_dir_contents.remove(entry)
+# if results store is present results are read from it instead of text files
+if RESULTS_STORE_FILE_NAME in eval_dir_contents:
+    eval_dir_contents.remove(RESULTS_STORE_FILE_NAME)
+    store_reader = ResultsStoreReader(os.path.join(eval_dir, RESULTS_STORE_FILE_NAME))
+else:
+    store_reader = None
 
 plot_conf_file = 'plot.conf'
 plot_parameter_names = dict()
@@ -135,6 +142,16 @@ for hp_value_file, result_dir in zip(hp_value_files, result_dirs):
                 if line_hp_value not in d:
                     d[line_hp_value] = [list(), list()]
                 r = d[line_hp_value]
+                if store_reader is not None:
+                    _, values = store_reader.get_results(
+                        res_type, regime, pupil=pupil_name, experiment=int(result_dir))
+                    if len(values) == 0:
+                        print('(plot_hp_search)WARNING: no %s %s results of pupil %s in experiment %s. Skipped' %
+                              (regime, res_type, pupil_name, result_dir))
+                        continue
+                    r[0].append(changing_hp_value)
+                    r[1].append(values[-AVERAGING_NUMBER:].mean())
+                    continue
                 file_name = res_type + '_' + regime + '.txt'
                 file_with_data = os.path.join(eval_dir, result_dir, pupil_name, file_name)
                 with open(file_with_data, 'r') as f:
@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import inspect
+import json
+import os
+import sys
+
+import tensorflow as tf
+from tensorflow.core.protobuf import saver_pb2
+
+
+class UncacheableHookError(Exception):
+    def __init__(self, msg):
+        super(UncacheableHookError, self).__init__(msg)
+        self._msg = msg
+
+
+class UncacheableGraphError(Exception):
+    def __init__(self, msg):
+        super(UncacheableGraphError, self).__init__(msg)
+        self._msg = msg
+
+
+def _canonical(obj):
+    # dictionary keys are not necessarily strings (e.g. tuples in hyperparameter names)
+    if isinstance(obj, dict):
+        return [[_canonical(k), _canonical(v)] for k, v in sorted(obj.items(), key=lambda item: repr(item[0]))]
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(elem) for elem in obj]
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    # repr of arbitrary object (e.g. function or instance) can contain memory address or miss state which
+    # affects the graph
+    raise UncacheableGraphError('build kwarg value %r can not be used in graph cache key' % (obj,))
+
+
+def _code_version(cls):
+    """Hash of source files of modules defining cls and its base classes. Graph is rebuilt if code building it is
+    changed"""
+    sha = hashlib.sha1()
+    file_names = list()
+    for klass in cls.__mro__:
+        module = sys.modules.get(klass.__module__)
+        if module is None or klass.__module__ == 'builtins':
+            continue
+        try:
+            file_name = inspect.getsourcefile(module)
+        except TypeError:
+            file_name = None
+        if file_name is None:
+            raise UncacheableGraphError('source of module %s is not available' % klass.__module__)
+        if file_name not in file_names:
+            file_names.append(file_name)
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def graph_cache_key(cls, kwargs, parent_key=None):
+    """Hash of class, source code of class modules and build kwargs. parent_key is a key of graph the built graph
+    is added to, e.g. key of pupil graph for meta optimizer. Raises UncacheableGraphError if kwargs contain values
+    which are not numbers, strings, None or containers of them"""
+    description = json.dumps(
+        [cls.__module__, cls.__name__, _code_version(cls), parent_key, tf.__version__, _canonical(kwargs)],
+        sort_keys=True
+    )
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def _encode_hook(value):
+    if isinstance(value, tf.Variable):
+        return {'variable': value.name}
+    if isinstance(value, tf.Tensor):
+        return {'tensor': value.name}
+    if isinstance(value, tf.Operation):
+        return {'operation': value.name}
+    if isinstance(value, tf.train.Saver):
+        return {'saver': base64.b64encode(value.as_saver_def().SerializeToString()).decode('ascii')}
+    if isinstance(value, (list, tuple)):
+        return {'list': [_encode_hook(elem) for elem in value], 'tuple': isinstance(value, tuple)}
+    if isinstance(value, dict):
+        for k in value:
+            if not isinstance(k, str):
+                raise UncacheableHookError('hook dictionary key %r is not a string' % (k,))
+        return {'dict': dict([(k, _encode_hook(v)) for k, v in value.items()])}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {'value': value}
+    raise UncacheableHookError('hook value %r can not be cached' % (value,))
+
+
+def _decode_hook(encoded, graph, variables):
+    if 'variable' in encoded:
+        if encoded['variable'] in variables:
+            return variables[encoded['variable']]
+        return graph.get_tensor_by_name(encoded['variable'])
+    if 'tensor' in encoded:
+        return graph.get_tensor_by_name(encoded['tensor'])
+    if 'operation' in encoded:
+        return graph.get_operation_by_name(encoded['operation'])
+    if 'saver' in encoded:
+        saver_def = saver_pb2.SaverDef()
+        saver_def.ParseFromString(base64.b64decode(encoded['saver']))
+        return tf.train.Saver(saver_def=saver_def)
+    if 'list' in encoded:
+        decoded = [_decode_hook(elem, graph, variables) for elem in encoded['list']]
+        return tuple(decoded) if encoded['tuple'] else decoded
+    if 'dict' in encoded:
+        return dict([(k, _decode_hook(v, graph, variables)) for k, v in encoded['dict'].items()])
+    return encoded['value']
+
+
+class GraphCache(object):
+    """Directory with built graphs. Graph is saved as MetaGraph file <key>.meta together with hooks
+    <key>.hooks.json which map aliases to names of tensors, operations and variables. Hooks file is written last
+    and files are moved into place atomically, so partly written entries are not visible to concurrent
+    processes (e.g. grid search workers)"""
+    def __init__(self, directory):
+        self._directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _file_names(self, key):
+        return os.path.join(self._directory, key + '.meta'), os.path.join(self._directory, key + '.hooks.json')
+
+    def __contains__(self, key):
+        meta_file, hooks_file = self._file_names(key)
+        return os.path.exists(meta_file) and os.path.exists(hooks_file)
+
+    def save(self, key, hooks):
+        """Exports default graph. Returns False if hooks can not be cached"""
+        meta_file, hooks_file = self._file_names(key)
+        try:
+            encoded = _encode_hook(hooks)
+        except UncacheableHookError as e:
+            print('(GraphCache.save)graph is not cached: %s' % e)
+            return False
+        tmp_suffix = '.tmp%s' % os.getpid()
+        try:
+            tf.train.export_meta_graph(filename=meta_file + tmp_suffix, clear_devices=False)
+        except ValueError as e:
+            # e.g. graph proto is larger than 2GB
+            print('(GraphCache.save)graph is not cached: %s' % e)
+            return False
+        os.replace(meta_file + tmp_suffix, meta_file)
+        with open(hooks_file + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump(encoded, f)
+        os.replace(hooks_file + tmp_suffix, hooks_file)
+        return True
+
+    def load(self, key):
+        """Imports graph into default graph and returns hooks. Returns None if there is no such entry or default
+        graph is not empty because names of imported tensors would change"""
+        if key not in self:
+            return None
+        graph = tf.get_default_graph()
+        if len(graph.get_operations()) > 0:
+            return None
+        meta_file, hooks_file = self._file_names(key)
+        with open(hooks_file, 'r', encoding='utf-8') as f:
+            encoded = json.load(f)
+        tf.train.import_meta_graph(meta_file, clear_devices=False)
+        variables = dict([(v.name, v) for v in tf.global_variables() + tf.local_variables()])
+        return _decode_hook(encoded, graph, variables)
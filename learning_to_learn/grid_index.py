@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+
+
+GRID_INDEX_FILE_NAME = 'grid_index.jsonl'
+
+
+def _hp_entries(hp_comb):
+    # values are saved as strings the same way as in experiment description files
+    return [[str(name), str(value), value.__class__.__name__] for name, value in hp_comb.items()]
+
+
+def hp_comb_hash(hp_comb):
+    """Hash of hyperparameter combination which does not depend on order of hyperparameters"""
+    canonical = json.dumps(sorted(_hp_entries(hp_comb)))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def read_grid_index(file_name):
+    """Returns list of index records. Record is a dictionary with 'hash', 'experiment' and 'hp' entries.
+    'hp' is a list of [name, value string, type name] triplets. Line broken by crash during writing is skipped"""
+    records = list()
+    if not os.path.exists(file_name):
+        return records
+    with open(file_name, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+class GridSearchIndex(object):
+    """Persistent index of completed hyperparameter combinations of grid search. One line is appended to index file
+    after results of combination are saved and the file is synced to disk, so index stays valid if process
+    crashes. experiment is number of experiment directory in meta optimizer grid search and None for pupil grid
+    search"""
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._experiments = dict()
+        for record in read_grid_index(file_name):
+            self._experiments[record['hash']] = record['experiment']
+        # if the last line was broken by crash, new record is started from new line so it is not lost too
+        self._line_is_broken = False
+        if os.path.exists(file_name) and os.path.getsize(file_name) > 0:
+            with open(file_name, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                self._line_is_broken = f.read(1) != b'\n'
+
+    def __contains__(self, hp_comb):
+        return hp_comb_hash(hp_comb) in self._experiments
+
+    def __len__(self):
+        return len(self._experiments)
+
+    def add(self, hp_comb, experiment=None):
+        hash_ = hp_comb_hash(hp_comb)
+        record = dict(hash=hash_, experiment=experiment, hp=_hp_entries(hp_comb))
+        with open(self._file_name, 'a', encoding='utf-8') as f:
+            if self._line_is_broken:
+                f.write('\n')
+                self._line_is_broken = False
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._experiments[hash_] = experiment
+
+    def get_next_experiment(self):
+        """Returns number following the largest recorded experiment number or 0"""
+        experiments = [e for e in self._experiments.values() if e is not None]
+        if len(experiments) == 0:
+            return 0
+        return max(experiments) + 1
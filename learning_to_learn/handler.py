@@ -1,15 +1,22 @@
 import datetime as dt
+import os
+from collections import OrderedDict
 
 import numpy as np
 import tensorflow as tf
 
 from learning_to_learn.useful_functions import create_path, add_index_to_filename_if_needed, construct, nested2string, \
     WrongMethodCallError, extend_dictionary
+from learning_to_learn.results_writer import ResultsWriter
+from learning_to_learn.results_store import ResultsStore, RESULTS_STORE_FILE_NAME
+from learning_to_learn.grid_index import GridSearchIndex, GRID_INDEX_FILE_NAME, hp_comb_hash
 
 
 class Handler(object):
 
     _stars = '*'*30
+    # number of results accumulated before they are appended to results store
+    _store_buffer_size = 1000
 
     def _compose_prefix(self, prefix):
         res = ''
@@ -130,8 +137,15 @@ class Handler(object):
             fuse_file_name=None,
             example_tensor_schedule=None,
             example_file_name=None,
-            verbose=True
+            verbose=True,
+            results_flush_interval=1.,
+            results_buffer_size=65536,
+            use_results_store=False
     ):
+        """results_flush_interval and results_buffer_size are passed to ResultsWriter which accumulates results
+        lines in memory. If results_flush_interval is None results are written to files immediately.
+        If use_results_store is True results are also appended to SQLite results store in save_path (required by
+        successive_halving_for_meta and model_based_search_for_meta)"""
         self._verbose = verbose
         if printed_result_types is None:
             printed_result_types = ['loss']
@@ -147,6 +161,9 @@ class Handler(object):
         self._bpc = 'bpc' in self._result_types
         self._hooks = hooks
         self._last_run_tensor_order = dict()
+        # fetch lists and their layouts composed by get_tensors
+        self._fetch_cache = dict()
+        self._last_fetches_are_basic = True
         self._save_to_file = save_to_file
         self._save_to_storage = save_to_storage
         self._print_results = print_results
@@ -157,6 +174,15 @@ class Handler(object):
         self._vocabulary = vocabulary
         if self._save_path is not None:
             create_path(self._save_path)
+            self._results_writer = ResultsWriter(
+                flush_interval=results_flush_interval, buffer_size=results_buffer_size)
+        else:
+            self._results_writer = None
+        # results store is opened on first write
+        self._use_results_store = use_results_store and self._save_path is not None
+        self._results_store = None
+        self._results_store_pid = None
+        self._store_rows = list()
 
         self._print_order = ['loss', 'bpc', 'perplexity', 'accuracy']
 
@@ -169,6 +195,12 @@ class Handler(object):
 
         self._meta_optimizer_inference_is_performed = False
 
+        # completed hyperparameter combinations of grid search
+        self._grid_index = None
+        if self._processing_type in ['several_launches', 'several_meta_optimizer_launches'] \
+                and self._save_path is not None:
+            self._grid_index = GridSearchIndex(os.path.join(self._save_path, GRID_INDEX_FILE_NAME))
+
         if self._processing_type == 'train' or self._processing_type == 'train_with_meta':
             self._create_train_fields()
             if self._save_path is not None:
@@ -259,6 +291,9 @@ class Handler(object):
                 layout_str += result_names[-1]
                 f.write(layout_str)
             self._experiment_counter = initial_experiment_counter_value
+            if self._grid_index is not None:
+                # experiments of interrupted grid search are not overwritten on resume
+                self._experiment_counter = max(self._experiment_counter, self._grid_index.get_next_experiment())
             self._tmpl = '%s/%s/%s_%s.txt'  # <experiment number>/<pupil_name>/<metric>_<regime>.txt
             self._hp_values_str_tmpl = '%s '*(len(self._order) - 1) + '%s'
             self._environment_instance.set_in_storage(launches=list())
@@ -322,6 +357,37 @@ class Handler(object):
     def order(self):
         return construct(self._order)
 
+    @property
+    def result_types(self):
+        return list(self._result_types)
+
+    @classmethod
+    def hp_comb_with_name_strings(cls, hp, order=None):
+        """Returns hyperparameter combination keyed by the same strings as in hp_layout.txt and results store"""
+        if order is None:
+            order = list(hp.keys())
+        res = OrderedDict()
+        for name in order:
+            if name in hp:
+                if isinstance(name, tuple):
+                    res[cls._hyperparameter_name_string(name)] = hp[name]
+                else:
+                    res[str(name)] = hp[name]
+        return res
+
+    def _hp_comb_for_grid_index(self, hp):
+        return self.hp_comb_with_name_strings(hp, order=self._order)
+
+    def get_hp_comb_hash(self, hp):
+        """Hash of hyperparameter combination used in grid search index"""
+        return hp_comb_hash(self._hp_comb_for_grid_index(hp))
+
+    def hp_comb_is_completed(self, hp):
+        """Checks if hyperparameter combination is recorded in grid search index"""
+        if self._grid_index is None:
+            return False
+        return self._hp_comb_for_grid_index(hp) in self._grid_index
+
     def set_pupil_name(self, pupil_name):
         self._name_of_pupil_for_optimizer_inference = pupil_name
 
@@ -343,6 +409,7 @@ class Handler(object):
             self._environment_instance.init_storage(dataset_name, **init_dict)
 
     def set_new_run_schedule(self, schedule, validation_dataset_names, save_direction='main'):
+        self.reset_fetch_cache()
         self._results_collect_interval = schedule['to_be_collected_while_training']['results_collect_interval']
         if self._results_collect_interval is not None:
             if self._result_types is not None:
@@ -400,6 +467,7 @@ class Handler(object):
             opt_inf_validation_tensor_schedule=None
     ):
         # print("(Handler.set_optimizer_train_schedule)self._opt_inf_pupil_names:", self._opt_inf_pupil_names)
+        self.reset_fetch_cache()
         self._opt_inf_pupil_names = opt_inf_pupil_names
         if self._save_path is not None:
             if self._opt_inf_pupil_names is not None:
@@ -479,7 +547,10 @@ class Handler(object):
     def stop_accumulation(self,
                           save_to_file=True,
                           save_to_storage=True,
-                          print_results=True):
+                          print_results=True,
+                          precomputed_means=None):
+        """precomputed_means is a dictionary with means accumulated outside of handler (e.g. in pupil graph).
+        They are used instead of values collected by process_results"""
         save_to_file = self.decide(save_to_file, self._save_to_file)
         save_to_storage = self.decide(save_to_storage, self._save_to_storage)
         print_results = self.decide(print_results, self._print_results)
@@ -501,6 +572,8 @@ class Handler(object):
                 mean = 0.
             else:
                 mean = mean / counter
+            if precomputed_means is not None and key in precomputed_means:
+                mean = precomputed_means[key]
             # print('(stop_accumulation)counter:', counter)
             if self._save_path is not None:
                 if save_to_file:
@@ -508,15 +581,18 @@ class Handler(object):
                         file_name = self._get_optimizer_inference_file_name('validation', key)
                     else:
                         file_name = self._file_names[self._name_of_dataset_on_which_accumulating]['results'][key]
-                    with open(file_name, 'a') as f:
-                        if self._training_step is not None:
-                            f.write('%s %s\n' % (self._training_step, mean))
-                        else:
-                            try:
-                                f.write('%s\n' % mean)
-                            except TypeError:
-                                print('(Handler.stop_accumulation)value_list:', value_list)
-                                raise
+                    if self._meta_optimizer_inference_is_performed:
+                        self._store_result('validation', key, self._training_step, mean)
+                    else:
+                        self._store_result(self._name_of_dataset_on_which_accumulating, key, self._training_step, mean)
+                    if self._training_step is not None:
+                        self._results_writer.write(file_name, '%s %s\n' % (self._training_step, mean))
+                    else:
+                        try:
+                            self._results_writer.write(file_name, '%s\n' % mean)
+                        except TypeError:
+                            print('(Handler.stop_accumulation)value_list:', value_list)
+                            raise
             means[key] = mean
         if save_to_storage:
             # if self._meta_optimizer_inference_is_performed:
@@ -777,8 +853,47 @@ class Handler(object):
             elif processing_type == 'validation':
                 file_name = self._file_names[dataset_name]['results'][descriptor]
 
-        with open(file_name, 'a') as f:
-            f.write('%s %s\n' % (step, datum))
+        self._results_writer.write(file_name, '%s %s\n' % (step, datum))
+        if processing_type == 'validation' and not self._meta_optimizer_inference_is_performed:
+            self._store_result(dataset_name, descriptor, step, datum)
+        else:
+            self._store_result(processing_type, descriptor, step, datum)
+
+    def _check_results_store_process(self):
+        # connection and not appended rows of parent process are not used after fork
+        if self._results_store_pid != os.getpid():
+            self._results_store = None
+            self._store_rows = list()
+            self._results_store_pid = os.getpid()
+
+    def _append_to_results_store(self, rows):
+        self._check_results_store_process()
+        if self._results_store is None:
+            self._results_store = ResultsStore(os.path.join(self._save_path, RESULTS_STORE_FILE_NAME))
+        self._results_store.append(rows)
+
+    def _store_result(self, regime, metric, step, value):
+        """Result is appended to results store with other accumulated results. Optimizer inference results are
+        stored with pupil name and meta optimizer training step"""
+        if not self._use_results_store:
+            return
+        self._check_results_store_process()
+        if self._meta_optimizer_inference_is_performed:
+            training_step = self._meta_optimizer_training_step
+            pupil = self._name_of_pupil_for_optimizer_inference
+        else:
+            training_step = None
+            pupil = None
+        self._store_rows.append((None, pupil, regime, metric, step, float(value), training_step))
+        if len(self._store_rows) >= self._store_buffer_size:
+            self._flush_store_rows()
+
+    def _flush_store_rows(self):
+        self._check_results_store_process()
+        if len(self._store_rows) > 0:
+            rows = self._store_rows
+            self._store_rows = list()
+            self._append_to_results_store(rows)
 
     def _save_launch_results(self, results, hp):
         for dataset_name, res in results.items():
@@ -789,8 +904,7 @@ class Handler(object):
             all_together.update(res)
             for key in self._order:
                 values.append(all_together[key])
-            with open(self._file_names[dataset_name], 'a') as f:
-                f.write(self._tmpl % tuple(values))
+            self._results_writer.write(self._file_names[dataset_name], self._tmpl % tuple(values))
 
     def _save_optimizer_launch_results(self, results, hp):
         if self._save_path is not None:
@@ -810,6 +924,23 @@ class Handler(object):
                 f.write('\n')
                 f.write(self._hp_values_str_tmpl % tuple(hp_types))
             # print("(Handler._save_optimizer_launch_results)results:", results)
+            if self._use_results_store:
+                rows = list()
+                for pupil_name, pupil_res in results.items():
+                    for regime, regime_res in pupil_res.items():
+                        if regime != 'step':
+                            for res_type, values in regime_res.items():
+                                if res_type != 'steps':
+                                    for step, value in zip(regime_res['steps'], values):
+                                        rows.append(
+                                            (self._experiment_counter, pupil_name, regime, res_type, step, value,
+                                             None))
+                self._append_to_results_store(rows)
+                self._check_results_store_process()
+                self._results_store.add_hyperparameters(
+                    self._experiment_counter,
+                    dict([(self._hyperparameter_name_string(name), value) for name, value in hp.items()])
+                )
             for pupil_name, pupil_res in results.items():
                 for regime, regime_res in pupil_res.items():
                     if regime != 'step':
@@ -843,7 +974,58 @@ class Handler(object):
             if datum is not None:
                 self._accumulated[descriptor].append(datum)
 
+    def reset_fetch_cache(self):
+        """Has to be called if hooks or tensor schedules are changed"""
+        self._fetch_cache = dict()
+
+    def _get_regime_tensor_schedule(self, regime):
+        if regime == 'train' or regime == 'train_meta_optimizer':
+            return getattr(self, '_train_tensor_schedule', None)
+        if regime == 'validation' or regime == 'batched_validation':
+            return getattr(self, '_validation_tensor_schedule', None)
+        if regime == 'fuse':
+            return getattr(self, '_fuse_tensor_schedule', None)
+        if regime == 'example':
+            return getattr(self, '_example_tensor_schedule', None)
+        return None
+
+    @staticmethod
+    def _scheduled_tensors_flags(schedule, step):
+        """Flags show which of tensors with step schedule are fetched on step. Tensors listed without schedule are
+        fetched always and do not have flags"""
+        if schedule is None:
+            return ()
+        flags = list()
+        for tensors_schedule in schedule.values():
+            if isinstance(tensors_schedule, dict):
+                for tensor_schedule in tensors_schedule.values():
+                    if isinstance(tensor_schedule, list):
+                        flags.append(step in tensor_schedule)
+                    elif isinstance(tensor_schedule, int):
+                        flags.append(step % tensor_schedule == 0)
+        return tuple(flags)
+
     def get_tensors(self, regime, step, with_meta_optimizer=False):
+        """Fetch list and its layout (self._last_run_tensor_order) are composed once for regime and set of
+        scheduled tensors fetched on step and taken from cache later"""
+        key = (
+            regime,
+            with_meta_optimizer,
+            self._scheduled_tensors_flags(self._get_regime_tensor_schedule(regime), step)
+        )
+        if key not in self._fetch_cache:
+            tensors = self._compose_fetches(regime, step, with_meta_optimizer)
+            only_basic = len(tensors) == self._last_run_tensor_order['basic']['borders'][1]
+            self._fetch_cache[key] = (tensors, self._last_run_tensor_order, only_basic)
+        tensors, self._last_run_tensor_order, self._last_fetches_are_basic = self._fetch_cache[key]
+        return tensors
+
+    def last_fetches_are_basic(self):
+        """True if list returned by last get_tensors call does not contain scheduled (print, summary, etc.)
+        tensors"""
+        return self._last_fetches_are_basic
+
+    def _compose_fetches(self, regime, step, with_meta_optimizer):
         tensors = list()
         self._last_run_tensor_order = dict()
         pointer = 0
@@ -869,13 +1051,17 @@ class Handler(object):
             if self._train_tensor_schedule is not None:
                 additional_tensors = self._get_additional_tensors(self._train_tensor_schedule, step, pointer)
                 tensors.extend(additional_tensors)
-        if regime == 'validation':
-            tensors.append(self._hooks['validation_predictions'])
-            current['tensors']['validation_predictions'] = [pointer, pointer + 1]
+        if regime == 'validation' or regime == 'batched_validation':
+            if regime == 'batched_validation':
+                prefix = 'batched_validation_'
+            else:
+                prefix = 'validation_'
+            tensors.append(self._hooks[prefix + 'predictions'])
+            current['tensors'][prefix + 'predictions'] = [pointer, pointer + 1]
             pointer += 1
             for res_type in self._result_types:
-                tensors.append(self._hooks['validation_' + res_type])
-                current['tensors']['validation_' + res_type] = [pointer, pointer + 1]
+                tensors.append(self._hooks[prefix + res_type])
+                current['tensors'][prefix + res_type] = [pointer, pointer + 1]
                 pointer += 1
             self._last_run_tensor_order['basic']['borders'] = [start, pointer]
 
@@ -1237,14 +1423,40 @@ class Handler(object):
                     print_step_number=True,
                     indent=1)
 
+    def _save_aborted_launch(self, hp, aborted, experiment=None):
+        """Appends line '<experiment> <hp values> <step> <reason>' to aborted.txt. experiment is omitted if None"""
+        values = list()
+        if experiment is not None:
+            values.append(experiment)
+        values.extend([hp[key] for key in self._order if key in hp])
+        values.extend([aborted['step'], aborted['reason']])
+        with open(os.path.join(self._save_path, 'aborted.txt'), 'a') as f:
+            f.write(' '.join([str(v) for v in values]) + '\n')
+
     def _process_several_launches_results(self, hp, results):
+        aborted = results.pop('aborted', None)
+        if aborted is not None:
+            self.print_hyper_parameters(hp, self._order)
+            print('launch was aborted on step %s: %s' % (aborted['step'], aborted['reason']))
+            if self._save_path is not None:
+                self._save_aborted_launch(hp, aborted)
         self._environment_instance.append_to_storage(None, launches=(results, hp))
         self._save_launch_results(results, hp)
         self._print_launch_results(results, hp)
+        if self._grid_index is not None:
+            # combination is recorded only after its results are on disk
+            self._results_writer.flush()
+            self._grid_index.add(self._hp_comb_for_grid_index(hp))
 
     def _process_several_optimizer_launches_results(self, hp, results):
         self._environment_instance.append_to_storage(None, launches=(results, hp))
+        experiment = self._experiment_counter
+        aborted = results.pop('aborted', None)
+        if aborted is not None and self._save_path is not None:
+            self._save_aborted_launch(hp, aborted, experiment=experiment)
         self._save_optimizer_launch_results(results, hp)
+        if self._grid_index is not None:
+            self._grid_index.add(self._hp_comb_for_grid_index(hp), experiment=experiment)
 
     def process_results(self, *args, regime=None):
         # print('in Handler.process_results')
@@ -1346,11 +1558,50 @@ class Handler(object):
                             self._environment_instance.get_default_method_parameters('train_optimizer')) + '\n' * 2
                     )
 
+    def log_abort(self, step, reason):
+        if self._verbose:
+            print('\nLaunch is aborted on step %s: %s' % (step, reason))
+        if self._current_log_path is not None:
+            with open(self._current_log_path, 'a') as f:
+                f.write('\naborted on step %s: %s\n' % (step, reason))
+
     def log_finish_time(self):
         if self._current_log_path is not None:
             with open(self._current_log_path, 'a') as f:
                 now = dt.datetime.now()
                 f.write('\nfinish time: ' + str(now) + '\n')
 
+    def save_optimizer_inference_results(self, pupil_name, meta_optimizer_training_step, storage):
+        """Writes results of optimizer inference performed in worker process. storage is a dictionary
+        <regime> -> <result type or 'steps'> -> list of values. Workers do not write files and results store
+        themselves so all writes are done by one process"""
+        if self._save_path is None:
+            return
+        self._check_results_store_process()
+        for regime, regime_res in storage.items():
+            if not isinstance(regime_res, dict) or 'steps' not in regime_res:
+                continue
+            for res_type, values in regime_res.items():
+                if res_type == 'steps':
+                    continue
+                file_name = self._file_names[pupil_name][regime]['results'][res_type] % meta_optimizer_training_step
+                for step, value in zip(regime_res['steps'], values):
+                    self._results_writer.write(file_name, '%s %s\n' % (step, value))
+                    if self._use_results_store:
+                        self._store_rows.append(
+                            (None, pupil_name, regime, res_type, step, float(value), meta_optimizer_training_step))
+        if len(self._store_rows) >= self._store_buffer_size:
+            self._flush_store_rows()
+
+    def flush_results(self):
+        if self._results_writer is not None:
+            self._results_writer.flush()
+            self._flush_store_rows()
+
     def close(self):
-        pass
+        if self._results_writer is not None:
+            self._results_writer.close()
+            self._flush_store_rows()
+            if self._results_store is not None:
+                self._results_store.close()
+                self._results_store = None
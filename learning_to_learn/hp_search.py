@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def encode_hp_combs(hp_combs):
+    """Every hyperparameter is encoded by index of its value among sorted values found in hp_combs divided by
+    number of values minus one. Grids of learning rates and init parameters are usually log spaced so index
+    encoding is close to log scale. Returns array of shape [len(hp_combs), number of hyperparameters]"""
+    names = list(hp_combs[0].keys())
+    columns = list()
+    for name in names:
+        values = list()
+        for hp_comb in hp_combs:
+            if hp_comb[name] not in values:
+                values.append(hp_comb[name])
+        try:
+            values = sorted(values)
+        except TypeError:
+            pass
+        scale = max(len(values) - 1, 1)
+        columns.append([values.index(hp_comb[name]) / scale for hp_comb in hp_combs])
+    return np.array(columns, dtype=np.float64).T.reshape((len(hp_combs), len(names)))
+
+
+class GaussianProcessProposer(object):
+    """Proposes hyperparameter combinations to launch from a finite set of candidates. Score of candidates is
+    modelled by Gaussian process with RBF kernel and candidates with the largest expected improvement are proposed.
+    Lower score is better. Scores are standardized, not finite scores (e.g. of aborted launches) are replaced by the
+    worst finite score. If several candidates are proposed at once predicted means of already chosen candidates are
+    used as their scores (kriging believer)"""
+    def __init__(self, length_scale=.3, noise=1e-2, xi=.01, random_seed=None):
+        self._length_scale = length_scale
+        self._noise = noise
+        self._xi = xi
+        self._random = np.random.RandomState(random_seed)
+
+    def _kernel(self, a, b):
+        sq_dist = np.sum((a[:, None, :] - b[None, :, :]) ** 2, axis=-1)
+        return np.exp(-.5 * sq_dist / self._length_scale ** 2)
+
+    def _predict(self, x, y, candidates):
+        k = self._kernel(x, x) + self._noise * np.eye(len(x))
+        chol = np.linalg.cholesky(k)
+        alpha = np.linalg.solve(chol.T, np.linalg.solve(chol, y))
+        k_star = self._kernel(candidates, x)
+        mean = k_star.dot(alpha)
+        v = np.linalg.solve(chol, k_star.T)
+        var = np.maximum(1. - np.sum(v ** 2, axis=0), 1e-12)
+        return mean, np.sqrt(var)
+
+    @staticmethod
+    def _normal_cdf(z):
+        # Abramowitz and Stegun approximation of erf, scipy is not required
+        t = 1. / (1. + .3275911 * np.abs(z) / np.sqrt(2.))
+        poly = t * (.254829592 + t * (-.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+        erf = 1. - poly * np.exp(-z ** 2 / 2.)
+        return .5 * (1. + np.sign(z) * erf)
+
+    def _expected_improvement(self, mean, std, best):
+        improvement = best - mean - self._xi
+        z = improvement / std
+        pdf = np.exp(-.5 * z ** 2) / np.sqrt(2 * np.pi)
+        return improvement * self._normal_cdf(z) + std * pdf
+
+    def propose(self, encoded_candidates, observed_x, observed_y, num=1, num_random=0):
+        """encoded_candidates are not launched candidates. Returns indices of proposed candidates. If number of
+        observations is less than num_random candidates are chosen randomly"""
+        num = min(num, len(encoded_candidates))
+        if len(observed_y) < max(num_random, 1):
+            return list(self._random.choice(len(encoded_candidates), size=num, replace=False))
+        y = np.array(observed_y, dtype=np.float64)
+        finite = np.isfinite(y)
+        if not np.any(finite):
+            return list(self._random.choice(len(encoded_candidates), size=num, replace=False))
+        y[~finite] = np.max(y[finite])
+        y = (y - np.mean(y)) / (np.std(y) + 1e-12)
+        x = np.array(observed_x, dtype=np.float64)
+        proposed = list()
+        for _ in range(num):
+            mean, std = self._predict(x, y, encoded_candidates)
+            ei = self._expected_improvement(mean, std, np.min(y))
+            ei[proposed] = -np.inf
+            idx = int(np.argmax(ei))
+            proposed.append(idx)
+            x = np.concatenate([x, encoded_candidates[idx:idx + 1]])
+            y = np.concatenate([y, mean[idx:idx + 1]])
+        return proposed
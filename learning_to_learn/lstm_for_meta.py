@@ -6,14 +6,15 @@ from learning_to_learn.useful_functions import create_vocabulary, get_positions_
     pred2vec_fast, vec2char, vec2char_fast, char2id, id2char, get_available_gpus, device_name_scope, \
     average_gradients, get_num_gpus_and_bs_on_gpus, custom_matmul, custom_add, InvalidArgumentError, \
     compose_save_list, compose_reset_list, compose_randomize_list, construct_dict_without_none_entries, \
-    append_to_nested, get_average_with_weights_func, func_on_list_in_nested
+    append_to_nested, get_average_with_weights_func, func_on_list_in_nested, text2ids, load_id_file
+from learning_to_learn.batch_generators import BatchGeneratorSpecsMixin
 
 from learning_to_learn.tensors import compute_metrics
 
 url = 'http://mattmahoney.net/dc/'
 
 
-class LstmBatchGenerator(object):
+class LstmBatchGenerator(BatchGeneratorSpecsMixin):
     @staticmethod
     def create_vocabulary(texts):
         text = ''
@@ -58,6 +59,9 @@ class LstmBatchGenerator(object):
     def get_vocabulary_size(self):
         return self._vocabulary_size
 
+    def _get_num_positions(self):
+        return self._text_size
+
     def _start_batch(self):
         batch = np.zeros(shape=(self._batch_size, self._vocabulary_size), dtype=np.float)
         for b in range(self._batch_size):
@@ -95,7 +99,7 @@ class LstmBatchGenerator(object):
         return np.stack(batches[:-1]), np.concatenate(batches[1:], 0)
 
 
-class LstmFastBatchGenerator(object):
+class LstmFastBatchGenerator(BatchGeneratorSpecsMixin):
     @staticmethod
     def create_vocabulary(texts):
         text = ''
@@ -126,32 +130,46 @@ class LstmFastBatchGenerator(object):
         self.vocabulary = vocabulary
         self._vocabulary_size = len(self.vocabulary)
         self.character_positions_in_vocabulary = get_positions_in_vocabulary(self.vocabulary)
+        self._ids = text2ids(self._text, self.vocabulary)
         self._num_unrollings = num_unrollings
+        # offsets of characters of one window relatively to cursors. Shape is [num_unrollings, 1]
+        self._unrolling_offsets = np.arange(self._num_unrollings).reshape((-1, 1))
         if random_batch_initiation:
-            self._cursor = random.sample(range(self._text_size), batch_size)
+            self._cursor = np.array(random.sample(range(self._text_size), batch_size))
         else:
             segment = self._text_size // batch_size
-            self._cursor = [offset * segment for offset in range(batch_size)]
+            self._cursor = np.arange(batch_size) * segment
         self._last_batch = self._start_batch()
 
     def get_dataset_length(self):
-        return len(self._text)
+        return self._text_size
 
     def get_vocabulary_size(self):
         return self._vocabulary_size
 
+    def get_ids(self):
+        return self._ids
+
+    def get_start_id(self):
+        return 0
+
+    def _get_num_positions(self):
+        return self._text_size
+
+    def _set_num_unrollings(self, num_unrollings):
+        self._num_unrollings = num_unrollings
+        self._unrolling_offsets = np.arange(self._num_unrollings).reshape((-1, 1))
+
     def _start_batch(self):
-        return np.array([[0] for _ in range(self._batch_size)])
+        return np.zeros((self._batch_size, 1), dtype=np.int32)
 
     def _zero_batch(self):
         return -np.ones(shape=(self._batch_size), dtype=np.float)
 
     def _next_batch(self):
         """Generate a single batch from the current cursor position in the data."""
-        ret = np.array([[char2id(self._text[self._cursor[b]], self.character_positions_in_vocabulary)]
-                        for b in range(self._batch_size)])
-        for b in range(self._batch_size):
-            self._cursor[b] = (self._cursor[b] + 1) % self._text_size
+        ret = self._ids[self._cursor].reshape((-1, 1))
+        self._cursor = (self._cursor + 1) % self._text_size
         return ret
 
     def char2batch(self, char):
@@ -160,14 +178,35 @@ class LstmFastBatchGenerator(object):
     def next(self):
         """Generate the next array of batches from the data. The array consists of
         the last batch of the previous array, followed by num_unrollings new ones.
+        Whole window is gathered from id array at once.
         """
-        batches = [self._last_batch]
-        for step in range(self._num_unrollings):
-            batches.append(self._next_batch())
-        self._last_batch = batches[-1]
-        # print('(LstmFastBatchGenerator.next)batches[:-1]:', batches[:-1])
-        # print('(LstmFastBatchGenerator.next)batches[:-1].shape:', [b.shape for b in batches[:-1]])
-        return np.stack(batches[:-1]), np.concatenate(batches[1:], 0)
+        batches = self._ids[(self._cursor + self._unrolling_offsets) % self._text_size]
+        inputs = np.concatenate([self._last_batch.reshape((1, -1)), batches[:-1]], 0)
+        self._last_batch = batches[-1].reshape((-1, 1))
+        self._cursor = (self._cursor + self._num_unrollings) % self._text_size
+        return inputs.reshape((self._num_unrollings, self._batch_size, 1)), batches.reshape((-1, 1))
+
+
+class LstmMemmapBatchGenerator(LstmFastBatchGenerator):
+    """Same as LstmFastBatchGenerator but instead of text a name of file created with
+    useful_functions.create_id_file is passed. Ids are read through np.memmap so grid search subprocesses and
+    exercises share one copy of a dataset."""
+    def __init__(self, id_file_name, batch_size, num_unrollings=1, vocabulary=None, random_batch_initiation=False):
+        self._text = None
+        self._ids = load_id_file(id_file_name)
+        self._text_size = len(self._ids)
+        self._batch_size = batch_size
+        self.vocabulary = vocabulary
+        self._vocabulary_size = len(self.vocabulary)
+        self.character_positions_in_vocabulary = get_positions_in_vocabulary(self.vocabulary)
+        self._num_unrollings = num_unrollings
+        self._unrolling_offsets = np.arange(self._num_unrollings).reshape((-1, 1))
+        if random_batch_initiation:
+            self._cursor = np.array(random.sample(range(self._text_size), batch_size))
+        else:
+            segment = self._text_size // batch_size
+            self._cursor = np.arange(batch_size) * segment
+        self._last_batch = self._start_batch()
 
 
 def characters(probabilities, vocabulary):
@@ -669,6 +708,84 @@ class Lstm(Model):
                     self._hooks['validation_predictions'] = self.sample_prediction
                     for k, v in metrics.items():
                         self._hooks['validation_' + k] = v
+                self._add_metric_accumulators(metrics, 'validation_')
+
+    def _batched_validation_graph(self):
+        """Validation text is split into num_validation_streams parts processed simultaneously. Every stream has its
+        own saved state and num_validation_unrollings characters of every stream are processed in one session.run
+        call. Metrics are averaged over all characters processed during a call."""
+        trainable = self._applicable_trainable
+        num_streams = self._num_validation_streams
+        num_unrollings = self._num_validation_unrollings
+        with tf.device(self._gpu_names[0]):
+            with tf.name_scope('batched_validation'):
+                validation_labels = tf.placeholder(
+                    tf.int32, [num_unrollings * num_streams, 1], name='batched_validation_labels')
+                sample_input = tf.placeholder(
+                    tf.int32, shape=[num_unrollings, num_streams, 1], name='batched_sample_input')
+                inputs = tf.reshape(sample_input, [num_unrollings, num_streams])
+                inputs = tf.one_hot(inputs, self._vocabulary_size)
+                labels = tf.reshape(validation_labels, [num_unrollings * num_streams])
+                validation_labels_prepared = tf.one_hot(labels, self._vocabulary_size)
+
+                self._hooks['batched_validation_inputs'] = sample_input
+                self._hooks['batched_validation_labels'] = validation_labels
+                saved_states = list()
+                for layer_idx, layer_num_nodes in enumerate(self._num_nodes):
+                    saved_states.append(
+                        (tf.Variable(
+                            tf.zeros([num_streams, layer_num_nodes]),
+                            trainable=False,
+                            name='saved_batched_state_%s_%s' % (layer_idx, 0)),
+                         tf.Variable(
+                             tf.zeros([num_streams, layer_num_nodes]),
+                             trainable=False,
+                             name='saved_batched_state_%s_%s' % (layer_idx, 1)))
+                    )
+
+                reset_list = compose_reset_list(saved_states)
+                self._hooks['reset_batched_validation_state'] = tf.group(*reset_list)
+
+                embeddings, _ = self._embed(inputs, trainable['embedding_matrix'])
+                rnn_outputs, new_states, _ = self._rnn_module(
+                    embeddings, saved_states, trainable['lstm_matrices'],
+                    trainable['lstm_biases'])
+                logits, _ = self._output_module(
+                    rnn_outputs, trainable['output_matrices'], trainable['output_biases'])
+
+                save_ops = compose_save_list((saved_states, new_states))
+
+                with tf.control_dependencies(save_ops):
+                    predictions = tf.nn.softmax(logits)
+                    metrics = compute_metrics(
+                        self._additional_metrics + ['loss'],
+                        predictions=predictions,
+                        labels=validation_labels_prepared,
+                        keep_first_dim=False
+                    )
+
+                    self._hooks['batched_validation_predictions'] = predictions
+                    for k, v in metrics.items():
+                        self._hooks['batched_validation_' + k] = v
+                self._add_metric_accumulators(metrics, 'batched_validation_')
+
+    def _add_metric_accumulators(self, metrics, prefix):
+        """Sums of metrics and number of steps are accumulated in variables so validation does not fetch metrics
+        on every step. Hooks: <prefix>accumulate_metrics, reset_<prefix>accumulators and
+        <prefix>accumulated_<metric> (mean of metric since last reset)"""
+        with tf.name_scope('accumulators'):
+            sums = dict()
+            accumulate_ops = list()
+            for k, v in metrics.items():
+                sums[k] = tf.Variable(0., trainable=False, name='%s_sum' % k)
+                accumulate_ops.append(tf.assign_add(sums[k], v))
+            count = tf.Variable(0., trainable=False, name='count')
+            accumulate_ops.append(tf.assign_add(count, 1.))
+            self._hooks[prefix + 'accumulate_metrics'] = tf.group(*accumulate_ops)
+            self._hooks['reset_' + prefix + 'accumulators'] = tf.variables_initializer(
+                list(sums.values()) + [count])
+            for k, s in sums.items():
+                self._hooks[prefix + 'accumulated_' + k] = s / tf.maximum(count, 1.)
 
     def _pack_trainable_to_optimizer_format(self, trainable):
         # print("(Lstm._pack_trainable_to_optimizer_format)trainable:", trainable)
@@ -732,21 +849,44 @@ class Lstm(Model):
         return self._pack_trainable_to_optimizer_format(variables_dictionary), variables_dictionary
 
     @staticmethod
-    def create_saver(var_dict):
+    def _compose_saved_vars(var_dict):
+        """Returns dictionary which maps names of variables in checkpoint to variables"""
+        saved_vars = dict()
+        saved_vars['embedding_matrix'] = var_dict['embedding_matrix']
+        for layer_idx, lstm_matrix in enumerate(var_dict['lstm_matrices']):
+            saved_vars['lstm_matrix_%s' % layer_idx] = lstm_matrix
+            saved_vars['lstm_bias_%s' % layer_idx] = var_dict['lstm_biases'][layer_idx]
+        for layer_idx, (output_matrix, output_bias) in \
+                enumerate(zip(var_dict['output_matrices'], var_dict['output_biases'])):
+            saved_vars['output_matrix_%s' % layer_idx] = output_matrix
+            saved_vars['output_bias_%s' % layer_idx] = output_bias
+        return saved_vars
+
+    @classmethod
+    def create_saver(cls, var_dict):
         # print("(Lstm.create_saver)var_dict:", var_dict)
         with tf.device('/cpu:0'):
-            saved_vars = dict()
-            saved_vars['embedding_matrix'] = var_dict['embedding_matrix']
-            for layer_idx, lstm_matrix in enumerate(var_dict['lstm_matrices']):
-                saved_vars['lstm_matrix_%s' % layer_idx] = lstm_matrix
-                saved_vars['lstm_bias_%s' % layer_idx] = var_dict['lstm_biases'][layer_idx]
-            for layer_idx, (output_matrix, output_bias) in \
-                    enumerate(zip(var_dict['output_matrices'], var_dict['output_biases'])):
-                saved_vars['output_matrix_%s' % layer_idx] = output_matrix
-                saved_vars['output_bias_%s' % layer_idx] = output_bias
+            saved_vars = cls._compose_saved_vars(var_dict)
             saver = tf.train.Saver(saved_vars, max_to_keep=None)
         return saver
 
+    @classmethod
+    def create_restore_from_arrays_op(cls, var_dict, name_scope):
+        """Alternative to saver.restore when checkpoint values are already in memory. Returns dictionary of
+        placeholders with keys equal to names of variables in checkpoint and op assigning placeholders values to
+        variables"""
+        saved_vars = cls._compose_saved_vars(var_dict)
+        placeholders = dict()
+        assign_ops = list()
+        with tf.name_scope(name_scope):
+            for name, var in saved_vars.items():
+                with tf.device(var.device):
+                    placeholders[name] = tf.placeholder(
+                        var.dtype.base_dtype, shape=var.get_shape(), name=name)
+                    assign_ops.append(tf.assign(var, placeholders[name]))
+            restore_op = tf.group(*assign_ops, name='restore_from_arrays')
+        return placeholders, restore_op
+
     def _add_trainable_variables(self):
         trainable = self._applicable_trainable
         var_dict = self._create_trainable_variables_dictionary(self._base_device, 'applicable_trainable')
@@ -802,6 +942,18 @@ class Lstm(Model):
                     tf.int32, shape=[self._num_unrollings * self._batch_size, 1], name='labels')
         return placeholders
 
+    def make_stacked_inputs_and_labels_placeholders(self, device, name_scope, leading_dims):
+        """Placeholders for several exercises and optimizer unrollings fed with one array. leading_dims are
+        prepended to shapes of placeholders created by make_inputs_and_labels_placeholders"""
+        placeholders = dict()
+        with tf.device(device):
+            with tf.name_scope(name_scope):
+                placeholders['inputs'] = tf.placeholder(
+                    tf.int32, shape=list(leading_dims) + [self._num_unrollings, self._batch_size, 1], name='inputs')
+                placeholders['labels'] = tf.placeholder(
+                    tf.int32, shape=list(leading_dims) + [self._num_unrollings * self._batch_size, 1], name='labels')
+        return placeholders
+
     def _add_train_inputs_and_labels_placeholders(self):
         placeholders = self.make_inputs_and_labels_placeholders(self._base_device, 'applicable_placeholders')
         for k, v in placeholders.items():
@@ -875,8 +1027,12 @@ class Lstm(Model):
                  regularization_rate=.000006,
                  additional_metrics=None,
                  regime='autonomous_training',
-                 going_to_limit_memory=False):
-        """4 regimes are possible: autonomous_training, inference, training_with_meta_optimizer, optimizer_training"""
+                 going_to_limit_memory=False,
+                 num_validation_streams=1,
+                 num_validation_unrollings=1):
+        """4 regimes are possible: autonomous_training, inference, training_with_meta_optimizer, optimizer_training
+        If num_validation_streams or num_validation_unrollings is greater than 1 batched validation graph is built
+        additionally. It is used by Environment for validation instead of one character graph"""
 
         if num_nodes is None:
             num_nodes = [112, 113]
@@ -893,9 +1049,14 @@ class Lstm(Model):
         self._num_output_layers = num_output_layers
         self._num_output_nodes = num_output_nodes
         self._num_unrollings = num_unrollings
-        self._init_parameter = init_parameter
-        self._regularization_rate = regularization_rate
+        # init_parameter and regularization_rate can be fed so they can be varied without graph rebuilding.
+        # init_parameter is fed when variables are initialized
+        self._init_parameter = tf.placeholder_with_default(float(init_parameter), [], name='init_parameter')
+        self._regularization_rate = tf.placeholder_with_default(
+            float(regularization_rate), [], name='regularization_rate')
         self._additional_metrics = additional_metrics
+        self._num_validation_streams = num_validation_streams
+        self._num_validation_unrollings = num_validation_unrollings
 
         self._hooks = dict(
             inputs=None,
@@ -912,11 +1073,26 @@ class Lstm(Model):
             reset_validation_state=None,
             reset_pupil_train_state=None,
             randomize_sample_state=None,
+            batched_validation_inputs=None,
+            batched_validation_labels=None,
+            batched_validation_predictions=None,
+            batched_validation_loss=None,
+            reset_batched_validation_state=None,
+            validation_accumulate_metrics=None,
+            reset_validation_accumulators=None,
+            batched_validation_accumulate_metrics=None,
+            reset_batched_validation_accumulators=None,
             dropout=None,
+            init_parameter=self._init_parameter,
+            regularization_rate=self._regularization_rate,
             saver=None)
         for add_metric in self._additional_metrics:
             self._hooks[add_metric] = None
             self._hooks['validation_' + add_metric] = None
+            self._hooks['batched_validation_' + add_metric] = None
+        for metric in self._additional_metrics + ['loss']:
+            self._hooks['validation_accumulated_' + metric] = None
+            self._hooks['batched_validation_accumulated_' + metric] = None
 
         if not going_to_limit_memory:
             gpu_names = get_available_gpus()
@@ -955,11 +1131,15 @@ class Lstm(Model):
             
             self._train_graph()
             self._validation_graph()
+            if self._num_validation_streams * self._num_validation_unrollings > 1:
+                self._batched_validation_graph()
 
         elif regime == 'inference':
             self._add_trainable_variables()
 
             self._validation_graph()
+            if self._num_validation_streams * self._num_validation_unrollings > 1:
+                self._batched_validation_graph()
 
         elif regime == 'training_with_meta_optimizer':
             self._add_trainable_variables()
@@ -967,6 +1147,8 @@ class Lstm(Model):
             self._add_train_inputs_and_labels_placeholders()
 
             self._validation_graph()
+            if self._num_validation_streams * self._num_validation_unrollings > 1:
+                self._batched_validation_graph()
 
         elif regime == 'optimizer_training':
             self._add_trainable_variables()
@@ -974,6 +1156,8 @@ class Lstm(Model):
             self._add_train_inputs_and_labels_placeholders()
 
             self._validation_graph()
+            if self._num_validation_streams * self._num_validation_unrollings > 1:
+                self._batched_validation_graph()
 
         else:
             raise InvalidArgumentError(
@@ -1,9 +1,9 @@
 import tensorflow as tf
 from learning_to_learn.useful_functions import construct, get_keys_from_nested, get_obj_elem_by_path, \
     device_name_scope, write_elem_in_obj_by_path, stop_gradient_in_nested, compose_save_list, average_gradients, \
-    retrieve_from_inner_dicts, distribute_into_inner_dicts, custom_matmul, values_from_nested, sort_lists_map, \
+    retrieve_from_inner_dicts, distribute_into_inner_dicts, values_from_nested, sort_lists_map, \
     global_l2_loss, filter_none_gradients, go_through_nested_with_name_scopes_to_perform_func_and_distribute_results, \
-    global_norm, func_on_list_in_nested, append_to_nested
+    global_norm, func_on_list_in_nested, append_to_nested, permute_last_dim
 
 from learning_to_learn.tensors import compute_metrics
 
@@ -13,6 +13,13 @@ CLIP_NORM = 1e+5
 
 class Meta(object):
 
+    @staticmethod
+    def _create_meta_optimizer_saver(opt_trainable):
+        """Saver of meta optimizer trainable variables. opt_trainable is a nested structure of variables. Saver is
+        used for meta optimizer checkpoints and for passing meta optimizer weights to optimizer inference workers"""
+        variables = [v for v in values_from_nested(opt_trainable) if isinstance(v, tf.Variable)]
+        return tf.train.Saver(variables, max_to_keep=None)
+
     @staticmethod
     def _stack_different_exercises_variables(variables):
         """stack variables from different checkpoints or permutations.
@@ -158,12 +165,20 @@ class Meta(object):
             optimizer_grad_labels,
             pupil_trainable_variables,
             pupil_grad_eval_pupil_storage,
-            optimizer_grad_pupil_storage
+            optimizer_grad_pupil_storage,
+            stacked_placeholders=False,
+            unstack_optimizer_unrollings=True
     ):
-        pupil_grad_eval_inputs = cls._stack_placeholders(gpu_borders, pupil_grad_eval_inputs)
-        pupil_grad_eval_labels = cls._stack_placeholders(gpu_borders, pupil_grad_eval_labels)
-        optimizer_grad_inputs = cls._stack_placeholders(gpu_borders, optimizer_grad_inputs)
-        optimizer_grad_labels = cls._stack_placeholders(gpu_borders, optimizer_grad_labels)
+        if not stacked_placeholders:
+            pupil_grad_eval_inputs = cls._stack_placeholders(gpu_borders, pupil_grad_eval_inputs)
+            pupil_grad_eval_labels = cls._stack_placeholders(gpu_borders, pupil_grad_eval_labels)
+            optimizer_grad_inputs = cls._stack_placeholders(gpu_borders, optimizer_grad_inputs)
+            optimizer_grad_labels = cls._stack_placeholders(gpu_borders, optimizer_grad_labels)
+        elif unstack_optimizer_unrollings:
+            pupil_grad_eval_inputs = cls._unstack_optimizer_unrollings(pupil_grad_eval_inputs)
+            pupil_grad_eval_labels = cls._unstack_optimizer_unrollings(pupil_grad_eval_labels)
+            optimizer_grad_inputs = cls._unstack_optimizer_unrollings(optimizer_grad_inputs)
+            optimizer_grad_labels = cls._unstack_optimizer_unrollings(optimizer_grad_labels)
         pupil_trainable_variables = cls._stack_trainable_variables(gpu_borders, pupil_trainable_variables)
         pupil_grad_eval_pupil_storage = cls._stack_storages(gpu_borders, pupil_grad_eval_pupil_storage)
         optimizer_grad_pupil_storage = cls._stack_storages(gpu_borders, optimizer_grad_pupil_storage)
@@ -245,17 +260,62 @@ class Meta(object):
                             optimizer_grad_inputs.append(placeholders['labels'])
         return pupil_grad_eval_inputs, pupil_grad_eval_labels, optimizer_grad_inputs, optimizer_grad_labels
 
+    def _make_stacked_inputs_and_labels_placeholders(self, pupil, num_unrollings, num_ex_on_gpus):
+        """One placeholder per gpu for all exercises on gpu and all optimizer unrollings. Shapes of inputs and
+        labels placeholders are [ex_on_gpu, num_unrollings] + shape of pupil inputs or labels.
+        Outputs are lists of placeholders (one per gpu)"""
+        pupil_grad_eval_inputs = list()
+        pupil_grad_eval_labels = list()
+
+        optimizer_grad_inputs = list()
+        optimizer_grad_labels = list()
+
+        for gpu_idx, num_ex_on_gpu in enumerate(num_ex_on_gpus):
+            with tf.name_scope('stacked_gpu_%s' % gpu_idx):
+                placeholders = pupil.make_stacked_inputs_and_labels_placeholders(
+                    '/gpu:%s' % gpu_idx, 'pupil_grad_eval_placeholders', [num_ex_on_gpu, num_unrollings])
+                pupil_grad_eval_inputs.append(placeholders['inputs'])
+                pupil_grad_eval_labels.append(placeholders['labels'])
+                if self._share_train_data:
+                    optimizer_grad_inputs.append(placeholders['inputs'])
+                    optimizer_grad_labels.append(placeholders['labels'])
+                else:
+                    placeholders = pupil.make_stacked_inputs_and_labels_placeholders(
+                        '/gpu:%s' % gpu_idx, 'optimizer_grad_placeholders', [num_ex_on_gpu, num_unrollings])
+                    optimizer_grad_inputs.append(placeholders['inputs'])
+                    optimizer_grad_labels.append(placeholders['labels'])
+        return pupil_grad_eval_inputs, pupil_grad_eval_labels, optimizer_grad_inputs, optimizer_grad_labels
+
+    @staticmethod
+    def _unstack_optimizer_unrollings(stacked_placeholders):
+        """Splits stacked placeholders along optimizer unrollings dimension. The result has the same structure as
+        result of _stack_placeholders"""
+        unstacked_by_gpu = list()
+        for gpu_idx, placeholder in enumerate(stacked_placeholders):
+            with tf.device('/gpu:%s' % gpu_idx):
+                unstacked_by_gpu.append(tf.unstack(placeholder, axis=1))
+        return unstacked_by_gpu
+
     @staticmethod
-    def _create_pupil_variables_and_savers(pupil, num_exercises, gpu_map):
+    def _create_pupil_variables_and_savers(pupil, num_exercises, gpu_map, create_restore_ops=False):
+        """If create_restore_ops is False restore placeholders and ops (used by pupil checkpoint cache) are not
+        created and None is returned instead of their lists"""
         trainable = list()
         pupil_grad_eval_pupil_storage = list()
         optimizer_grad_pupil_storage = list()
         savers = list()
         pupil_trainable_initializers = list()
+        restore_placeholders = list() if create_restore_ops else None
+        restore_ops = list() if create_restore_ops else None
         for ex_idx in range(num_exercises):
             tr, tr_pupil_format = pupil.create_trainable_variables_dictionary_for_optimizer(
                 gpu_map[ex_idx], 'trainable_vars_ex_%s' % ex_idx)
             savers.append(pupil.create_saver(tr_pupil_format))
+            if create_restore_ops:
+                placeholders, restore_op = pupil.create_restore_from_arrays_op(
+                    tr_pupil_format, 'restore_from_arrays_ex_%s' % ex_idx)
+                restore_placeholders.append(placeholders)
+                restore_ops.append(restore_op)
             pupil_trainable_initializers.append(
                 tf.variables_initializer(
                     values_from_nested(tr), name='trainable_variables_initializer_for_ex_%s' % ex_idx
@@ -267,13 +327,19 @@ class Meta(object):
             optimizer_grad_pupil_storage.append(
                 pupil.create_storage(gpu_map[ex_idx], 'optimizer_grad_states_ex_%s' % ex_idx))
         return trainable, pupil_grad_eval_pupil_storage, optimizer_grad_pupil_storage, savers,\
-            pupil_trainable_initializers
+            pupil_trainable_initializers, restore_placeholders, restore_ops
 
     def _add_standard_train_hooks(self):
-        self._hooks['pupil_grad_eval_inputs'] = self._pupil_grad_eval_inputs
-        self._hooks['pupil_grad_eval_labels'] = self._pupil_grad_eval_labels
-        self._hooks['optimizer_grad_inputs'] = self._optimizer_grad_inputs
-        self._hooks['optimizer_grad_labels'] = self._optimizer_grad_labels
+        if self._stacked_placeholders:
+            self._hooks['stacked_pupil_grad_eval_inputs'] = self._pupil_grad_eval_inputs
+            self._hooks['stacked_pupil_grad_eval_labels'] = self._pupil_grad_eval_labels
+            self._hooks['stacked_optimizer_grad_inputs'] = self._optimizer_grad_inputs
+            self._hooks['stacked_optimizer_grad_labels'] = self._optimizer_grad_labels
+        else:
+            self._hooks['pupil_grad_eval_inputs'] = self._pupil_grad_eval_inputs
+            self._hooks['pupil_grad_eval_labels'] = self._pupil_grad_eval_labels
+            self._hooks['optimizer_grad_inputs'] = self._optimizer_grad_inputs
+            self._hooks['optimizer_grad_labels'] = self._optimizer_grad_labels
         self._hooks['pupil_savers'] = self._pupil_savers
 
     @staticmethod
@@ -418,6 +484,8 @@ class Meta(object):
 
     @staticmethod
     def _forward_permute(optimizer_ins, in_perm_keys, out_perm_keys, collapse_1st_dim=False):
+        """'in_perm' and 'out_perm' are integer tensors of shape [2, num_exercises, dim]. The first element along
+        first dimension is permutation and the second is its inverse"""
         with tf.name_scope('forward_permute'):
             for k, v in optimizer_ins.items():
                 with tf.name_scope(k):
@@ -425,58 +493,60 @@ class Meta(object):
                         for in_perm_key in in_perm_keys:
                             with tf.name_scope(in_perm_key):
                                 if isinstance(v[in_perm_key], list):
-                                    v[in_perm_key] = [custom_matmul(t, v['in_perm']) for t in v[in_perm_key]]
+                                    v[in_perm_key] = [permute_last_dim(t, v['in_perm'][0]) for t in v[in_perm_key]]
                                     if collapse_1st_dim:
                                         v['o'] = [tf.reshape(vec, vec.get_shape().as_list()[1:]) for vec in v['o']]
                                 else:
-                                    v[in_perm_key] = custom_matmul(v[in_perm_key], v['in_perm'])
+                                    v[in_perm_key] = permute_last_dim(v[in_perm_key], v['in_perm'][0])
                                     if collapse_1st_dim:
                                         v['o'] = tf.reshape(v['o'], v['o'].get_shape().as_list()[1:])
                     if 'out_perm' in v:
                         for out_perm_key in out_perm_keys:
                             with tf.name_scope(out_perm_key):
                                 if isinstance(v[out_perm_key], list):
-                                    v[out_perm_key] = [custom_matmul(t, v['out_perm']) for t in v[out_perm_key]]
+                                    v[out_perm_key] = [
+                                        permute_last_dim(t, v['out_perm'][0]) for t in v[out_perm_key]]
                                     if collapse_1st_dim:
                                         v['sigma'] = [
                                             tf.reshape(vec, vec.get_shape().as_list()[1:]) for vec in v['sigma']]
                                 else:
-                                    v[out_perm_key] = custom_matmul(v[out_perm_key], v['out_perm'])
+                                    v[out_perm_key] = permute_last_dim(v[out_perm_key], v['out_perm'][0])
                                     if collapse_1st_dim:
                                         v['sigma'] = tf.reshape(v['sigma'], v['sigma'].get_shape().as_list()[1:])
         return optimizer_ins
 
     @staticmethod
     def _backward_permute(optimizer_outs, in_perm_keys, out_perm_keys, collapse_1st_dim=False):
+        """Undoes _forward_permute with inverse permutations"""
         with tf.name_scope('backward_permute'):
             for k, v in optimizer_outs.items():
                 with tf.name_scope(k):
                     if 'in_perm' in v:
-                        in_tr = tf.matrix_transpose(v['in_perm'])
+                        in_inv = v['in_perm'][1]
                         for in_perm_key in in_perm_keys:
                             with tf.name_scope(in_perm_key):
                                 if isinstance(v[in_perm_key], list):
-                                    v[in_perm_key] = [custom_matmul(t, in_tr) for t in v[in_perm_key]]
+                                    v[in_perm_key] = [permute_last_dim(t, in_inv) for t in v[in_perm_key]]
                                     if collapse_1st_dim:
                                         v[in_perm_key] = [
                                             tf.reshape(
                                                 vec, vec.get_shape().as_list()[1:]) for vec in v[in_perm_key]]
                                 else:
-                                    v[in_perm_key] = custom_matmul(v[in_perm_key], in_tr)
+                                    v[in_perm_key] = permute_last_dim(v[in_perm_key], in_inv)
                                     if collapse_1st_dim:
                                         v[in_perm_key] = tf.reshape(
                                             v[in_perm_key], v[in_perm_key].get_shape().as_list()[1:])
                     if 'out_perm' in v:
-                        out_tr = tf.matrix_transpose(v['out_perm'])
+                        out_inv = v['out_perm'][1]
                         for out_perm_key in out_perm_keys:
                             with tf.name_scope(out_perm_key):
                                 if isinstance(v[out_perm_key], list):
-                                    v[out_perm_key] = [custom_matmul(t, out_tr) for t in v[out_perm_key]]
+                                    v[out_perm_key] = [permute_last_dim(t, out_inv) for t in v[out_perm_key]]
                                     if collapse_1st_dim:
                                         v[out_perm_key] = [
                                             tf.reshape(vec, vec.get_shape().as_list()[1:]) for vec in v[out_perm_key]]
                                 else:
-                                    v[out_perm_key] = custom_matmul(v[out_perm_key], out_tr)
+                                    v[out_perm_key] = permute_last_dim(v[out_perm_key], out_inv)
                                     if collapse_1st_dim:
                                         v[out_perm_key] = tf.reshape(
                                             v[out_perm_key], v[out_perm_key].get_shape().as_list()[1:])
@@ -627,6 +697,193 @@ class Meta(object):
         grads, _ = tf.clip_by_global_norm(grads, 1.)
         return grads, v
 
+    def _optimizer_unrolling(
+            self, gpu_idx, pupil_grad_eval_inputs, pupil_grad_eval_labels, optimizer_grad_inputs,
+            optimizer_grad_labels, pupil_trainable_variables, pupil_grad_eval_pupil_storage,
+            optimizer_grad_pupil_storage, states):
+        """One step of pupil training performed by optimizer. Returns new pupil trainable variables, new pupil
+        storages, new optimizer states, start and end losses and additional metrics"""
+        optimizer_ins, pupil_grad_eval_pupil_storage, start_loss, start_predictions, start_labels = \
+            self._eval_pupil_gradients_for_optimizer_training(
+                pupil_grad_eval_inputs,
+                pupil_grad_eval_labels,
+                pupil_trainable_variables, pupil_grad_eval_pupil_storage
+            )
+        start_additional_metrics = compute_metrics(
+            self._additional_metrics, start_predictions,
+            start_labels, start_loss, keep_first_dim=True)
+
+        # print("(Meta._optimizer_unrolling)BEFORE OPTIMIZER CORE:")
+        # print_optimizer_ins(optimizer_ins)
+        optimizer_outs, states = self._optimizer_core(
+            optimizer_ins, states, gpu_idx, permute=self._permute)
+        optimizer_outs = self._compose_phi_and_psi(optimizer_outs)
+        optimizer_outs_with_mods = self._compose_mods(optimizer_outs)
+        optimizer_outs_mods_are_applied = self._sub_mods(optimizer_outs_with_mods)
+        new_pupil_trainable = self._filter_opt_flow_dict(
+            optimizer_outs_mods_are_applied, ['matrix', 'bias'])
+
+        end_loss, _, optimizer_grad_pupil_storage, end_predictions, end_labels = \
+            self._pupil.loss_and_opt_ins(
+                optimizer_grad_inputs,
+                optimizer_grad_labels,
+                optimizer_grad_pupil_storage, opt_ins=new_pupil_trainable,
+                name_scope='pupil_loss_after_pupil_modification'
+            )
+        end_additional_metrics = compute_metrics(
+            self._additional_metrics, end_predictions,
+            end_labels, end_loss, keep_first_dim=True)
+        return new_pupil_trainable, pupil_grad_eval_pupil_storage, optimizer_grad_pupil_storage, states, \
+            start_loss, end_loss, start_additional_metrics, end_additional_metrics
+
+    def _recomputed_optimizer_unrolling(self, gpu_idx, *unrolling_args):
+        """Same as _optimizer_unrolling but activations of unrolling are not kept for backward pass. Only inputs of
+        unrolling (pupil variables, storages and optimizer states) are kept and unrolling is computed again when
+        gradients are computed. Optimizer trainable variables are passed to unrolling as inputs so their gradients
+        are computed together with gradients of inputs. Other variables read in unrolling (e.g. permutation
+        matrices) are passed by tf.custom_gradient to grad function in variables argument if they are resource
+        variables. Dropout masks are not reproduced in recomputation"""
+        nest = tf.contrib.framework.nest
+        opt_trainable = self._opt_trainable
+        flat_args = nest.flatten(unrolling_args)
+        num_args = len(flat_args)
+        result_structure = list()
+
+        def unrolling(*flat_inputs):
+            self._opt_trainable = nest.pack_sequence_as(opt_trainable, list(flat_inputs[num_args:]))
+            outer_additional_loss = self._additional_loss
+            self._additional_loss = 0
+            res = self._optimizer_unrolling(
+                gpu_idx, *nest.pack_sequence_as(unrolling_args, list(flat_inputs[:num_args])))
+            res = res + (tf.convert_to_tensor(self._additional_loss, dtype=tf.float32),)
+            self._additional_loss = outer_additional_loss
+            self._opt_trainable = opt_trainable
+            return res
+
+        @tf.custom_gradient
+        def segment(*flat_inputs):
+            res = unrolling(*flat_inputs)
+            result_structure.append(res)
+            flat_res = nest.flatten(res)
+
+            def grad(*dys, **kwargs):
+                # tf.custom_gradient requires variables keyword argument if unrolling reads resource variables
+                variables = kwargs.get('variables')
+                out_idx = [idx for idx, (out, dy) in enumerate(zip(flat_res, dys))
+                           if dy is not None and out.dtype.is_floating]
+                with tf.name_scope('recompute_optimizer_unrolling'):
+                    # recomputation starts only after gradients of unrolling outputs are available
+                    with tf.control_dependencies([dys[idx] for idx in out_idx]):
+                        inputs = [tf.identity(inp) for inp in flat_inputs]
+                    recomputed = nest.flatten(unrolling(*inputs))
+                in_idx = [idx for idx, inp in enumerate(flat_inputs) if inp.dtype.is_floating]
+                if variables is None:
+                    variables = list()
+                var_idx = [idx for idx, v in enumerate(variables) if v.dtype.base_dtype.is_floating]
+                grads = tf.gradients(
+                    [recomputed[idx] for idx in out_idx],
+                    [inputs[idx] for idx in in_idx] + [variables[idx] for idx in var_idx],
+                    grad_ys=[dys[idx] for idx in out_idx]
+                )
+                input_grads = [None] * len(flat_inputs)
+                for idx, g in zip(in_idx, grads[:len(in_idx)]):
+                    input_grads[idx] = g
+                if 'variables' not in kwargs:
+                    return input_grads
+                variable_grads = [None] * len(variables)
+                for idx, g in zip(var_idx, grads[len(in_idx):]):
+                    variable_grads[idx] = g
+                return input_grads, variable_grads
+
+            return flat_res, grad
+
+        flat_res = segment(*(flat_args + nest.flatten(opt_trainable)))
+        res = nest.pack_sequence_as(result_structure[0], list(flat_res))
+        self._additional_loss += res[-1]
+        return res[:-1]
+
+    def _unroll_optimizer_in_loop(
+            self, gpu_idx, pupil_grad_eval_inputs, pupil_grad_eval_labels, optimizer_grad_inputs,
+            optimizer_grad_labels, pupil_trainable_variables, pupil_grad_eval_pupil_storage,
+            optimizer_grad_pupil_storage, states):
+        """Optimizer unrollings are performed inside tf.while_loop so graph size does not depend on number of
+        unrollings. Inputs and labels are stacked placeholders of shape [ex_on_gpu, num_unrollings, ...] and
+        number of unrollings is taken from fed arrays. Start and end losses are stacked along first dimension,
+        additional metrics are averaged over unrollings"""
+        nest = tf.contrib.framework.nest
+        with tf.name_scope('optimizer_unrolling_loop'):
+            num_unrollings = tf.shape(pupil_grad_eval_inputs)[1]
+            metric_arrays = dict()
+            for prefix in ['start', 'end']:
+                metric_arrays[prefix + '_loss'] = tf.TensorArray(tf.float32, size=num_unrollings)
+                metric_arrays[prefix + '_metrics'] = dict(
+                    [(add_metric, tf.TensorArray(tf.float32, size=num_unrollings))
+                     for add_metric in self._additional_metrics])
+            loop_vars = (
+                tf.constant(0),
+                nest.map_structure(tf.identity, pupil_trainable_variables),
+                nest.map_structure(tf.identity, pupil_grad_eval_pupil_storage),
+                nest.map_structure(tf.identity, optimizer_grad_pupil_storage),
+                nest.map_structure(tf.identity, states),
+                tf.constant(0.),
+                metric_arrays
+            )
+
+            def body(unr_idx, trainable, pupil_grad_eval_storage, optimizer_grad_storage, states_, additional_loss,
+                     arrays):
+                # additional loss is accumulated in python attribute by _compose_mods. Tensors created in loop
+                # can not be used outside so the loss is passed through loop variables
+                outer_additional_loss = self._additional_loss
+                self._additional_loss = 0
+                res = self._optimizer_unrolling(
+                    gpu_idx,
+                    tf.gather(pupil_grad_eval_inputs, unr_idx, axis=1),
+                    tf.gather(pupil_grad_eval_labels, unr_idx, axis=1),
+                    tf.gather(optimizer_grad_inputs, unr_idx, axis=1),
+                    tf.gather(optimizer_grad_labels, unr_idx, axis=1),
+                    trainable,
+                    pupil_grad_eval_storage,
+                    optimizer_grad_storage,
+                    states_
+                )
+                additional_loss += self._additional_loss
+                self._additional_loss = outer_additional_loss
+                new_arrays = dict()
+                for prefix, loss, metrics in [('start', res[4], res[6]), ('end', res[5], res[7])]:
+                    new_arrays[prefix + '_loss'] = arrays[prefix + '_loss'].write(unr_idx, loss)
+                    new_arrays[prefix + '_metrics'] = dict(
+                        [(add_metric, arrays[prefix + '_metrics'][add_metric].write(unr_idx, metrics[add_metric]))
+                         for add_metric in self._additional_metrics])
+                # structures returned by pupil may differ from structures of loop variables in type of sequences
+                return (
+                    unr_idx + 1,
+                    nest.pack_sequence_as(trainable, nest.flatten(res[0])),
+                    nest.pack_sequence_as(pupil_grad_eval_storage, nest.flatten(res[1])),
+                    nest.pack_sequence_as(optimizer_grad_storage, nest.flatten(res[2])),
+                    nest.pack_sequence_as(states_, nest.flatten(res[3])),
+                    additional_loss,
+                    new_arrays
+                )
+
+            _, pupil_trainable_variables, pupil_grad_eval_pupil_storage, optimizer_grad_pupil_storage, states, \
+                additional_loss, metric_arrays = tf.while_loop(
+                    lambda unr_idx, *args: unr_idx < num_unrollings,
+                    body,
+                    loop_vars,
+                    swap_memory=self._swap_memory
+                )
+            self._additional_loss += additional_loss
+            start_losses = metric_arrays['start_loss'].stack()
+            end_losses = metric_arrays['end_loss'].stack()
+            start_additional_metrics = dict(
+                [(add_metric, tf.reduce_mean(array.stack()))
+                 for add_metric, array in metric_arrays['start_metrics'].items()])
+            end_additional_metrics = dict(
+                [(add_metric, tf.reduce_mean(array.stack()))
+                 for add_metric, array in metric_arrays['end_metrics'].items()])
+        return pupil_trainable_variables, pupil_grad_eval_pupil_storage, optimizer_grad_pupil_storage, states, \
+            start_losses, end_losses, start_additional_metrics, end_additional_metrics
+
     def _train_graph(self):
         with tf.name_scope('optimizer_train_graph'):
             pupil_grad_eval_inputs, pupil_grad_eval_labels, optimizer_grad_inputs, optimizer_grad_labels, \
@@ -639,7 +896,9 @@ class Meta(object):
                         self._optimizer_grad_labels,
                         self._pupil_trainable_variables,
                         self._pupil_grad_eval_pupil_storage,
-                        self._optimizer_grad_pupil_storage
+                        self._optimizer_grad_pupil_storage,
+                        stacked_placeholders=self._stacked_placeholders,
+                        unstack_optimizer_unrollings=not self._unrolling_loop
                     )
 
             start_losses_by_gpu = list()
@@ -671,58 +930,58 @@ class Meta(object):
                             one_gpu_start_additional_metrics[add_metric] = list()
                             one_gpu_end_additional_metrics[add_metric] = list()
                         # print("(Meta._train_graph)pupil_grad_eval_inputs:", pupil_grad_eval_inputs)
-                        for unr_idx in range(self._num_optimizer_unrollings):
-                            with tf.name_scope('optimizer_unrolling_%s' % unr_idx):
-                                optimizer_ins, pupil_grad_eval_pupil_storage[gpu_idx], start_loss, start_predictions,\
-                                    start_labels = \
-                                        self._eval_pupil_gradients_for_optimizer_training(
+                        if self._unrolling_loop:
+                            new_pupil_trainable, pupil_grad_eval_pupil_storage[gpu_idx], \
+                                optimizer_grad_pupil_storage[gpu_idx], tmp_states, one_gpu_start_losses, \
+                                one_gpu_end_losses, one_gpu_start_additional_metrics, \
+                                one_gpu_end_additional_metrics = self._unroll_optimizer_in_loop(
+                                    gpu_idx,
+                                    pupil_grad_eval_inputs[gpu_idx],
+                                    pupil_grad_eval_labels[gpu_idx],
+                                    optimizer_grad_inputs[gpu_idx],
+                                    optimizer_grad_labels[gpu_idx],
+                                    pupil_trainable_variables[gpu_idx],
+                                    pupil_grad_eval_pupil_storage[gpu_idx],
+                                    optimizer_grad_pupil_storage[gpu_idx],
+                                    tmp_states
+                                )
+                        else:
+                            if self._recompute_unrollings:
+                                optimizer_unrolling = self._recomputed_optimizer_unrolling
+                            else:
+                                optimizer_unrolling = self._optimizer_unrolling
+                            for unr_idx in range(self._num_optimizer_unrollings):
+                                with tf.name_scope('optimizer_unrolling_%s' % unr_idx):
+                                    new_pupil_trainable, pupil_grad_eval_pupil_storage[gpu_idx], \
+                                        optimizer_grad_pupil_storage[gpu_idx], tmp_states, start_loss, end_loss, \
+                                        start_additional_metrics, end_additional_metrics = optimizer_unrolling(
+                                            gpu_idx,
                                             pupil_grad_eval_inputs[gpu_idx][unr_idx],
                                             pupil_grad_eval_labels[gpu_idx][unr_idx],
-                                            pupil_trainable_variables[gpu_idx], pupil_grad_eval_pupil_storage[gpu_idx]
+                                            optimizer_grad_inputs[gpu_idx][unr_idx],
+                                            optimizer_grad_labels[gpu_idx][unr_idx],
+                                            pupil_trainable_variables[gpu_idx],
+                                            pupil_grad_eval_pupil_storage[gpu_idx],
+                                            optimizer_grad_pupil_storage[gpu_idx],
+                                            tmp_states
                                         )
-                                start_additional_metrics = compute_metrics(
-                                    self._additional_metrics, start_predictions,
-                                    start_labels, start_loss, keep_first_dim=True)
-
-                                # print("(Meta._train_graph)pupil_trainable_variables[%s]:" % gpu_idx,
-                                #       pupil_trainable_variables[gpu_idx])
-
-                                # print("(Meta._train_graph)BEFORE OPTIMIZER CORE:")
-                                # print_optimizer_ins(optimizer_ins)
-                                optimizer_outs, tmp_states = self._optimizer_core(
-                                    optimizer_ins, tmp_states, gpu_idx, permute=self._permute)
-                                optimizer_outs = self._compose_phi_and_psi(optimizer_outs)
-                                optimizer_outs_with_mods = self._compose_mods(optimizer_outs)
-                                optimizer_outs_mods_are_applied = self._sub_mods(optimizer_outs_with_mods)
-                                new_pupil_trainable = self._filter_opt_flow_dict(
-                                    optimizer_outs_mods_are_applied, ['matrix', 'bias'])
-
-                                end_loss, _, optimizer_grad_pupil_storage[gpu_idx], end_predictions, end_labels = \
-                                    self._pupil.loss_and_opt_ins(
-                                        optimizer_grad_inputs[gpu_idx][unr_idx],
-                                        optimizer_grad_labels[gpu_idx][unr_idx],
-                                        optimizer_grad_pupil_storage[gpu_idx], opt_ins=new_pupil_trainable,
-                                        name_scope='pupil_loss_after_pupil_modification'
+                                    pupil_trainable_variables[gpu_idx] = new_pupil_trainable
+                                    one_gpu_start_losses.append(start_loss)
+                                    one_gpu_end_losses.append(end_loss)
+                                    one_gpu_start_additional_metrics = append_to_nested(
+                                        one_gpu_start_additional_metrics,
+                                        start_additional_metrics
                                     )
-                                end_additional_metrics = compute_metrics(
-                                    self._additional_metrics, end_predictions,
-                                    end_labels, end_loss, keep_first_dim=True)
-                                # print("(Meta._train_graph)new_pupil_trainable:",
-                                #       new_pupil_trainable)
-
-                                pupil_trainable_variables[gpu_idx] = new_pupil_trainable
-                                one_gpu_start_losses.append(start_loss)
-                                one_gpu_end_losses.append(end_loss)
-                                one_gpu_start_additional_metrics = append_to_nested(
-                                    one_gpu_start_additional_metrics,
-                                    start_additional_metrics
-                                )
-                                one_gpu_end_additional_metrics = append_to_nested(
-                                    one_gpu_end_additional_metrics,
-                                    end_additional_metrics
-                                )
-                        one_gpu_start_losses = tf.stack(one_gpu_start_losses)
-                        one_gpu_end_losses = tf.stack(one_gpu_end_losses)
+                                    one_gpu_end_additional_metrics = append_to_nested(
+                                        one_gpu_end_additional_metrics,
+                                        end_additional_metrics
+                                    )
+                            one_gpu_start_losses = tf.stack(one_gpu_start_losses)
+                            one_gpu_end_losses = tf.stack(one_gpu_end_losses)
+                            one_gpu_start_additional_metrics = func_on_list_in_nested(
+                                one_gpu_start_additional_metrics, tf.reduce_mean)
+                            one_gpu_end_additional_metrics = func_on_list_in_nested(
+                                one_gpu_end_additional_metrics, tf.reduce_mean)
 
                         # with tf.device('/cpu:0'):
                         #     one_gpu_start_losses = tf.Print(
@@ -740,11 +999,6 @@ class Meta(object):
                         train_optimizer_loss = one_gpu_end_loss + self._l2_loss(self._regularization_rate)
                         one_gpu_start_loss = tf.reduce_mean(one_gpu_start_losses)
 
-                        one_gpu_start_additional_metrics = func_on_list_in_nested(
-                            one_gpu_start_additional_metrics, tf.reduce_mean)
-                        one_gpu_end_additional_metrics = func_on_list_in_nested(
-                            one_gpu_end_additional_metrics, tf.reduce_mean)
-
                         new_pupil_trainable = self._retrieve_and_unstack_trainable_variables(
                             self._num_exercises, new_pupil_trainable)
                         # print("(Meta._train_graph)pupil_grad_eval_pupil_storage (before unstacking):",
@@ -0,0 +1,110 @@
+import queue
+import threading
+
+
+class PrefetchingBatchGenerator(object):
+    """Wraps batch generator instance and calls its next method in a background thread. Produced batches are put
+    into bounded queue so batch generation overlaps with session.run. All attributes except for next,
+    change_batch_size, change_specs are taken from wrapped generator.
+    If wrapped generator has get_cursor_state and set_cursor_state methods, state of generator after every
+    prefetched batch is put into queue with the batch. Consumer remembers state after last consumed batch and
+    generator is rewound to it when batch size or specs are changed, so no data is skipped or repeated. Otherwise
+    already prefetched batches are dropped.
+    Statistics for tuning queue size are returned by get_stats method:
+        num_requests: number of next calls
+        num_starvations: number of next calls on which queue was empty (training waited for batch)
+        mean_queue_depth: average number of ready batches found in queue on next call"""
+    def __init__(self, batch_gen, queue_size=2):
+        self._batch_gen = batch_gen
+        self._queue_size = queue_size
+        self._num_requests = 0
+        self._num_starvations = 0
+        self._accumulated_depth = 0
+        self._queue = None
+        self._stop_event = None
+        self._worker = None
+        self._rewindable = hasattr(batch_gen, 'get_cursor_state') and hasattr(batch_gen, 'set_cursor_state')
+        # state of generator after last batch returned by next. Is updated only by consumer thread
+        self._consumed_state = None
+        self._start()
+
+    def _start(self):
+        if self._rewindable:
+            self._consumed_state = self._batch_gen.get_cursor_state()
+        self._queue = queue.Queue(maxsize=self._queue_size)
+        self._stop_event = threading.Event()
+        self._worker = threading.Thread(target=self._fill_queue, args=(self._queue, self._stop_event))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _fill_queue(self, queue_, stop_event):
+        while not stop_event.is_set():
+            try:
+                batch = self._batch_gen.next()
+                state = self._batch_gen.get_cursor_state() if self._rewindable else None
+            except Exception as e:
+                # exception is passed to the consumer and raised in next
+                batch, state = e, None
+            while not stop_event.is_set():
+                try:
+                    queue_.put((state, batch), timeout=.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def _stop(self):
+        if self._worker is not None:
+            self._stop_event.set()
+            self._worker.join()
+            self._worker = None
+
+    def _rewind(self):
+        """Returns wrapped generator to state after last consumed batch. Worker has to be stopped"""
+        self._batch_gen.set_cursor_state(self._consumed_state)
+
+    def next(self):
+        depth = self._queue.qsize()
+        self._num_requests += 1
+        self._accumulated_depth += depth
+        if depth == 0:
+            self._num_starvations += 1
+        state, batch = self._queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        self._consumed_state = state
+        return batch
+
+    def change_batch_size(self, batch_size):
+        """Already prefetched batches are regenerated with new batch size"""
+        self._stop()
+        if self._rewindable:
+            self._rewind()
+        self._batch_gen.change_batch_size(batch_size)
+        self._start()
+
+    def change_specs(self, **kwargs):
+        """Already prefetched batches are regenerated with new specs"""
+        self._stop()
+        if self._rewindable:
+            self._rewind()
+        self._batch_gen.change_specs(**kwargs)
+        self._start()
+
+    def get_stats(self):
+        if self._num_requests > 0:
+            mean_queue_depth = self._accumulated_depth / self._num_requests
+        else:
+            mean_queue_depth = 0.
+        return dict(
+            num_requests=self._num_requests,
+            num_starvations=self._num_starvations,
+            mean_queue_depth=mean_queue_depth
+        )
+
+    def close(self):
+        self._stop()
+
+    def __getattr__(self, name):
+        return getattr(self._batch_gen, name)
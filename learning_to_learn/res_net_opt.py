@@ -1,8 +1,8 @@
 from itertools import chain
 
 import tensorflow as tf
-from learning_to_learn.useful_functions import block_diagonal, custom_matmul, custom_add, flatten, \
-    construct_dict_without_none_entries, construct
+from learning_to_learn.useful_functions import custom_matmul, custom_add, flatten, \
+    construct_dict_without_none_entries, construct, InvalidArgumentError
 
 from learning_to_learn.meta import Meta
 
@@ -51,11 +51,15 @@ class ResNet4Lstm(Meta):
 
     @staticmethod
     def _create_permutation_matrix(size, num_exercises):
+        """Permutations are kept as integer indices. Returns tensor of shape [2, num_exercises, size] where
+        the first element is random permutation and the second is its inverse"""
         with tf.device('/cpu:0'):
             map_ = tf.stack(
                 [tf.random_shuffle([i for i in range(size)])
                  for _ in range(num_exercises)])
-        return tf.one_hot(map_, size)
+            # indices which sort permutation make inverse permutation
+            inverse = tf.nn.top_k(-map_, k=size, sorted=True).indices
+        return tf.stack([map_, inverse])
 
     def _reset_permutations(self, gpu_idx):
         variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='permutation_matrices_on_gpu_%s' % gpu_idx)
@@ -63,7 +67,7 @@ class ResNet4Lstm(Meta):
         for v in variables:
             v_shape = v.get_shape().as_list()
             reset_ops.append(
-                tf.assign(v, self._create_permutation_matrix(v_shape[1], v_shape[0]))
+                tf.assign(v, self._create_permutation_matrix(v_shape[2], v_shape[1]))
             )
         return reset_ops
 
@@ -75,18 +79,21 @@ class ResNet4Lstm(Meta):
                 _ = tf.get_variable(
                     'embedding',
                     initializer=self._create_permutation_matrix(self._pupil_net_size['embedding_size'], num_exercises),
+                    dtype=tf.int32,
                     trainable=False
                 )
             for layer_idx in range(self._pupil_net_size['num_layers']):
                 _ = tf.get_variable(
                     'c_%s' % layer_idx,
                     initializer=self._create_permutation_matrix(num_nodes[layer_idx], num_exercises),
+                    dtype=tf.int32,
                     trainable=False
                 )
             for layer_idx in range(self._pupil_net_size['num_output_layers'] - 1):
                 _ = tf.get_variable(
                     'h_%s' % layer_idx,
                     initializer=self._create_permutation_matrix(num_output_nodes[layer_idx], num_exercises),
+                    dtype=tf.int32,
                     trainable=False
                 )
 
@@ -96,6 +103,19 @@ class ResNet4Lstm(Meta):
             reset_ops.extend(self._reset_permutations(gpu_idx))
         return reset_ops
 
+    @staticmethod
+    def _block_permutation(permutations):
+        """Analog of block diagonal matrix for permutations kept as indices. Indices of every block are shifted
+        by total size of previous blocks"""
+        if len(permutations) == 1:
+            return permutations[0]
+        shifted = list()
+        offset = 0
+        for perm in permutations:
+            shifted.append(perm + offset)
+            offset += perm.get_shape().as_list()[-1]
+        return tf.concat(shifted, -1)
+
     def _extend_with_permutations(self, optimizer_ins, gpu_idx):
         num_layers = self._pupil_net_size['num_layers']
         num_output_layers = self._pupil_net_size['num_output_layers']
@@ -110,18 +130,18 @@ class ResNet4Lstm(Meta):
                 output_layers.append(tf.get_variable('h_%s' % layer_idx))
         if self._emb_layer_is_present:
             optimizer_ins['embedding_layer']['out_perm'] = emb
-            optimizer_ins['lstm_layer_0']['in_perm'] = block_diagonal([emb, lstm_layers[0]])
+            optimizer_ins['lstm_layer_0']['in_perm'] = self._block_permutation([emb, lstm_layers[0]])
         for layer_idx, c in enumerate(lstm_layers):
-            optimizer_ins['lstm_layer_%s' % layer_idx]['out_perm'] = block_diagonal(
+            optimizer_ins['lstm_layer_%s' % layer_idx]['out_perm'] = self._block_permutation(
                 [c] * 4
             )
             if layer_idx < num_layers - 1:
-                optimizer_ins['lstm_layer_%s' % (layer_idx+1)]['in_perm'] = block_diagonal(
+                optimizer_ins['lstm_layer_%s' % (layer_idx+1)]['in_perm'] = self._block_permutation(
                     [c, lstm_layers[layer_idx+1]])
         optimizer_ins['output_layer_0']['in_perm'] = lstm_layers[-1]
-        for layer_idx, h in output_layers:
+        for layer_idx, h in enumerate(output_layers):
             optimizer_ins['output_layer_%s' % layer_idx]['out_perm'] = h
-            optimizer_ins['output_layer_%s' % (layer_idx+1)]['out_perm'] = output_layers[layer_idx+1]
+            optimizer_ins['output_layer_%s' % (layer_idx+1)]['in_perm'] = h
         return optimizer_ins
 
     @staticmethod
@@ -290,13 +310,15 @@ class ResNet4Lstm(Meta):
 
     # @staticmethod
     # def _apply_res_core(vars, opt_ins, rnn_part, target, scope, target_dims):
-    def _apply_res_core(self, vars, opt_ins, rnn_part, target, scope, target_dims):
+    def _get_res_core_activation_func(self):
         if self._res_core_activation_func == 'relu':
-            a_func = tf.nn.relu
+            return tf.nn.relu
         elif self._res_core_activation_func == 'tanh':
-            a_func = tf.tanh
-        else:
-            a_func = None
+            return tf.tanh
+        return None
+
+    def _apply_res_core(self, vars, opt_ins, rnn_part, target, scope, target_dims):
+        a_func = self._get_res_core_activation_func()
         with tf.name_scope(scope):
             # print("\n(ResNet4Lstm._apply_res_core)rnn_part:", rnn_part)
             # print('(ResNet4Lstm._apply_res_core)opt_ins:', opt_ins)
@@ -327,7 +349,8 @@ class ResNet4Lstm(Meta):
                 #         )
 
                 matmul_res = custom_matmul(hs, m)
-                if idx == 0:
+                # tensors created inside tf.while_loop or recomputed unrolling can not be used outside of it
+                if idx == 0 and not self._unrolling_loop and not self._recompute_unrollings:
                     self._debug_tensors.append(matmul_res)
                 hs = a_func(custom_add(matmul_res, b))
                 # hs = tf.tanh(custom_add(matmul_res, b))
@@ -350,121 +373,166 @@ class ResNet4Lstm(Meta):
             #         sigma, [sigma], message='(ResNetOpt._apply_res_core)(scope=%s)sigma: ' % scope, summarize=10)
             return o, sigma, rnn_part
 
-    def _apply_res_layer(self, ins, res_vars, rnn_part, scope):
-        with tf.name_scope(scope):
-            outs = construct(ins)
-            if self._emb_layer_is_present:
-                core_inps = [
-                    ins['embedding_layer']['o_c'],
-                    ins['embedding_layer']['sigma_c'],
-                    ins['lstm_layer_0']['o_c'],
-                    ins['lstm_layer_0']['sigma_c']
-                ]
-                target = [
-                    ins['embedding_layer']['o_c'],
-                    ins['embedding_layer']['sigma_c']
-                ]
-                # print('(ResNet4Lstm._apply_res_layer)core_inps:', core_inps)
-                # print('(ResNet4Lstm._apply_res_layer)res_vars:', res_vars)
-                o, sigma, emb_rnn_part = self._apply_res_core(
-                    res_vars['embedding_layer'], core_inps, rnn_part, target,
-                    'embedding_layer', self._pupil_dims['embedding_layer'])
-                outs['embedding_layer']['o_c'] = o
-                outs['embedding_layer']['sigma_c'] = sigma
-            else:
-                emb_rnn_part = 0
-
-            lstm_rnn_parts = list()
-            for layer_idx in range(self._pupil_net_size['num_layers']):
-                if layer_idx == 0:
-                    if self._emb_layer_is_present:
-                        previous_layer_tensors = [
-                            ins['embedding_layer']['o_c'],
-                            ins['embedding_layer']['sigma_c']
-                        ]
-                    else:
-                        previous_layer_tensors = []
-                else:
+    def _res_core_inputs(self, ins):
+        """Returns list of tuples (layer_name, core_inps, target, target_dims) for all pupil layers in order
+        embedding layer, lstm layers, output layers"""
+        cores = list()
+        if self._emb_layer_is_present:
+            core_inps = [
+                ins['embedding_layer']['o_c'],
+                ins['embedding_layer']['sigma_c'],
+                ins['lstm_layer_0']['o_c'],
+                ins['lstm_layer_0']['sigma_c']
+            ]
+            target = [
+                ins['embedding_layer']['o_c'],
+                ins['embedding_layer']['sigma_c']
+            ]
+            cores.append(('embedding_layer', core_inps, target, self._pupil_dims['embedding_layer']))
+
+        for layer_idx in range(self._pupil_net_size['num_layers']):
+            if layer_idx == 0:
+                if self._emb_layer_is_present:
                     previous_layer_tensors = [
-                        ins['lstm_layer_%s' % (layer_idx - 1)]['o_c'],
-                        ins['lstm_layer_%s' % (layer_idx - 1)]['sigma_c']
-                    ]
-                if layer_idx == self._pupil_net_size['num_layers'] - 1:
-                    next_layer_tensors = [
-                        ins['output_layer_0']['o_c'],
-                        ins['output_layer_0']['sigma_c']
+                        ins['embedding_layer']['o_c'],
+                        ins['embedding_layer']['sigma_c']
                     ]
                 else:
-                    next_layer_tensors = [
-                        ins['lstm_layer_%s' % (layer_idx + 1)]['o_c'],
-                        ins['lstm_layer_%s' % (layer_idx + 1)]['sigma_c']
-                    ]
-                layer_name = 'lstm_layer_%s' % layer_idx
-                core_inps = [
-                    *previous_layer_tensors,
-                    ins[layer_name]['o_c'],
-                    ins[layer_name]['sigma_c'],
-                    self._pad(ins[layer_name]['o_c'], -1),
-                    self._pad(ins[layer_name]['sigma_c'], -1),
-                    self._pad(ins[layer_name]['o_c'], 1),
-                    self._pad(ins[layer_name]['sigma_c'], 1),
-                    *next_layer_tensors
+                    previous_layer_tensors = []
+            else:
+                previous_layer_tensors = [
+                    ins['lstm_layer_%s' % (layer_idx - 1)]['o_c'],
+                    ins['lstm_layer_%s' % (layer_idx - 1)]['sigma_c']
                 ]
-                target = [
-                    ins[layer_name]['o_c'],
-                    ins[layer_name]['sigma_c']
+            if layer_idx == self._pupil_net_size['num_layers'] - 1:
+                next_layer_tensors = [
+                    ins['output_layer_0']['o_c'],
+                    ins['output_layer_0']['sigma_c']
                 ]
-                o, sigma, lstm_rnn_part = self._apply_res_core(
-                    res_vars[layer_name], core_inps, rnn_part, target,
-                    layer_name, self._pupil_dims['lstm_layers'][layer_idx])
-                lstm_rnn_parts.append(lstm_rnn_part)
-                outs[layer_name]['o_c'] = o
-                outs[layer_name]['sigma_c'] = sigma
-
-            output_rnn_parts = list()
-            for layer_idx in range(self._pupil_net_size['num_output_layers']):
-                if layer_idx == 0:
-                    previous_layer_tensors = [
-                        ins['lstm_layer_%s' % (self._pupil_net_size['num_layers'] - 1)]['o_c'],
-                        ins['lstm_layer_%s' % (self._pupil_net_size['num_layers'] - 1)]['sigma_c']
-                    ]
-                else:
-                    previous_layer_tensors = [
-                        ins['output_layer_%s' % (layer_idx - 1)]['o_c'],
-                        ins['output_layer_%s' % (layer_idx - 1)]['sigma_c']
-                    ]
-                if layer_idx == self._pupil_net_size['num_output_layers'] - 1:
-                    next_layer_tensors = []
-                else:
-                    next_layer_tensors = [
-                        ins['output_layer_%s' % (layer_idx + 1)]['o_c'],
-                        ins['output_layer_%s' % (layer_idx + 1)]['sigma_c']
-                    ]
-                core_inps = [
-                    *previous_layer_tensors,
-                    ins['output_layer_%s' % layer_idx]['o_c'],
-                    ins['output_layer_%s' % layer_idx]['sigma_c'],
-                    *next_layer_tensors
+            else:
+                next_layer_tensors = [
+                    ins['lstm_layer_%s' % (layer_idx + 1)]['o_c'],
+                    ins['lstm_layer_%s' % (layer_idx + 1)]['sigma_c']
+                ]
+            layer_name = 'lstm_layer_%s' % layer_idx
+            core_inps = [
+                *previous_layer_tensors,
+                ins[layer_name]['o_c'],
+                ins[layer_name]['sigma_c'],
+                self._pad(ins[layer_name]['o_c'], -1),
+                self._pad(ins[layer_name]['sigma_c'], -1),
+                self._pad(ins[layer_name]['o_c'], 1),
+                self._pad(ins[layer_name]['sigma_c'], 1),
+                *next_layer_tensors
+            ]
+            target = [
+                ins[layer_name]['o_c'],
+                ins[layer_name]['sigma_c']
+            ]
+            cores.append((layer_name, core_inps, target, self._pupil_dims['lstm_layers'][layer_idx]))
+
+        for layer_idx in range(self._pupil_net_size['num_output_layers']):
+            if layer_idx == 0:
+                previous_layer_tensors = [
+                    ins['lstm_layer_%s' % (self._pupil_net_size['num_layers'] - 1)]['o_c'],
+                    ins['lstm_layer_%s' % (self._pupil_net_size['num_layers'] - 1)]['sigma_c']
                 ]
-                target = [
-                    ins['output_layer_%s' % layer_idx]['o_c'],
-                    ins['output_layer_%s' % layer_idx]['sigma_c']
+            else:
+                previous_layer_tensors = [
+                    ins['output_layer_%s' % (layer_idx - 1)]['o_c'],
+                    ins['output_layer_%s' % (layer_idx - 1)]['sigma_c']
+                ]
+            if layer_idx == self._pupil_net_size['num_output_layers'] - 1:
+                next_layer_tensors = []
+            else:
+                next_layer_tensors = [
+                    ins['output_layer_%s' % (layer_idx + 1)]['o_c'],
+                    ins['output_layer_%s' % (layer_idx + 1)]['sigma_c']
                 ]
-                layer_name = 'output_layer_%s' % layer_idx
-                # print("(ResNet4Lstm._apply_res_layer)layer_idx:", layer_idx)
-                # print("(ResNet4Lstm._apply_res_layer)core_inps:", core_inps)
-                # print("(ResNet4Lstm._apply_res_layer)rnn_part:", rnn_part)
-                o, sigma, output_rnn_part = self._apply_res_core(
-                    res_vars[layer_name], core_inps, rnn_part, target,
-                    layer_name, self._pupil_dims['output_layers'][layer_idx])
-                output_rnn_parts.append(output_rnn_part)
-                layer_name = 'output_layer_%s' % layer_idx
+            layer_name = 'output_layer_%s' % layer_idx
+            core_inps = [
+                *previous_layer_tensors,
+                ins[layer_name]['o_c'],
+                ins[layer_name]['sigma_c'],
+                *next_layer_tensors
+            ]
+            target = [
+                ins[layer_name]['o_c'],
+                ins[layer_name]['sigma_c']
+            ]
+            cores.append((layer_name, core_inps, target, self._pupil_dims['output_layers'][layer_idx]))
+        return cores
+
+    def _apply_fused_res_cores(self, res_vars, cores, rnn_part):
+        """Does the same as _apply_res_core called for every pupil layer but with several large batched matmuls.
+        Core inputs of all layers are padded with zeros to the same number of rows and features and stacked. Core
+        variables are padded with zeros so padded features do not change results. Padded rows are cut from
+        results. Returns list of (o, sigma, rnn_part) tuples in order of cores"""
+        a_func = self._get_res_core_activation_func()
+        with tf.name_scope('fused_res_cores'):
+            hs_by_layers = list()
+            for _, core_inps, _, _ in cores:
+                opt_ins_united = tf.concat(core_inps, -1)
+                rnn_stack_num = opt_ins_united.get_shape().as_list()[-2]
+                stacked_rnn_part = tf.stack([rnn_part] * rnn_stack_num, axis=-2)
+                hs_by_layers.append(tf.concat([opt_ins_united, stacked_rnn_part], -1))
+            shapes = [hs.get_shape().as_list() for hs in hs_by_layers]
+            batch_shape = shapes[0][:-2]
+            max_rows = max([shape[-2] for shape in shapes])
+            max_features = max([shape[-1] for shape in shapes])
+            hs = tf.stack(
+                [tf.pad(hs, [[0, 0]] * len(batch_shape) + [[0, max_rows - shape[-2]], [0, max_features - shape[-1]]])
+                 for hs, shape in zip(hs_by_layers, shapes)],
+                name='stacked_core_inputs'
+            )
+            hs = tf.reshape(hs, [len(cores), -1, max_features])
+            num_core_layers = len(res_vars[cores[0][0]][0])
+            for idx in range(num_core_layers):
+                in_dim = hs.get_shape().as_list()[-1]
+                matrices = [res_vars[layer_name][0][idx] for layer_name, _, _, _ in cores]
+                biases = [res_vars[layer_name][1][idx] for layer_name, _, _, _ in cores]
+                out_dim = max([m.get_shape().as_list()[-1] for m in matrices])
+                matrix = tf.stack(
+                    [tf.pad(m, [[0, in_dim - m.get_shape().as_list()[0]], [0, out_dim - m.get_shape().as_list()[1]]])
+                     for m in matrices])
+                bias = tf.stack([tf.pad(b, [[0, out_dim - b.get_shape().as_list()[0]]]) for b in biases])
+                hs = a_func(tf.matmul(hs, matrix) + tf.expand_dims(bias, 1))
+            hs = tf.reshape(hs, [len(cores)] + batch_shape + [max_rows, hs.get_shape().as_list()[-1]])
+
+            results = list()
+            for layer_idx, ((layer_name, _, target, target_dims), shape) in enumerate(zip(cores, shapes)):
+                with tf.name_scope(layer_name):
+                    layer_out_dim = res_vars[layer_name][0][-1].get_shape().as_list()[-1]
+                    layer_hs = hs[layer_idx][..., :shape[-2], :layer_out_dim]
+                    rnn_part_dim = layer_out_dim - sum(target_dims)
+                    layer_hs = tf.add(
+                        layer_hs,
+                        tf.concat(target + [tf.zeros(shape[:-1] + [rnn_part_dim])], -1, name='res_tensor'),
+                        name='after_res_conn'
+                    )
+                    results.append(
+                        tuple(tf.split(
+                            layer_hs, list(target_dims) + [rnn_part_dim], axis=-1, name='o_sigma_and_rnn_part')))
+        return results
+
+    def _apply_res_layer(self, ins, res_vars, rnn_part, scope, fuse_res_cores=None):
+        if fuse_res_cores is None:
+            fuse_res_cores = self._fuse_res_cores
+        with tf.name_scope(scope):
+            outs = construct(ins)
+            cores = self._res_core_inputs(ins)
+            if fuse_res_cores:
+                results = self._apply_fused_res_cores(res_vars, cores, rnn_part)
+            else:
+                results = [
+                    self._apply_res_core(res_vars[layer_name], core_inps, rnn_part, target, layer_name, target_dims)
+                    for layer_name, core_inps, target, target_dims in cores]
+            rnn_parts = list()
+            for (layer_name, _, _, _), (o, sigma, core_rnn_part) in zip(cores, results):
                 outs[layer_name]['o_c'] = o
                 outs[layer_name]['sigma_c'] = sigma
-            # print("(ResNet4Lstm._apply_res_layer)emb_rnn_part:", emb_rnn_part)
-            # print("(ResNet4Lstm._apply_res_layer)lstm_rnn_parts:", lstm_rnn_parts)
-            # print("(ResNet4Lstm._apply_res_layer)output_rnn_parts:", output_rnn_parts)
-            return outs, emb_rnn_part + sum(lstm_rnn_parts + output_rnn_parts)
+                rnn_parts.append(core_rnn_part)
+            return outs, sum(rnn_parts)
 
     def _apply_lstm_layer(self, inp, state, matrix, bias, scope='lstm'):
         with tf.name_scope(scope):
@@ -544,7 +612,13 @@ class ResNet4Lstm(Meta):
             share_train_data=False,
             regime='train',
             optimizer_for_opt_type='adam',
-            additional_metrics=None
+            additional_metrics=None,
+            stacked_placeholders=False,
+            unrolling_loop=False,
+            swap_memory=True,
+            recompute_unrollings=False,
+            fuse_res_cores=False,
+            pupil_checkpoint_cache=False
     ):
         if additional_metrics is None:
             additional_metrics = list()
@@ -565,11 +639,37 @@ class ResNet4Lstm(Meta):
             self._base_device = '/gpu:0'
         else:
             self._base_device = '/cpu:0'
-        self._regularization_rate = regularization_rate
-        self._clip_norm = clip_norm
-        self._optimizer_init_parameter = optimizer_init_parameter
+        # these parameters can be fed so they can be varied without graph rebuilding. optimizer_init_parameter is
+        # fed when variables are initialized
+        self._regularization_rate = tf.placeholder_with_default(
+            float(regularization_rate), [], name='optimizer_regularization_rate')
+        self._clip_norm = tf.placeholder_with_default(float(clip_norm), [], name='clip_norm')
+        self._optimizer_init_parameter = tf.placeholder_with_default(
+            float(optimizer_init_parameter), [], name='optimizer_init_parameter')
         self._permute = permute
         self._share_train_data = share_train_data
+        # if unrolling_loop is True optimizer unrollings are performed by tf.while_loop. It requires stacked
+        # placeholders which number of unrollings dimension is not fixed so number of unrollings can be changed
+        # without graph rebuilding
+        self._unrolling_loop = unrolling_loop
+        self._swap_memory = swap_memory
+        # if recompute_unrollings is True activations of optimizer unrollings are not kept until gradients of
+        # optimizer are computed. They are computed again unrolling by unrolling during backward pass
+        if recompute_unrollings and unrolling_loop:
+            raise InvalidArgumentError(
+                'Recomputation of unrollings is not supported if unrollings are performed in tf.while_loop. '
+                'Use swap_memory instead',
+                (recompute_unrollings, unrolling_loop),
+                ('recompute_unrollings', 'unrolling_loop'),
+                'only one of recompute_unrollings and unrolling_loop can be True'
+            )
+        self._recompute_unrollings = recompute_unrollings
+        # if fuse_res_cores is True res cores of all pupil layers are applied with batched matmuls
+        self._fuse_res_cores = fuse_res_cores
+        # ops for assigning pupil variables from arrays are required if train_optimizer is called with
+        # use_pupil_checkpoint_cache=True
+        self._pupil_checkpoint_cache = pupil_checkpoint_cache
+        self._stacked_placeholders = stacked_placeholders or unrolling_loop
         self._regime = regime
 
         self._optimizer_for_opt_type = optimizer_for_opt_type
@@ -581,6 +681,10 @@ class ResNet4Lstm(Meta):
             pupil_grad_eval_labels=None,
             optimizer_grad_inputs=None,
             optimizer_grad_labels=None,
+            stacked_pupil_grad_eval_inputs=None,
+            stacked_pupil_grad_eval_labels=None,
+            stacked_optimizer_grad_inputs=None,
+            stacked_optimizer_grad_labels=None,
             pupil_savers=None,
             optimizer_train_op=None,
             learning_rate_for_optimizer_training=None,
@@ -596,7 +700,13 @@ class ResNet4Lstm(Meta):
             start_loss=None,
             end_loss=None,
             optimizer_dropout_keep_prob=None,
-            pupil_trainable_initializers=None
+            pupil_trainable_initializers=None,
+            pupil_restore_placeholders=None,
+            pupil_restore_ops=None,
+            optimizer_regularization_rate=self._regularization_rate,
+            clip_norm=self._clip_norm,
+            optimizer_init_parameter=self._optimizer_init_parameter,
+            num_optimizer_unrollings=self._num_optimizer_unrollings
         )
         for add_metric in self._additional_metrics:
             self._hooks['start_' + add_metric] = None
@@ -615,17 +725,26 @@ class ResNet4Lstm(Meta):
             self._num_ex_on_gpus = [ex_per_gpu] * (self._num_gpus - 1) + [ex_per_gpu + remaining]
             self._gpu_borders = self._gpu_idx_borders(self._exercise_gpu_map)
 
-            tmp = self._make_inputs_and_labels_placeholders(
-                self._pupil, self._num_optimizer_unrollings, self._num_exercises,
-                self._exercise_gpu_map)
+            if self._stacked_placeholders:
+                tmp = self._make_stacked_inputs_and_labels_placeholders(
+                    self._pupil, None if self._unrolling_loop else self._num_optimizer_unrollings,
+                    self._num_ex_on_gpus)
+            else:
+                tmp = self._make_inputs_and_labels_placeholders(
+                    self._pupil, self._num_optimizer_unrollings, self._num_exercises,
+                    self._exercise_gpu_map)
             self._pupil_grad_eval_inputs, self._pupil_grad_eval_labels,\
                 self._optimizer_grad_inputs, self._optimizer_grad_labels = tmp
             self._pupil_trainable_variables, self._pupil_grad_eval_pupil_storage, self._optimizer_grad_pupil_storage, \
-                self._pupil_savers, self._pupil_trainable_initializers = self._create_pupil_variables_and_savers(
-                    self._pupil, self._num_exercises, self._exercise_gpu_map)
+                self._pupil_savers, self._pupil_trainable_initializers, self._pupil_restore_placeholders, \
+                self._pupil_restore_ops = self._create_pupil_variables_and_savers(
+                    self._pupil, self._num_exercises, self._exercise_gpu_map,
+                    create_restore_ops=self._pupil_checkpoint_cache)
             # print("(ResNet4Lstm.__init__)self._pupil_grad_eval_pupil_storage:", self._pupil_grad_eval_pupil_storage)
             self._hooks['pupil_savers'] = self._pupil_savers
             self._hooks['pupil_trainable_initializers'] = self._pupil_trainable_initializers
+            self._hooks['pupil_restore_placeholders'] = self._pupil_restore_placeholders
+            self._hooks['pupil_restore_ops'] = self._pupil_restore_ops
             self._hooks['reset_pupil_grad_eval_pupil_storage'] = tf.group(
                 *chain(*[self._pupil.reset_storage(stor) for stor in self._pupil_grad_eval_pupil_storage])
             )
@@ -645,6 +764,7 @@ class ResNet4Lstm(Meta):
             self._num_lstm_nodes, self._num_res_layers)
         with tf.device(self._base_device):
             self._opt_trainable = self._create_optimizer_trainable_vars()
+        self._hooks['meta_optimizer_saver'] = self._create_meta_optimizer_saver(self._opt_trainable)
 
         # self._create_permutation_matrices(1, 0)
 
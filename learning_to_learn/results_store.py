@@ -0,0 +1,136 @@
+import sqlite3
+
+import numpy as np
+
+from learning_to_learn.useful_functions import convert
+
+
+RESULTS_STORE_FILE_NAME = 'results.sqlite'
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS results '
+    '(experiment INTEGER, pupil TEXT, regime TEXT, metric TEXT, step INTEGER, value REAL, training_step INTEGER)',
+    'CREATE INDEX IF NOT EXISTS results_idx ON results (metric, regime, pupil, experiment)',
+    'CREATE TABLE IF NOT EXISTS hyperparameters (experiment INTEGER, name TEXT, value TEXT, type TEXT)',
+]
+
+
+class ResultsStore(object):
+    """Append only SQLite file with results of one launch. Row of results table holds experiment index, pupil name,
+    regime ('train', 'validation'), metric name, step, value and meta optimizer training step at which optimizer
+    inference was performed. experiment, pupil and training_step can be None.
+    Hyperparameters of experiments are kept in separate table. Each append call is one transaction"""
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._connection = sqlite3.connect(file_name, timeout=60.)
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        # stores created before training_step column was added
+        columns = [r[1] for r in self._connection.execute('PRAGMA table_info(results)')]
+        if 'training_step' not in columns:
+            self._connection.execute('ALTER TABLE results ADD COLUMN training_step INTEGER')
+        self._connection.commit()
+
+    def append(self, rows):
+        """rows is a list of tuples (experiment, pupil, regime, metric, step, value, training_step)"""
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO results (experiment, pupil, regime, metric, step, value, training_step) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def add_hyperparameters(self, experiment, hp):
+        """hp is a dictionary. Hyperparameter names are converted into strings. Values are restored with their
+        types by ResultsStoreReader"""
+        rows = [(experiment, str(name), str(value), value.__class__.__name__) for name, value in hp.items()]
+        with self._connection:
+            self._connection.executemany('INSERT INTO hyperparameters VALUES (?, ?, ?, ?)', rows)
+
+    def close(self):
+        self._connection.close()
+
+
+class ResultsStoreReader(object):
+    def __init__(self, file_name):
+        self._connection = sqlite3.connect(file_name, timeout=60.)
+
+    def _distinct(self, column, table='results'):
+        return [r[0] for r in self._connection.execute(
+            'SELECT DISTINCT %s FROM %s ORDER BY %s' % (column, table, column))]
+
+    def get_experiments(self):
+        return self._distinct('experiment')
+
+    def get_pupils(self):
+        return self._distinct('pupil')
+
+    def get_regimes(self):
+        return self._distinct('regime')
+
+    def get_metrics(self):
+        return self._distinct('metric')
+
+    def get_hyperparameters(self, experiment):
+        res = dict()
+        for name, value, type_ in self._connection.execute(
+                'SELECT name, value, type FROM hyperparameters WHERE experiment = ?', (experiment,)):
+            res[name] = convert(value, type_)
+        return res
+
+    def get_hyperparameter_table(self):
+        """Returns experiment indices array and dictionary of hyperparameter value arrays aligned with it"""
+        experiments = self._distinct('experiment', table='hyperparameters')
+        table = dict()
+        for idx, experiment in enumerate(experiments):
+            for name, value in self.get_hyperparameters(experiment).items():
+                if name not in table:
+                    table[name] = [None] * len(experiments)
+                table[name][idx] = value
+        return np.array(experiments), dict([(name, np.array(values)) for name, values in table.items()])
+
+    @staticmethod
+    def _add_condition(conditions, params, column, value):
+        if value is None:
+            conditions.append('%s IS NULL' % column)
+        else:
+            conditions.append('%s = ?' % column)
+            params.append(value)
+
+    def get_results(self, metric, regime, pupil=None, experiment=None, training_step=None):
+        """Returns steps and values arrays sorted by step. training_step is a meta optimizer training step at which
+        optimizer inference was performed"""
+        conditions = list()
+        params = list()
+        for column, value in [('metric', metric), ('regime', regime), ('pupil', pupil), ('experiment', experiment),
+                              ('training_step', training_step)]:
+            self._add_condition(conditions, params, column, value)
+        rows = self._connection.execute(
+            'SELECT step, value FROM results WHERE %s ORDER BY step' % ' AND '.join(conditions), params).fetchall()
+        if len(rows) == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0])
+        steps, values = zip(*rows)
+        return np.array(steps), np.array(values, dtype=np.float64)
+
+    def get_results_by_experiments(self, metric, regime, pupil=None):
+        """Returns dictionary experiment index -> (steps, values). Loaded with one query"""
+        conditions = list()
+        params = list()
+        for column, value in [('metric', metric), ('regime', regime), ('pupil', pupil), ('training_step', None)]:
+            self._add_condition(conditions, params, column, value)
+        rows = self._connection.execute(
+            'SELECT experiment, step, value FROM results WHERE %s ORDER BY experiment, step' %
+            ' AND '.join(conditions), params).fetchall()
+        res = dict()
+        if len(rows) == 0:
+            return res
+        experiments, steps, values = [np.array(column) for column in zip(*rows)]
+        borders = np.flatnonzero(experiments[1:] != experiments[:-1]) + 1
+        for exp_steps, exp_values, exp_experiments in zip(
+                np.split(steps, borders), np.split(values, borders), np.split(experiments, borders)):
+            experiment = exp_experiments[0]
+            if experiment is not None:
+                experiment = int(experiment)
+            res[experiment] = (exp_steps, exp_values.astype(np.float64))
+        return res
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,105 @@
+import atexit
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+
+_open_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_writers():
+    for writer in list(_open_writers):
+        writer.close()
+
+
+class ResultsWriter(object):
+    """Appends lines to result files. Lines are accumulated in memory and written through file handles kept open
+    between writes. At most max_open_files handles are kept open, least recently used handle is closed first (e.g.
+    optimizer inference results are written into new file on every meta optimizer training step). Buffers are
+    flushed by background thread every flush_interval seconds, when size of buffered lines exceeds buffer_size
+    characters, on flush and close calls and on interpreter exit.
+    If flush_interval is None lines are written immediately.
+    If writer is used in a forked process it starts its own thread and file handles. Lines buffered by parent
+    process are not written by child."""
+    def __init__(self, flush_interval=1., buffer_size=65536, max_open_files=64):
+        self._flush_interval = flush_interval
+        self._buffer_size = buffer_size
+        self._max_open_files = max_open_files
+        self._closed = False
+        self._start()
+        _open_writers.add(self)
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._buffers = dict()
+        self._buffered_size = 0
+        self._handles = OrderedDict()
+        self._stop_event = threading.Event()
+        if self._flush_interval is not None:
+            self._thread = threading.Thread(target=self._flush_periodically, args=(self._stop_event,))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._thread = None
+
+    def _flush_periodically(self, stop_event):
+        while not stop_event.wait(self._flush_interval):
+            self.flush()
+
+    def _check_process(self):
+        if os.getpid() != self._pid:
+            self._start()
+
+    def _get_handle(self, file_name):
+        if file_name in self._handles:
+            self._handles.move_to_end(file_name)
+        else:
+            while len(self._handles) >= self._max_open_files:
+                _, f = self._handles.popitem(last=False)
+                f.close()
+            self._handles[file_name] = open(file_name, 'a', encoding='utf-8')
+        return self._handles[file_name]
+
+    def _write_buffers(self):
+        for file_name, lines in self._buffers.items():
+            f = self._get_handle(file_name)
+            f.write(''.join(lines))
+            f.flush()
+        self._buffers = dict()
+        self._buffered_size = 0
+
+    def write(self, file_name, line):
+        self._check_process()
+        if self._closed:
+            with open(file_name, 'a', encoding='utf-8') as f:
+                f.write(line)
+            return
+        with self._lock:
+            if file_name not in self._buffers:
+                self._buffers[file_name] = list()
+            self._buffers[file_name].append(line)
+            self._buffered_size += len(line)
+            if self._thread is None or self._buffered_size > self._buffer_size:
+                self._write_buffers()
+
+    def flush(self):
+        self._check_process()
+        with self._lock:
+            self._write_buffers()
+
+    def close(self):
+        if self._closed:
+            return
+        self._check_process()
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._lock:
+            self._write_buffers()
+            for f in self._handles.values():
+                f.close()
+            self._handles = OrderedDict()
+        self._closed = True
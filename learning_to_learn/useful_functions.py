@@ -7,6 +7,7 @@ import ast
 from collections import OrderedDict
 import tensorflow as tf
 from tensorflow.python.client import device_lib
+from learning_to_learn.grid_index import GRID_INDEX_FILE_NAME, read_grid_index
 
 
 escape_sequences = ['\\', '\'', '\"', '\a', '\b', '\f', '\n', '\r', '\t', '\v']
@@ -38,6 +39,14 @@ class WrongMethodCallError(Exception):
         self._msg = msg
 
 
+class WorkerError(Exception):
+    """Raised in parent process when task of worker process failed. Message contains traceback from worker because
+    exception objects are not always picklable"""
+    def __init__(self, msg):
+        super(WorkerError, self).__init__(msg)
+        self._msg = msg
+
+
 def create_vocabulary(text):
     all_characters = list()
     for char in text:
@@ -79,6 +88,40 @@ def filter_text(text, allowed_letters):
     return new_text
 
 
+def text2ids(tokens, vocabulary):
+    """Converts a text or a list of tokens into np.int32 array of ids. If all vocabulary entries are characters
+    conversion is performed with a lookup table over character codes"""
+    character_positions_in_vocabulary = get_positions_in_vocabulary(vocabulary)
+    if isinstance(tokens, str) and all([len(c) == 1 for c in vocabulary]):
+        codes = np.frombuffer(tokens.encode('utf-32-le'), dtype=np.uint32)
+        table = -np.ones(shape=(max([ord(c) for c in vocabulary]) + 1), dtype=np.int32)
+        for char, id_ in character_positions_in_vocabulary.items():
+            table[ord(char)] = id_
+        ids = -np.ones(shape=(len(codes)), dtype=np.int32)
+        in_table = codes < len(table)
+        ids[in_table] = table[codes[in_table]]
+        unexpected = np.nonzero(ids < 0)[0]
+        if len(unexpected) > 0:
+            char2id(tokens[unexpected[0]], character_positions_in_vocabulary)
+        return ids
+    ids = np.ndarray(shape=(len(tokens)), dtype=np.int32)
+    for idx, token in enumerate(tokens):
+        ids[idx] = char2id(token, character_positions_in_vocabulary)
+    return ids
+
+
+def create_id_file(tokens, vocabulary, file_name):
+    """Encodes text (or list of tokens) and saves ids in .npy format (file_name should have .npy extension). The file
+    is written once and later opened with load_id_file by memmap batch generators"""
+    create_path(file_name, file_name_is_in_path=True)
+    np.save(file_name, text2ids(tokens, vocabulary))
+
+
+def load_id_file(file_name):
+    """Ids are memory mapped so processes reading the same file share pages through OS cache"""
+    return np.load(file_name, mmap_mode='r')
+
+
 def char2vec(char, character_positions_in_vocabulary):
     voc_size = len(character_positions_in_vocabulary)
     vec = np.zeros(shape=(1, voc_size), dtype=np.float)
@@ -965,6 +1008,23 @@ def compose_randomize_list(*args, name_scope='randomize_list'):
         return randomize_list
 
 
+def permute_last_dim(tensor, permutations):
+    """Permutes elements along last dimension of tensor independently for every exercise. tensor has shape
+    [num_exercises, ..., dim] and permutations is integer tensor of shape [num_exercises, dim]:
+        res[e, ..., j] = tensor[e, ..., permutations[e, j]]
+    Result is the same as of multiplication by one hot permutation matrices but only O(dim) memory is used"""
+    with tf.name_scope('permute_last_dim'):
+        shape = tensor.get_shape().as_list()
+        ndims = len(shape)
+        num_exercises, dim = shape[0], shape[-1]
+        transposed = tf.transpose(tensor, perm=[0, ndims - 1] + list(range(1, ndims - 1)))
+        flat = tf.reshape(transposed, [num_exercises * dim, -1])
+        indices = permutations + tf.expand_dims(tf.range(num_exercises) * dim, 1)
+        gathered = tf.gather(flat, tf.reshape(indices, [-1]))
+        gathered = tf.reshape(gathered, [num_exercises, dim] + shape[1:-1])
+        return tf.transpose(gathered, perm=[0] + list(range(2, ndims)) + [1])
+
+
 def block_diagonal(matrices, dtype=tf.float32):
     r"""Constructs block-diagonal matrices from a list of batched 2D tensors.
 
@@ -1306,6 +1366,17 @@ def get_hps(file_name):
 
 
 def get_combs_and_num_exps(eval_dir):
+    """Returns completed hyperparameter combinations and number of experiments. Grid search index is used if
+    eval_dir contains it. Otherwise experiment description files are parsed"""
+    index_file_name = os.path.join(eval_dir, GRID_INDEX_FILE_NAME)
+    if os.path.exists(index_file_name):
+        hp_sets = list()
+        records = read_grid_index(index_file_name)
+        for record in records:
+            hp_set = tuple([convert(v, t) for _, v, t in record['hp']])
+            if hp_set not in hp_sets:
+                hp_sets.append(hp_set)
+        return hp_sets, len(records)
     contents = os.listdir(eval_dir)
     exp_description_files = list()
     for entry in contents:
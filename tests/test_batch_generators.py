@@ -0,0 +1,109 @@
+import numpy as np
+import tensorflow as tf
+
+from learning_to_learn.batch_generators import redistribute_cursors
+from learning_to_learn.lstm_for_meta import LstmBatchGenerator, LstmFastBatchGenerator
+from learning_to_learn.useful_functions import InvalidArgumentError
+
+
+TEXT = 'the quick brown fox jumps over the lazy dog!'
+VOCABULARY = LstmBatchGenerator.create_vocabulary([TEXT])
+
+
+class RedistributeCursorsTest(tf.test.TestCase):
+
+    def testAddedCursorsArePlacedEvenly(self):
+        self.assertEqual(redistribute_cursors([0, 10, 20], 5, 30), [0, 10, 20, 18, 24])
+
+    def testAddedCursorsWrapAroundDataset(self):
+        self.assertEqual(redistribute_cursors([25], 3, 30), [25, 5, 15])
+
+    def testFirstCursorsAreKept(self):
+        self.assertEqual(redistribute_cursors(np.array([3, 13, 23]), 2, 30), [3, 13])
+
+
+class ChangeSpecsTest(tf.test.TestCase):
+
+    def _create(self, batch_size=2, num_unrollings=3):
+        return LstmFastBatchGenerator(TEXT, batch_size, num_unrollings=num_unrollings, vocabulary=VOCABULARY)
+
+    def testIncreaseBatchSizeKeepsOldStreams(self):
+        gen, reference = self._create(), self._create()
+        gen.next()
+        reference.next()
+        gen.change_batch_size(4)
+        self.assertAllEqual(gen._cursor, [3, 25, 25, 36])
+        inputs, _ = gen.next()
+        reference_inputs, _ = reference.next()
+        self.assertEqual(inputs.shape, (3, 4, 1))
+        self.assertAllEqual(inputs[:, :2], reference_inputs)
+        # added streams start from start batch and their cursors
+        ids = gen.get_ids()
+        self.assertAllEqual(inputs[:, 2, 0], [0, ids[25], ids[26]])
+        self.assertAllEqual(inputs[:, 3, 0], [0, ids[36], ids[37]])
+
+    def testDecreaseBatchSizeKeepsFirstStreams(self):
+        gen, reference = self._create(batch_size=3), self._create(batch_size=3)
+        gen.next()
+        reference.next()
+        gen.change_specs(batch_size=1)
+        inputs, labels = gen.next()
+        reference_inputs, reference_labels = reference.next()
+        self.assertAllEqual(inputs, reference_inputs[:, :1])
+        self.assertAllEqual(labels, reference_labels.reshape((3, 3))[:, :1].reshape((-1, 1)))
+
+    def testChangeNumUnrollings(self):
+        gen = self._create()
+        gen.next()
+        gen.next()
+        gen.change_specs(num_unrollings=5)
+        inputs, labels = gen.next()
+        ids = gen.get_ids()
+        self.assertEqual(inputs.shape, (5, 2, 1))
+        self.assertEqual(labels.shape, (10, 1))
+        # window continues from last character of previous window
+        self.assertAllEqual(inputs[:, 0, 0], ids[5:10])
+        self.assertAllEqual(inputs[:, 1, 0], ids[27:32])
+        self.assertAllEqual(labels.reshape((5, 2))[:, 0], ids[6:11])
+
+    def testVocabularyCanNotBeChanged(self):
+        gen = self._create()
+        gen.change_specs(vocabulary=VOCABULARY)
+        with self.assertRaises(InvalidArgumentError):
+            gen.change_specs(vocabulary=VOCABULARY[::-1])
+
+
+class CursorStateTest(tf.test.TestCase):
+
+    def _check_rewind(self, batch_gen_cls):
+        gen = batch_gen_cls(TEXT, 3, num_unrollings=4, vocabulary=VOCABULARY)
+        gen.next()
+        state = gen.get_cursor_state()
+        inputs, labels = gen.next()
+        gen.next()
+        gen.set_cursor_state(state)
+        rewound_inputs, rewound_labels = gen.next()
+        self.assertAllEqual(rewound_inputs, inputs)
+        self.assertAllEqual(rewound_labels, labels)
+
+    def testRewind(self):
+        self._check_rewind(LstmBatchGenerator)
+        self._check_rewind(LstmFastBatchGenerator)
+
+    def testStateIsCopy(self):
+        gen = LstmFastBatchGenerator(TEXT, 2, num_unrollings=2, vocabulary=VOCABULARY)
+        cursor, last_batch = gen.get_cursor_state()
+        gen.next()
+        self.assertEqual(cursor, [0, 22])
+        self.assertAllEqual(last_batch, np.zeros((2, 1)))
+
+    def testCursorTypeIsKept(self):
+        gen = LstmFastBatchGenerator(TEXT, 2, num_unrollings=2, vocabulary=VOCABULARY)
+        gen.set_cursor_state(([5, 7], np.zeros((2, 1), dtype=np.int32)))
+        self.assertIsInstance(gen._cursor, np.ndarray)
+        inputs, _ = gen.next()
+        self.assertAllEqual(inputs[1:, :, 0], [[gen.get_ids()[5], gen.get_ids()[7]]])
+
+
+if __name__ == '__main__':
+    tf.test.main()
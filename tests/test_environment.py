@@ -0,0 +1,74 @@
+import tensorflow as tf
+
+from learning_to_learn.environment import Controller
+
+
+class DivergenceDetectorTest(tf.test.TestCase):
+
+    def _create(self, **specs):
+        storage = dict(train=dict(loss=list(), accuracy=list()))
+        specs['type'] = 'divergence_detector'
+        return storage, Controller(storage, specs)
+
+    def _feed(self, storage, controller, values, result_type='loss'):
+        reasons = list()
+        for value in values:
+            storage['train'][result_type].append(value)
+            reasons.append(controller.get())
+        return reasons
+
+    def testNoValues(self):
+        _, controller = self._create()
+        self.assertIsNone(controller.get())
+
+    def testNan(self):
+        storage, controller = self._create()
+        reasons = self._feed(storage, controller, [2., 1.5, float('nan'), 1.])
+        self.assertIsNone(reasons[1])
+        self.assertIn('nan', reasons[2])
+        # launch stays aborted
+        self.assertEqual(reasons[3], reasons[2])
+
+    def testNanIsNotCheckedIfSwitchedOff(self):
+        storage, controller = self._create(check_nan=False)
+        self.assertIsNone(self._feed(storage, controller, [2., float('inf')])[-1])
+
+    def testThreshold(self):
+        storage, controller = self._create(threshold=10.)
+        reasons = self._feed(storage, controller, [5., 10., 11.])
+        self.assertIsNone(reasons[1])
+        self.assertIn('exceeds threshold', reasons[2])
+
+    def testThresholdIfMaximized(self):
+        storage, controller = self._create(result_type='accuracy', threshold=.1)
+        reasons = self._feed(storage, controller, [.2, .1, .05], result_type='accuracy')
+        self.assertIsNone(reasons[1])
+        self.assertIn('below threshold', reasons[2])
+
+    def testWindow(self):
+        storage, controller = self._create(window=2)
+        reasons = self._feed(storage, controller, [3., 2., 2.5, 1.9, 2.1, 2.2])
+        self.assertEqual(reasons[:5], [None] * 5)
+        self.assertIn('did not improve', reasons[5])
+
+    def testWindowMinDelta(self):
+        storage, controller = self._create(window=1, min_delta=.5)
+        reasons = self._feed(storage, controller, [3., 2., 1.8])
+        self.assertIsNone(reasons[1])
+        self.assertIn('did not improve', reasons[2])
+
+    def testWindowIfMaximized(self):
+        storage, controller = self._create(result_type='accuracy', window=2)
+        reasons = self._feed(storage, controller, [.1, .2, .15, .25, .2, .24], result_type='accuracy')
+        self.assertEqual(reasons[:5], [None] * 5)
+        self.assertIn('did not improve', reasons[5])
+
+    def testMaximizeCanBeSetExplicitly(self):
+        storage, controller = self._create(maximize=True, threshold=1.)
+        reasons = self._feed(storage, controller, [2., 3., .5])
+        self.assertEqual(reasons[:2], [None] * 2)
+        self.assertIn('below threshold', reasons[2])
+
+
+if __name__ == '__main__':
+    tf.test.main()
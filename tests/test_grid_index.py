@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from learning_to_learn.grid_index import GRID_INDEX_FILE_NAME, GridSearchIndex, hp_comb_hash, read_grid_index
+
+
+class HpCombHashTest(unittest.TestCase):
+
+    def testOrderIndependence(self):
+        hp_comb = OrderedDict([('learning_rate', .1), ('num_nodes', 100), ('optimizer', 'adam')])
+        reversed_hp_comb = OrderedDict(reversed(list(hp_comb.items())))
+        self.assertEqual(hp_comb_hash(hp_comb), hp_comb_hash(reversed_hp_comb))
+
+    def testValueTypeIsTakenIntoAccount(self):
+        hashes = set([hp_comb_hash(dict(value=value)) for value in [1, 1., '1']])
+        self.assertEqual(len(hashes), 3)
+
+    def testDifferentValues(self):
+        self.assertNotEqual(hp_comb_hash(dict(learning_rate=.1)), hp_comb_hash(dict(learning_rate=.2)))
+
+
+class GridSearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._file_name = os.path.join(self._dir, GRID_INDEX_FILE_NAME)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def testReadMissingIndex(self):
+        self.assertEqual(read_grid_index(self._file_name), list())
+        self.assertEqual(len(GridSearchIndex(self._file_name)), 0)
+
+    def testTruncatedLineIsSkipped(self):
+        index = GridSearchIndex(self._file_name)
+        index.add(dict(learning_rate=.1), experiment=0)
+        index.add(dict(learning_rate=.2), experiment=1)
+        # crash during writing of the last line
+        with open(self._file_name, 'a', encoding='utf-8') as f:
+            f.write('{"hash": "abc", "experi')
+        records = read_grid_index(self._file_name)
+        self.assertEqual([record['experiment'] for record in records], [0, 1])
+        self.assertEqual(records[1]['hp'], [['learning_rate', '0.2', 'float']])
+
+    def testRecordAfterTruncatedLineIsNotLost(self):
+        GridSearchIndex(self._file_name).add(dict(learning_rate=.1), experiment=0)
+        with open(self._file_name, 'a', encoding='utf-8') as f:
+            f.write('{"hash": "abc", "experi')
+        GridSearchIndex(self._file_name).add(dict(learning_rate=.2), experiment=1)
+        index = GridSearchIndex(self._file_name)
+        self.assertEqual(len(index), 2)
+        self.assertIn(dict(learning_rate=.2), index)
+
+    def testResume(self):
+        index = GridSearchIndex(self._file_name)
+        self.assertEqual(index.get_next_experiment(), 0)
+        index.add(OrderedDict([('learning_rate', .1), ('num_nodes', 100)]), experiment=0)
+        index.add(OrderedDict([('learning_rate', .2), ('num_nodes', 100)]), experiment=1)
+        resumed = GridSearchIndex(self._file_name)
+        self.assertEqual(len(resumed), 2)
+        self.assertIn(OrderedDict([('num_nodes', 100), ('learning_rate', .1)]), resumed)
+        self.assertNotIn(OrderedDict([('learning_rate', .3), ('num_nodes', 100)]), resumed)
+        self.assertEqual(resumed.get_next_experiment(), 2)
+
+    def testNextExperimentIgnoresPupilGridSearchRecords(self):
+        index = GridSearchIndex(self._file_name)
+        index.add(dict(learning_rate=.1))
+        self.assertEqual(GridSearchIndex(self._file_name).get_next_experiment(), 0)
+        index.add(dict(learning_rate=.2), experiment=4)
+        self.assertEqual(GridSearchIndex(self._file_name).get_next_experiment(), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import numpy as np
+import tensorflow as tf
+
+from learning_to_learn.lstm_for_meta import LstmBatchGenerator, LstmFastBatchGenerator
+
+
+TEXT = 'the quick brown fox jumps over the lazy dog!'
+
+
+class LstmFastBatchGeneratorTest(tf.test.TestCase):
+
+    def _check_same_batches(self, batch_size, num_unrollings, num_steps=7):
+        vocabulary = LstmBatchGenerator.create_vocabulary([TEXT])
+        one_hot_gen = LstmBatchGenerator(TEXT, batch_size, num_unrollings=num_unrollings, vocabulary=vocabulary)
+        fast_gen = LstmFastBatchGenerator(TEXT, batch_size, num_unrollings=num_unrollings, vocabulary=vocabulary)
+        # several steps so that cursors pass the end of the text
+        for _ in range(num_steps):
+            one_hot_inputs, one_hot_labels = one_hot_gen.next()
+            inputs, labels = fast_gen.next()
+            self.assertEqual(inputs.shape, (num_unrollings, batch_size, 1))
+            self.assertEqual(labels.shape, (num_unrollings * batch_size, 1))
+            self.assertAllEqual(np.argmax(one_hot_inputs, -1), inputs[:, :, 0])
+            self.assertAllEqual(np.argmax(one_hot_labels, -1), labels[:, 0])
+
+    def testBatchesMatchOneHotGenerator(self):
+        for batch_size in [1, 3, 8]:
+            for num_unrollings in [1, 2, 5]:
+                self._check_same_batches(batch_size, num_unrollings)
+
+
+if __name__ == '__main__':
+    tf.test.main()
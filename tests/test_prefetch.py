@@ -0,0 +1,48 @@
+import time
+
+import tensorflow as tf
+
+from learning_to_learn.lstm_for_meta import LstmBatchGenerator, LstmFastBatchGenerator
+from learning_to_learn.prefetch import PrefetchingBatchGenerator
+
+
+TEXT = 'the quick brown fox jumps over the lazy dog!'
+VOCABULARY = LstmBatchGenerator.create_vocabulary([TEXT])
+
+
+class PrefetchingBatchGeneratorTest(tf.test.TestCase):
+
+    def _create(self):
+        return LstmFastBatchGenerator(TEXT, 2, num_unrollings=3, vocabulary=VOCABULARY)
+
+    def _check_same_sequence(self, queue_size, wait_before_change):
+        """Specs are changed mid-stream. If wait_before_change is True queue is filled before change, otherwise
+        change is likely to happen while worker produces batch"""
+        changes = {3: dict(batch_size=4), 7: dict(batch_size=1), 10: dict(num_unrollings=5), 14: dict(batch_size=3)}
+        reference = self._create()
+        prefetching = PrefetchingBatchGenerator(self._create(), queue_size=queue_size)
+        try:
+            for step in range(20):
+                if step in changes:
+                    if wait_before_change:
+                        time.sleep(.05)
+                    reference.change_specs(**changes[step])
+                    if list(changes[step].keys()) == ['batch_size']:
+                        prefetching.change_batch_size(changes[step]['batch_size'])
+                    else:
+                        prefetching.change_specs(**changes[step])
+                reference_inputs, reference_labels = reference.next()
+                inputs, labels = prefetching.next()
+                self.assertAllEqual(inputs, reference_inputs)
+                self.assertAllEqual(labels, reference_labels)
+        finally:
+            prefetching.close()
+
+    def testChangeSpecsGivesSameSequenceAsUnwrappedGenerator(self):
+        for queue_size in [1, 2, 5]:
+            for wait_before_change in [False, True]:
+                self._check_same_sequence(queue_size, wait_before_change)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,248 @@
+import os
+import zlib
+
+import numpy as np
+import tensorflow as tf
+
+from learning_to_learn.lstm_for_meta import Lstm
+from learning_to_learn.res_net_opt import ResNet4Lstm
+
+
+NUM_EXERCISES = 2
+BATCH_SIZE = 3
+VOCABULARY_SIZE = 9
+NUM_PUPIL_UNROLLINGS = 2
+
+
+def build_pupil_and_optimizer(**optimizer_kwargs):
+    pupil = Lstm(
+        batch_size=BATCH_SIZE,
+        num_layers=2,
+        num_nodes=[6, 7],
+        num_output_layers=2,
+        num_output_nodes=[5],
+        vocabulary_size=VOCABULARY_SIZE,
+        embedding_size=4,
+        num_unrollings=NUM_PUPIL_UNROLLINGS,
+        regime='training_with_meta_optimizer'
+    )
+    kwargs = dict(
+        num_exercises=NUM_EXERCISES,
+        num_lstm_nodes=8,
+        num_optimizer_unrollings=1,
+        num_res_layers=2,
+        res_size=10,
+        permute=False,
+        regime='train'
+    )
+    kwargs.update(optimizer_kwargs)
+    return pupil, ResNet4Lstm(pupil, **kwargs)
+
+
+def assign_random_values(seed=0):
+    """Returns ops assigning random values to global variables. Values depend only on variable names, so variables
+    of differently built graphs get the same values. Permutation variables get valid permutations"""
+    ops = list()
+    for v in tf.global_variables():
+        shape = v.get_shape().as_list()
+        rng = np.random.RandomState((zlib.crc32(v.op.name.encode('utf-8')) + seed) % 2**32)
+        if 'permutation_matrices' in v.op.name:
+            permutations = np.stack([rng.permutation(shape[2]) for _ in range(shape[1])])
+            value = np.stack([permutations, np.argsort(permutations, axis=1)])
+        elif v.dtype.base_dtype.is_floating:
+            value = .1 * np.asarray(rng.randn(*shape))
+        else:
+            continue
+        ops.append(tf.assign(v, value.astype(v.dtype.base_dtype.as_numpy_dtype)))
+    return ops
+
+
+def random_feed_dict(pupil, optimizer, num_optimizer_unrollings, seed=0):
+    """Random inputs and labels for all exercises and optimizer unrollings. Stacked placeholders are used if
+    optimizer is built with them"""
+    rng = np.random.RandomState(seed)
+    hooks = optimizer.get_default_hooks()
+    leading_dims = [NUM_EXERCISES, num_optimizer_unrollings]
+    arrays = dict()
+    for name in ['pupil_grad_eval', 'optimizer_grad']:
+        arrays[name + '_inputs'] = rng.randint(
+            VOCABULARY_SIZE, size=leading_dims + [NUM_PUPIL_UNROLLINGS, BATCH_SIZE, 1])
+        arrays[name + '_labels'] = rng.randint(
+            VOCABULARY_SIZE, size=leading_dims + [NUM_PUPIL_UNROLLINGS * BATCH_SIZE, 1])
+    feed_dict = {
+        hooks['optimizer_dropout_keep_prob']: 1.,
+        pupil.get_default_hooks()['dropout']: 1.,
+    }
+    for name, array in arrays.items():
+        if 'stacked_' + name in hooks:
+            feed_dict[hooks['stacked_' + name][0]] = array
+        else:
+            for ex_idx, ex_placeholders in enumerate(hooks[name]):
+                for unr_idx, placeholder in enumerate(ex_placeholders):
+                    feed_dict[placeholder] = array[ex_idx, unr_idx]
+    return feed_dict
+
+
+def compute_losses_and_optimizer_gradients(test_case, num_optimizer_unrollings=2, **optimizer_kwargs):
+    """Builds pupil and optimizer in new graph. Returns start loss, end loss and dictionary with gradients of end
+    loss with respect to optimizer trainable variables"""
+    graph = tf.Graph()
+    with graph.as_default():
+        pupil, optimizer = build_pupil_and_optimizer(
+            num_optimizer_unrollings=num_optimizer_unrollings, **optimizer_kwargs)
+        hooks = optimizer.get_default_hooks()
+        variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='optimizer_trainable_variables')
+        grads = tf.gradients(hooks['end_loss'], variables)
+        randomize = assign_random_values()
+        feed_dict = random_feed_dict(pupil, optimizer, num_optimizer_unrollings)
+        with test_case.test_session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(randomize)
+            start_loss, end_loss, grad_values = sess.run(
+                [hooks['start_loss'], hooks['end_loss'], grads], feed_dict=feed_dict)
+    return start_loss, end_loss, dict([(v.op.name, g) for v, g in zip(variables, grad_values)])
+
+
+class FusedResCoresTest(tf.test.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+        self._pupil, self._optimizer = build_pupil_and_optimizer()
+
+    def _random_ins(self, rng):
+        num_rows = 2 * BATCH_SIZE
+        dims = dict(embedding_layer=self._pupil.get_layer_dims()['embedding_layer'])
+        for layer_idx, layer_dims in enumerate(self._pupil.get_layer_dims()['lstm_layers']):
+            dims['lstm_layer_%s' % layer_idx] = layer_dims
+        for layer_idx, layer_dims in enumerate(self._pupil.get_layer_dims()['output_layers']):
+            dims['output_layer_%s' % layer_idx] = layer_dims
+        ins = dict()
+        for layer_name, (o_dim, sigma_dim) in dims.items():
+            ins[layer_name] = dict(
+                o_c=tf.constant(rng.randn(NUM_EXERCISES, num_rows, o_dim), dtype=tf.float32),
+                sigma_c=tf.constant(rng.randn(NUM_EXERCISES, num_rows, sigma_dim), dtype=tf.float32)
+            )
+        return ins
+
+    def testFusedResCoresMatchPerLayerCores(self):
+        rng = np.random.RandomState(0)
+        ins = self._random_ins(rng)
+        res_idx = 0
+        rnn_part = tf.constant(
+            rng.randn(NUM_EXERCISES, self._optimizer._rnn_for_res_layers[res_idx]), dtype=tf.float32)
+        res_vars = self._optimizer._opt_trainable['res_layers'][res_idx]
+        outs, rnn_sum = self._optimizer._apply_res_layer(
+            ins, res_vars, rnn_part, 'per_layer_cores', fuse_res_cores=False)
+        fused_outs, fused_rnn_sum = self._optimizer._apply_res_layer(
+            ins, res_vars, rnn_part, 'fused_cores', fuse_res_cores=True)
+        # output parts of cores are initialized with zeros so variables are randomized
+        randomize = [
+            tf.assign(v, rng.randn(*v.get_shape().as_list()).astype(np.float32))
+            for v in tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='optimizer_trainable_variables')]
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(randomize)
+            res, fused_res = sess.run([(outs, rnn_sum), (fused_outs, fused_rnn_sum)])
+        outs, rnn_sum = res
+        fused_outs, fused_rnn_sum = fused_res
+        self.assertAllClose(rnn_sum, fused_rnn_sum, rtol=1e-5, atol=1e-5)
+        for layer_name in ins:
+            self.assertAllClose(outs[layer_name]['o_c'], fused_outs[layer_name]['o_c'], rtol=1e-5, atol=1e-5)
+            self.assertAllClose(
+                outs[layer_name]['sigma_c'], fused_outs[layer_name]['sigma_c'], rtol=1e-5, atol=1e-5)
+
+
+class MetaOptimizerSaverTest(tf.test.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+        self._pupil, self._optimizer = build_pupil_and_optimizer()
+
+    def testSaveAndRestore(self):
+        saver = self._optimizer.get_default_hooks()['meta_optimizer_saver']
+        variables = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='optimizer_trainable_variables')
+        self.assertGreater(len(variables), 0)
+        rng = np.random.RandomState(1)
+        randomize = [
+            tf.assign(v, rng.randn(*v.get_shape().as_list()).astype(np.float32)) for v in variables]
+        path = os.path.join(self.get_temp_dir(), 'meta_optimizer')
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(randomize)
+            saved = sess.run(variables)
+            saver.save(sess, path)
+            sess.run(tf.global_variables_initializer())
+            saver.restore(sess, path)
+            restored = sess.run(variables)
+        for s, r in zip(saved, restored):
+            self.assertAllEqual(s, r)
+
+
+class PupilRestoreOpsTest(tf.test.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+
+    def testRestoreOpsAreNotBuiltByDefault(self):
+        _, optimizer = build_pupil_and_optimizer()
+        # hooks which are None are not returned
+        hooks = optimizer.get_default_hooks()
+        self.assertNotIn('pupil_restore_placeholders', hooks)
+        self.assertNotIn('pupil_restore_ops', hooks)
+
+    def testRestoreOpsAreBuiltForCheckpointCache(self):
+        _, optimizer = build_pupil_and_optimizer(pupil_checkpoint_cache=True)
+        hooks = optimizer.get_default_hooks()
+        self.assertEqual(len(hooks['pupil_restore_placeholders']), NUM_EXERCISES)
+        self.assertEqual(len(hooks['pupil_restore_ops']), NUM_EXERCISES)
+
+
+class RecomputedUnrollingsTest(tf.test.TestCase):
+
+    def _check_same_as_plain(self, **optimizer_kwargs):
+        start_loss, end_loss, grads = compute_losses_and_optimizer_gradients(self, **optimizer_kwargs)
+        recomputed_start_loss, recomputed_end_loss, recomputed_grads = compute_losses_and_optimizer_gradients(
+            self, recompute_unrollings=True, **optimizer_kwargs)
+        self.assertAllClose(start_loss, recomputed_start_loss, rtol=1e-5, atol=1e-5)
+        self.assertAllClose(end_loss, recomputed_end_loss, rtol=1e-5, atol=1e-5)
+        self.assertEqual(sorted(grads.keys()), sorted(recomputed_grads.keys()))
+        for name, g in grads.items():
+            self.assertAllClose(g, recomputed_grads[name], rtol=1e-4, atol=1e-5)
+
+    def testGradientsMatchPlainUnrollings(self):
+        self._check_same_as_plain()
+
+    def testGradientsMatchPlainUnrollingsWithPermutations(self):
+        # permutation variables are read inside recomputed segment
+        self._check_same_as_plain(permute=True)
+
+
+class UnrollingLoopTest(tf.test.TestCase):
+
+    def _check_same_as_static(self, **optimizer_kwargs):
+        start_loss, end_loss, grads = compute_losses_and_optimizer_gradients(self, **optimizer_kwargs)
+        loop_start_loss, loop_end_loss, loop_grads = compute_losses_and_optimizer_gradients(
+            self, unrolling_loop=True, **optimizer_kwargs)
+        self.assertAllClose(start_loss, loop_start_loss, rtol=1e-5, atol=1e-5)
+        self.assertAllClose(end_loss, loop_end_loss, rtol=1e-5, atol=1e-5)
+        self.assertEqual(sorted(grads.keys()), sorted(loop_grads.keys()))
+        for name, g in grads.items():
+            self.assertAllClose(g, loop_grads[name], rtol=1e-4, atol=1e-5)
+
+    def testLoopMatchesStaticUnrollings(self):
+        self._check_same_as_static()
+
+    def testLoopMatchesStaticUnrollingsWithPermutations(self):
+        self._check_same_as_static(permute=True)
+
+    def testLoopMatchesStackedStaticUnrollings(self):
+        self._check_same_as_static(stacked_placeholders=True, num_optimizer_unrollings=3)
+
+    def testDebugTensorsAreNotCollectedInLoop(self):
+        tf.reset_default_graph()
+        _, optimizer = build_pupil_and_optimizer(unrolling_loop=True)
+        self.assertEqual(optimizer._debug_tensors, list())
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,52 @@
+import numpy as np
+import tensorflow as tf
+
+from learning_to_learn.res_net_opt import ResNet4Lstm
+from learning_to_learn.useful_functions import custom_matmul, permute_last_dim
+
+
+NUM_EXERCISES = 3
+DIM = 5
+
+
+class PermuteLastDimTest(tf.test.TestCase):
+
+    def setUp(self):
+        tf.reset_default_graph()
+        self._rng = np.random.RandomState(0)
+        self._permutations = np.stack([self._rng.permutation(DIM) for _ in range(NUM_EXERCISES)]).astype(np.int32)
+
+    def _one_hot_matmul(self, tensor, permutations):
+        """Multiplication by transposed one hot permutation matrices which was used before permute_last_dim"""
+        matrices = np.transpose(np.eye(DIM)[permutations], [0, 2, 1])
+        return np.einsum('e...i,eij->e...j', tensor, matrices)
+
+    def testMatchesOneHotMatmul(self):
+        for shape in [[NUM_EXERCISES, DIM], [NUM_EXERCISES, 4, DIM], [NUM_EXERCISES, 2, 4, DIM]]:
+            tensor = self._rng.randn(*shape).astype(np.float32)
+            permuted = permute_last_dim(tf.constant(tensor), tf.constant(self._permutations))
+            with self.test_session() as sess:
+                res = sess.run(permuted)
+            self.assertAllClose(res, self._one_hot_matmul(tensor, self._permutations))
+
+    def testMatchesCustomMatmul(self):
+        tensor = self._rng.randn(NUM_EXERCISES, 4, DIM).astype(np.float32)
+        matrices = tf.matrix_transpose(tf.one_hot(self._permutations, DIM))
+        permuted = permute_last_dim(tf.constant(tensor), tf.constant(self._permutations))
+        multiplied = custom_matmul(tf.constant(tensor), matrices)
+        with self.test_session() as sess:
+            res, expected = sess.run([permuted, multiplied])
+        self.assertAllClose(res, expected)
+
+    def testInversePermutationRestoresTensor(self):
+        tensor = self._rng.randn(NUM_EXERCISES, 2, 4, DIM).astype(np.float32)
+        # permutation and its inverse are created the same way as permutation variables of ResNet4Lstm
+        permutations = ResNet4Lstm._create_permutation_matrix(DIM, NUM_EXERCISES)
+        restored = permute_last_dim(permute_last_dim(tf.constant(tensor), permutations[0]), permutations[1])
+        with self.test_session() as sess:
+            res = sess.run(restored)
+        self.assertAllEqual(res, tensor)
+
+
+if __name__ == '__main__':
+    tf.test.main()